@@ -0,0 +1,189 @@
+"""
+初回同期（バックフィル）モード
+
+大量のメールが残っている取得元を、1回の実行あたり件数・バイト数・時間の上限つきで
+少しずつ処理します。進捗は状態ディレクトリに保存され、残り件数と処理速度から
+完了見込み時間 (ETA) を計算します。すべて処理し終えると通常の取得元として扱われます。
+
+    sources:
+      - protocol: imap
+        ...
+        backfill:
+          max_messages: 500     # 1回の実行で処理する最大件数
+          max_bytes: 200000000  # 1回の実行で処理する最大バイト数
+          max_seconds: 300      # 1回の実行で使う最大時間（秒）
+"""
+
+import os
+import json
+import time
+import logging
+from typing import Any, Callable, Dict, List, Optional
+from config_model import BackfillConfig
+from journal import state_file_name
+
+logger = logging.getLogger(__name__)
+
+
+def format_duration(seconds: float) -> str:
+    """秒数を「1時間5分」のような表記にする"""
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}秒"
+    minutes, _ = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}時間{minutes}分"
+    return f"{minutes}分"
+
+
+class BackfillState:
+    """1つの取得元のバックフィル進捗"""
+
+    def __init__(self, path: str, options: BackfillConfig):
+        self.path = path
+        self.max_messages = options.max_messages
+        self.max_bytes = options.max_bytes
+        self.max_seconds = options.max_seconds
+
+        self.done = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.remaining: Optional[int] = None
+        self.complete = False
+        self._started = None
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.done = data.get('done', 0)
+                self.bytes = data.get('bytes', 0)
+                self.seconds = data.get('seconds', 0.0)
+                self.remaining = data.get('remaining')
+                self.complete = data.get('complete', False)
+            except (OSError, ValueError) as e:
+                logger.warning(f"バックフィル進捗の読み込みに失敗しました: {e}")
+
+    @classmethod
+    def load(cls, state_dir: Optional[str], source_config: Dict[str, Any],
+             options: Optional[BackfillConfig]) -> Optional['BackfillState']:
+        """バックフィルが設定されていれば進捗を読み込む"""
+        if not options or not state_dir:
+            return None
+        return cls(os.path.join(state_dir, state_file_name('backfill', source_config)), options)
+
+    @property
+    def active(self) -> bool:
+        return not self.complete
+
+    @property
+    def started(self) -> bool:
+        """begin() を呼び出し、finish() をまだ呼び出していない"""
+        return self._started is not None
+
+    def begin(self):
+        """取得元の処理を始める前に呼び出す。予算は取得元の全フォルダで共有する"""
+        self._started = time.monotonic()
+        self._selected = 0
+        self._selected_bytes = 0
+        self._processed = 0
+        self._transferred = 0
+        self._remaining = 0
+
+    def select(self, message_ids: List[Any], sizes: Optional[Callable[[List[Any]], Dict[Any, int]]] = None) -> List[Any]:
+        """
+        今回処理するメッセージを、残りの件数・バイト数の予算で切り出す。
+        sizes はIDの一覧からサイズの辞書を返す関数（バイト数上限がある場合のみ使用）。
+        """
+        if self.out_of_time():
+            chunk = []
+        elif self.max_messages:
+            chunk = message_ids[:max(self.max_messages - self._selected, 0)]
+        else:
+            chunk = list(message_ids)
+        if self.max_bytes and sizes and chunk:
+            size_map = sizes(chunk)
+            total = self._selected_bytes
+            for i, msg_id in enumerate(chunk):
+                total += size_map.get(msg_id, 0)
+                # 今回まだ1件も選んでいなければ、上限を超えていても進まなくならないように処理する
+                if total > self.max_bytes and (i > 0 or self._selected > 0):
+                    chunk = chunk[:i]
+                    break
+            self._selected_bytes += sum(size_map.get(msg_id, 0) for msg_id in chunk)
+        self._selected += len(chunk)
+        if len(chunk) < len(message_ids):
+            logger.info(f"バックフィル: 今回は {len(message_ids)} 件中 {len(chunk)} 件を処理します")
+        return chunk
+
+    def out_of_time(self) -> bool:
+        return bool(self.max_seconds and self._started is not None
+                    and time.monotonic() - self._started > self.max_seconds)
+
+    def eta(self) -> Optional[float]:
+        """残り件数と平均処理速度から完了までの見込み秒数を返す"""
+        if not self.remaining or not self.done or not self.seconds:
+            return None
+        return self.remaining / (self.done / self.seconds)
+
+    def record(self, processed: int, transferred_bytes: int, remaining: int):
+        """フォルダごとの処理結果を加算する"""
+        self._processed += processed
+        self._transferred += transferred_bytes
+        self._remaining += remaining
+
+    def finish(self, partial: bool = False):
+        """
+        今回の処理結果を反映して保存する。
+        partial: エラー・停止で中断し、残り件数を数えていないフォルダがある
+        """
+        self.done += self._processed
+        self.bytes += self._transferred
+        if self._started is not None:
+            self.seconds += time.monotonic() - self._started
+            self._started = None
+        if partial:
+            # 完了とはみなさず、残り件数は前回の値から今回の処理分を減らすだけにする
+            if self.remaining is not None:
+                self.remaining = max(self.remaining - self._processed, self._remaining)
+            else:
+                self.remaining = self._remaining
+        else:
+            self.remaining = self._remaining
+        if self.remaining <= 0 and not partial:
+            self.complete = True
+            logger.info(f"バックフィル完了: 合計 {self.done} 件 ({self.bytes // (1024 * 1024)} MB) を {format_duration(self.seconds)} で処理しました")
+        else:
+            eta = self.eta()
+            total = self.done + self.remaining
+            logger.info(
+                f"バックフィル進捗: {self.done}/{total} 件 ({self.done * 100 // max(total, 1)}%)"
+                + (f"、残り約 {format_duration(eta)}" if eta is not None else "")
+            )
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'done': self.done,
+                    'bytes': self.bytes,
+                    'seconds': self.seconds,
+                    'remaining': self.remaining,
+                    'complete': self.complete,
+                }, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"バックフィル進捗の保存に失敗しました: {e}")
+
+    def to_event(self, source: str) -> Dict[str, Any]:
+        """GUIへ通知するための進捗情報"""
+        return {
+            'action': 'backfill',
+            'source': source,
+            'done': self.done,
+            'total': self.done + (self.remaining or 0),
+            'eta': self.eta(),
+            'complete': self.complete,
+        }
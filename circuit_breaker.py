@@ -0,0 +1,169 @@
+"""
+取得元ごとのサーキットブレーカー（circuit_breaker を指定した場合のみ有効）
+
+サーバが停止している取得元に毎回接続を試みると、名前解決・接続・TLS のタイムアウトを
+待つ間に他の取得元の処理が遅れます。連続して失敗した取得元は一定時間スキップし、
+時間が経ったら1回だけ試行（半開状態）して、成功すれば通常どおりの処理に戻します。
+
+- 状態は closed（通常）/ open（スキップ中）/ half_open（試行中）
+- failure_threshold 回連続で失敗すると open になる
+- スキップする時間は base_delay 秒から開くたびに2倍にし、max_delay 秒を上限とする。
+  複数の取得元が同時に再試行しないよう、ランダムに最大 JITTER の割合だけ短くする
+- 状態は状態ディレクトリに保存し、実行・プロセスをまたいで引き継ぐ
+- 停止要求・処理時間の上限で打ち切られた試行は数えず、次の実行で再び試行する
+
+    circuit_breaker:
+      failure_threshold: 3   # open にするまでの連続失敗回数
+      base_delay: 300        # 最初にスキップする時間（秒）
+      max_delay: 21600       # スキップする時間の上限（秒）
+"""
+
+import os
+import json
+import time
+import random
+import logging
+from typing import Any, Dict, Optional
+from backfill import format_duration
+from config_model import BreakerConfig
+from journal import state_file_name
+from report import source_user
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """1つの取得元のサーキットブレーカー"""
+    # スキップする時間をランダムに短くする割合
+    JITTER = 0.2
+
+    def __init__(self, path: str, options: BreakerConfig, name: str = ''):
+        self.path = path
+        # ログに表示する取得元の名前
+        self.name = name
+        self.options = options
+        self.state = CLOSED
+        self.failures = 0
+        # open になった回数（半開状態での失敗も含む）。スキップする時間の計算に使う
+        self.trips = 0
+        self.retry_at: Optional[float] = None
+        self.probe_started: Optional[float] = None
+        self.last_error: Optional[str] = None
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.state = data.get('state', CLOSED)
+                self.failures = data.get('failures', 0)
+                self.trips = data.get('trips', 0)
+                self.retry_at = data.get('retry_at')
+                self.probe_started = data.get('probe_started')
+                self.last_error = data.get('last_error')
+            except (OSError, ValueError) as e:
+                logger.warning(f"サーキットブレーカーの状態の読み込みに失敗しました: {e}")
+
+    @classmethod
+    def load(cls, state_dir: Optional[str], source_config: Dict[str, Any],
+             options: Optional[BreakerConfig]) -> Optional['CircuitBreaker']:
+        """サーキットブレーカーが有効なら状態を読み込む"""
+        if not options or not state_dir:
+            return None
+        return cls(os.path.join(state_dir, state_file_name('breaker', source_config)), options,
+                   source_user(source_config))
+
+    @property
+    def tripped(self) -> bool:
+        """open または half_open（前回までに連続して失敗している）"""
+        return self.state != CLOSED
+
+    def allow(self) -> bool:
+        """
+        今回の実行で処理してよいかを返す。
+        スキップする時間が過ぎていれば half_open にして、1回だけの試行を許可する
+        """
+        if self.state == CLOSED:
+            return True
+        now = time.time()
+        if self.state == HALF_OPEN and self.probe_started is not None \
+                and now - self.probe_started < self.options.base_delay:
+            # 他の実行が試行中。結果が記録されないまま base_delay 秒経った試行は中断されたものとみなす
+            return False
+        if self.state == OPEN and self.retry_at is not None and now < self.retry_at:
+            return False
+        self.state = HALF_OPEN
+        self.probe_started = now
+        self.save()
+        return True
+
+    def record_success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        if self.tripped:
+            logger.info(f"{self.name}: 取得元が回復したため、サーキットブレーカーを閉じました")
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.retry_at = None
+        self.probe_started = None
+        self.last_error = None
+        self.save()
+
+    def record_failure(self, error: str):
+        self.failures += 1
+        self.last_error = error
+        self.probe_started = None
+        if self.state == HALF_OPEN or self.failures >= self.options.failure_threshold:
+            self.trips += 1
+            delay = min(self.options.base_delay * 2 ** (self.trips - 1), self.options.max_delay)
+            delay *= 1 - random.uniform(0, self.JITTER)
+            self.state = OPEN
+            self.retry_at = time.time() + delay
+            logger.warning(f"{self.name}: {self.failures} 回連続で失敗したため、約 {format_duration(delay)}間この取得元をスキップします")
+        self.save()
+
+    def record_interrupted(self):
+        """
+        停止要求・処理時間の上限で打ち切られた場合。成功とも失敗とも数えず、
+        試行中 (half_open) なら試行を取り消して次の実行で再び試行する
+        """
+        if self.state != HALF_OPEN:
+            return
+        self.state = OPEN
+        self.probe_started = None
+        self.save()
+
+    def skip_message(self) -> str:
+        """スキップした理由（レポートのエラーに記録する）"""
+        if self.state == HALF_OPEN:
+            return "サーキットブレーカーの試行中のためスキップしました"
+        retry = time.strftime('%H:%M:%S', time.localtime(self.retry_at)) if self.retry_at else '-'
+        return f"連続して失敗しているためスキップしました（次の試行: {retry}、直前のエラー: {self.last_error}）"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """レポート・制御API・GUIに渡す状態"""
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'retry_at': self.retry_at,
+            'last_error': self.last_error,
+        }
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'state': self.state,
+                    'failures': self.failures,
+                    'trips': self.trips,
+                    'retry_at': self.retry_at,
+                    'probe_started': self.probe_started,
+                    'last_error': self.last_error,
+                }, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"サーキットブレーカーの状態の保存に失敗しました: {e}")
@@ -0,0 +1,332 @@
+"""
+設定の型付きモデル
+
+YAML から読み込んだ辞書を、設定の読み込み時に1度だけ検証して
+__slots__ つきのオブジェクトに変換します。処理中は属性を参照するだけで、
+既定値つきの .get() を繰り返したり、処理の途中で設定の誤りに気付いたりしないようにします。
+
+- 不正な値は ConfigError（項目の位置を含むメッセージ）として報告する
+- 各モデルは元の辞書を raw に保持する。ジャーナルなどの状態ファイル名や
+  取得元のIDは、従来どおり元の辞書から求める
+"""
+
+import os
+from typing import Any, Dict, List, Optional
+from report import source_user
+
+SOURCE_PROTOCOLS = ('pop3', 'imap', 'maildir', 'mbox')
+# サーバではなくローカルのファイルから読み込む取得元
+LOCAL_PROTOCOLS = ('maildir', 'mbox')
+DESTINATION_TYPES = ('imap', 'maildir')
+
+
+class ConfigError(ValueError):
+    """設定ファイルの内容が不正"""
+
+
+def _mapping(value: Any, where: str) -> Dict[str, Any]:
+    if not isinstance(value, dict):
+        raise ConfigError(f"{where}: 項目の一覧（マッピング）で指定してください")
+    return value
+
+
+def _text(data: Dict[str, Any], key: str, where: str, default: Optional[str] = None, required: bool = False) -> Optional[str]:
+    value = data.get(key)
+    if value is None or value == '':
+        if required:
+            raise ConfigError(f"{where}.{key}: 必須の項目です")
+        return default
+    if not isinstance(value, str):
+        raise ConfigError(f"{where}.{key}: 文字列で指定してください")
+    return value
+
+
+def _flag(data: Dict[str, Any], key: str, where: str, default: bool) -> bool:
+    value = data.get(key)
+    if value is None:
+        return default
+    if not isinstance(value, bool):
+        raise ConfigError(f"{where}.{key}: true または false で指定してください")
+    return value
+
+
+def _number(data: Dict[str, Any], key: str, where: str, default: Any, minimum: float, integer: bool = True) -> Any:
+    value = data.get(key)
+    if value is None:
+        return default
+    if isinstance(value, str) and value.strip().isdigit():
+        # GUIや手書きの設定では数値が文字列になっていることがある
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or (integer and not isinstance(value, int)):
+        raise ConfigError(f"{where}.{key}: {'整数' if integer else '数値'}で指定してください")
+    if value < minimum:
+        raise ConfigError(f"{where}.{key}: {minimum} 以上で指定してください")
+    return value
+
+
+def _port(data: Dict[str, Any], where: str) -> int:
+    if data.get('port') is None:
+        raise ConfigError(f"{where}.port: 必須の項目です")
+    port = _number(data, 'port', where, None, 1)
+    if port > 65535:
+        raise ConfigError(f"{where}.port: 1～65535 で指定してください")
+    return port
+
+
+class BackfillConfig:
+    """取得元ごとの初回同期（backfill）の設定。0 の項目は上限なし"""
+    __slots__ = ('max_messages', 'max_bytes', 'max_seconds')
+    DEFAULT_MAX_MESSAGES = 500
+    DEFAULT_MAX_SECONDS = 300.0
+
+    def __init__(self, max_messages: int = DEFAULT_MAX_MESSAGES, max_bytes: Optional[int] = None,
+                 max_seconds: float = DEFAULT_MAX_SECONDS):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+
+    @classmethod
+    def from_dict(cls, data: Any, where: str = 'backfill') -> Optional['BackfillConfig']:
+        """backfill: true は既定値で有効にする。未指定・false なら None"""
+        if not data:
+            return None
+        data = {} if data is True else _mapping(data, where)
+        return cls(
+            max_messages=_number(data, 'max_messages', where, cls.DEFAULT_MAX_MESSAGES, 0),
+            max_bytes=_number(data, 'max_bytes', where, None, 0),
+            max_seconds=_number(data, 'max_seconds', where, cls.DEFAULT_MAX_SECONDS, 0, integer=False),
+        )
+
+
+class SourceConfig:
+    """取得元アカウントの設定"""
+    __slots__ = ('protocol', 'host', 'port', 'user', 'password', 'ssl', 'delete_after_move',
+                 'folder', 'folders', 'parallel_connections', 'compress', 'keep_alive', 'max_idle',
+                 'pipelining', 'path', 'time_budget', 'backfill', 'raw')
+
+    def __init__(self, **fields: Any):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], where: str = 'source') -> 'SourceConfig':
+        data = _mapping(data, where)
+        protocol = _text(data, 'protocol', where, required=True).lower()
+        if protocol not in SOURCE_PROTOCOLS:
+            raise ConfigError(f"{where}.protocol: 未対応のプロトコルです: {protocol}")
+        folders = data.get('folders')
+        if isinstance(folders, str):
+            folders = [folders]
+        if folders is not None and not (isinstance(folders, list) and all(isinstance(f, str) and f for f in folders)):
+            raise ConfigError(f"{where}.folders: フォルダ名（またはその一覧）で指定してください")
+        folder = _text(data, 'folder', where)
+        if protocol in LOCAL_PROTOCOLS:
+            return cls._local(protocol, data, where)
+        if data.get('password') is None:
+            raise ConfigError(f"{where}.password: 必須の項目です")
+        return cls(
+            protocol=protocol,
+            host=_text(data, 'host', where, required=True),
+            port=_port(data, where),
+            user=_text(data, 'user', where, required=True),
+            password=_text(data, 'password', where, ''),
+            ssl=_flag(data, 'ssl', where, True),
+            delete_after_move=_flag(data, 'delete_after_move', where, False),
+            # 処理するフォルダ（ワイルドカードを含むパターン可）。folder は最初に処理するフォルダ
+            folders=list(folders) if folders else [folder or 'INBOX'],
+            folder=folder or (folders[0] if folders else 'INBOX'),
+            parallel_connections=_number(data, 'parallel_connections', where, 1, 1),
+            compress=_flag(data, 'compress', where, True),
+            keep_alive=_flag(data, 'keep_alive', where, False),
+            max_idle=_number(data, 'max_idle', where, 600, 0, integer=False),
+            pipelining=_flag(data, 'pipelining', where, True),
+            time_budget=_number(data, 'time_budget', where, None, 1, integer=False),
+            backfill=BackfillConfig.from_dict(data.get('backfill'), f'{where}.backfill'),
+            raw=data,
+        )
+
+    @classmethod
+    def _local(cls, protocol: str, data: Dict[str, Any], where: str) -> 'SourceConfig':
+        """maildir / mbox の取得元。host などの代わりに path を指定する"""
+        path = os.path.expanduser(_text(data, 'path', where, required=True))
+        return cls(
+            protocol=protocol,
+            path=path,
+            host='',
+            port=0,
+            # ログや画面の表示名。省略時はファイル名（ディレクトリ名）
+            user=_text(data, 'user', where) or source_user(dict(data, path=path)),
+            password='',
+            ssl=False,
+            delete_after_move=_flag(data, 'delete_after_move', where, False),
+            folders=[None],
+            folder=None,
+            parallel_connections=1,
+            compress=False,
+            keep_alive=False,
+            max_idle=0,
+            pipelining=False,
+            time_budget=_number(data, 'time_budget', where, None, 1, integer=False),
+            backfill=BackfillConfig.from_dict(data.get('backfill'), f'{where}.backfill'),
+            raw=data,
+        )
+
+    def replace(self, **changes: Any) -> 'SourceConfig':
+        """一部の項目だけを変えた複製を返す"""
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return SourceConfig(**fields)
+
+
+class DestinationConfig:
+    """移動先アカウントの設定"""
+    __slots__ = ('type', 'host', 'port', 'user', 'password', 'ssl', 'folder', 'compress', 'required', 'apply_routing',
+                 'path', 'fsync_batch', 'raw')
+
+    def __init__(self, **fields: Any):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], where: str = 'destination') -> 'DestinationConfig':
+        data = _mapping(data, where)
+        kind = _text(data, 'type', where, 'imap').lower()
+        if kind not in DESTINATION_TYPES:
+            raise ConfigError(f"{where}.type: 未対応の移動先です: {kind}")
+        if kind == 'maildir':
+            return cls(
+                type=kind,
+                path=os.path.expanduser(_text(data, 'path', where, required=True)),
+                host='',
+                port=0,
+                user='',
+                password='',
+                ssl=False,
+                folder=_text(data, 'folder', where, 'INBOX'),
+                compress=False,
+                required=_flag(data, 'required', where, True),
+                apply_routing=_flag(data, 'apply_routing', where, True),
+                # fsync をまとめて行う件数
+                fsync_batch=_number(data, 'fsync_batch', where, 256, 1),
+                raw=data,
+            )
+        if data.get('password') is None:
+            raise ConfigError(f"{where}.password: 必須の項目です")
+        return cls(
+            type=kind,
+            host=_text(data, 'host', where, required=True),
+            port=_port(data, where),
+            user=_text(data, 'user', where, required=True),
+            password=_text(data, 'password', where, ''),
+            ssl=_flag(data, 'ssl', where, True),
+            folder=_text(data, 'folder', where, 'INBOX'),
+            compress=_flag(data, 'compress', where, True),
+            required=_flag(data, 'required', where, True),
+            apply_routing=_flag(data, 'apply_routing', where, True),
+            raw=data,
+        )
+
+
+class LaneConfig:
+    """サイズ別レーンの設定（lanes）"""
+    __slots__ = ('large_message_size', 'small_concurrency', 'large_concurrency')
+    DEFAULT_LARGE_MESSAGE_SIZE = 10 * 1024 * 1024
+
+    def __init__(self, large_message_size: int, small_concurrency: int, large_concurrency: int):
+        self.large_message_size = large_message_size
+        self.small_concurrency = small_concurrency
+        self.large_concurrency = large_concurrency
+
+    @classmethod
+    def from_dict(cls, data: Any, where: str = 'lanes') -> Optional['LaneConfig']:
+        """lanes: true は既定値で有効にする。未指定・false なら None"""
+        if not data:
+            return None
+        data = {} if data is True else _mapping(data, where)
+        return cls(
+            large_message_size=_number(data, 'large_message_size', where, cls.DEFAULT_LARGE_MESSAGE_SIZE, 1),
+            small_concurrency=_number(data, 'small_concurrency', where, 1, 1),
+            large_concurrency=_number(data, 'large_concurrency', where, 1, 1),
+        )
+
+
+class TimeoutConfig:
+    """POP3 / IMAP 接続のタイムアウト（timeouts）"""
+    __slots__ = ('connect', 'read')
+
+    def __init__(self, connect: float = 30.0, read: float = 120.0):
+        self.connect = connect
+        self.read = read
+
+    @classmethod
+    def from_dict(cls, data: Any, where: str = 'timeouts') -> 'TimeoutConfig':
+        if data is None:
+            return cls()
+        data = _mapping(data, where)
+        return cls(
+            connect=_number(data, 'connect', where, 30.0, 1, integer=False),
+            read=_number(data, 'read', where, 120.0, 1, integer=False),
+        )
+
+
+class BreakerConfig:
+    """取得元ごとのサーキットブレーカーの設定（circuit_breaker）"""
+    __slots__ = ('failure_threshold', 'base_delay', 'max_delay')
+
+    def __init__(self, failure_threshold: int = 3, base_delay: float = 300.0, max_delay: float = 21600.0):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def from_dict(cls, data: Any, where: str = 'circuit_breaker') -> Optional['BreakerConfig']:
+        """circuit_breaker: true は既定値で有効にする。未指定・false なら None"""
+        if not data:
+            return None
+        data = {} if data is True else _mapping(data, where)
+        base_delay = _number(data, 'base_delay', where, 300.0, 1, integer=False)
+        return cls(
+            failure_threshold=_number(data, 'failure_threshold', where, 3, 1),
+            base_delay=base_delay,
+            max_delay=max(_number(data, 'max_delay', where, 21600.0, 1, integer=False), base_delay),
+        )
+
+
+class RunConfig:
+    """一括処理 (run_batch) 1回分の取得元と移動先"""
+    __slots__ = ('sources', 'destinations', 'lanes', 'timeouts', 'breaker')
+
+    def __init__(self, sources: List[SourceConfig], destinations: List[DestinationConfig],
+                 lanes: Optional[LaneConfig] = None, timeouts: Optional[TimeoutConfig] = None,
+                 breaker: Optional[BreakerConfig] = None):
+        self.sources = sources
+        self.destinations = destinations
+        self.lanes = lanes
+        self.timeouts = timeouts or TimeoutConfig()
+        self.breaker = breaker
+
+    @classmethod
+    def from_dict(cls, config: Dict[str, Any]) -> 'RunConfig':
+        """
+        設定全体を検証して変換する。
+        移動先は destinations があれば優先し、なければ destination を使う
+        """
+        sources = config.get('sources') or []
+        if not isinstance(sources, list):
+            raise ConfigError("sources: 取得元の一覧で指定してください")
+        destinations = config.get('destinations')
+        if destinations:
+            if not isinstance(destinations, list):
+                raise ConfigError("destinations: 移動先の一覧で指定してください")
+            dest_configs = [DestinationConfig.from_dict(d, f"destinations[{i}]") for i, d in enumerate(destinations)]
+        elif config.get('destination'):
+            dest_configs = [DestinationConfig.from_dict(config['destination'])]
+        else:
+            raise ConfigError("移動先(destination)の設定が見つかりません")
+        return cls(
+            [SourceConfig.from_dict(s, f"sources[{i}]") for i, s in enumerate(sources)],
+            dest_configs,
+            LaneConfig.from_dict(config.get('lanes')),
+            TimeoutConfig.from_dict(config.get('timeouts')),
+            BreakerConfig.from_dict(config.get('circuit_breaker')),
+        )
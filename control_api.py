@@ -0,0 +1,318 @@
+"""
+ローカル制御API
+
+デーモンとGUIの両方で、127.0.0.1 上に HTTP+JSON の制御APIを提供します。
+ポート番号とアクセストークンは PID ファイルに書き込まれます（所有者のみ読み取り可）。
+リクエストには `Authorization: Bearer <token>` ヘッダ、または `?token=<token>` が必要です。
+
+    GET  /status                   実行状態と取得元ごとの状態
+    GET  /events                   進捗イベントのストリーム (Server-Sent Events)
+    POST /run                      今すぐ実行する
+    POST /sources/<id>/pause       取得元を一時停止する（次の実行から対象外）
+    POST /sources/<id>/resume      取得元の一時停止を解除する
+    POST /show                     GUIのウィンドウを表示する（GUIのみ）
+
+<id> は /status が返す取得元のID、またはユーザー名です。
+"""
+
+import hmac
+import json
+import queue
+import logging
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlsplit, parse_qs
+from report import RunReport, source_id, source_user
+
+logger = logging.getLogger(__name__)
+
+# SSE の接続を維持するためのコメントを送る間隔（秒）
+KEEPALIVE_SECONDS = 15
+# 読み出しが遅いクライアントのために保持するイベント数の上限
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+class ControlState:
+    """制御APIから参照・操作する実行状態"""
+
+    def __init__(self, mode: str, run_now: Callable[[], None],
+                 next_run: Optional[Callable[[], Optional[float]]] = None,
+                 show: Optional[Callable[[], None]] = None):
+        self.mode = mode
+        self._run_now = run_now
+        self._next_run = next_run
+        self._show = show
+        self._lock = threading.Lock()
+        self._sources: List[Dict[str, Any]] = []
+        self._states: Dict[str, Dict[str, Any]] = {}
+        self.paused: Set[str] = set()
+        self.running = False
+        self.last_run: Optional[Dict[str, Any]] = None
+        self._subscribers: List[queue.Queue] = []
+
+    # --- 実行側から呼び出す ---
+
+    def set_sources(self, sources: List[Dict[str, Any]]):
+        """設定されている取得元を反映する"""
+        with self._lock:
+            self._sources = [
+                {
+                    'id': source_id(source_config),
+                    'protocol': source_config.get('protocol', ''),
+                    'user': source_user(source_config),
+                    'host': source_config.get('host') or source_config.get('path', ''),
+                }
+                for source_config in sources or []
+            ]
+
+    def begin_run(self, config: Dict[str, Any]) -> Dict[str, Any]:
+        """実行の開始を記録し、一時停止中の取得元を除いた設定を返す"""
+        sources = config.get('sources', [])
+        self.set_sources(sources)
+        with self._lock:
+            self.running = True
+            paused = set(self.paused)
+            for state in self._states.values():
+                state.pop('state', None)
+        active = [s for s in sources if source_id(s) not in paused]
+        if len(active) < len(sources):
+            logger.info(f"一時停止中の取得元 {len(sources) - len(active)} 件をスキップします")
+        self.publish({'action': 'run', 'state': 'running'})
+        return dict(config, sources=active)
+
+    def end_run(self, report: RunReport):
+        """実行結果を記録する"""
+        with self._lock:
+            self.running = False
+            self.last_run = {
+                'started': report.started,
+                'finished': report.finished,
+                'total_moved': report.total_moved,
+                'total_errors': report.total_errors,
+            }
+            for entry in report.sources:
+                state = self._states.setdefault(entry['id'], {})
+                state['last'] = entry
+                if 'breaker' in entry:
+                    state['breaker'] = entry['breaker']
+        self.publish(dict(self.last_run, action='run', state='done'))
+
+    def callback(self, forward: Optional[Callable[[Dict[str, Any]], None]] = None) -> Callable[[Dict[str, Any]], None]:
+        """run_batch に渡す進捗コールバック。forward にも同じイベントを渡す"""
+        def on_event(data: Dict[str, Any]):
+            if data.get('action') == 'source':
+                with self._lock:
+                    state = self._states.setdefault(data['source_id'], {})
+                    state['state'] = data.get('state')
+                    if 'breaker' in data:
+                        state['breaker'] = data['breaker']
+            elif data.get('action') == 'backfill':
+                with self._lock:
+                    for source in self._sources:
+                        if source['user'] == data.get('source'):
+                            self._states.setdefault(source['id'], {})['backfill'] = data
+            self.publish(data)
+            if forward:
+                forward(data)
+        return on_event
+
+    # --- API から呼び出す ---
+
+    def resolve(self, key: str) -> Optional[str]:
+        """ID またはユーザー名から取得元のIDを求める"""
+        with self._lock:
+            for source in self._sources:
+                if source['id'] == key:
+                    return key
+            matches = [source['id'] for source in self._sources if source['user'] == key]
+        return matches[0] if len(matches) == 1 else None
+
+    def set_paused(self, key: str, paused: bool) -> Optional[str]:
+        sid = self.resolve(key)
+        if sid is None:
+            return None
+        with self._lock:
+            if paused:
+                self.paused.add(sid)
+            else:
+                self.paused.discard(sid)
+        logger.info(f"取得元 {key} の{'一時停止' if paused else '一時停止を解除'}を受け付けました")
+        self.publish({'action': 'pause' if paused else 'resume', 'source_id': sid})
+        return sid
+
+    def run_now(self):
+        self._run_now()
+
+    def show(self) -> bool:
+        if not self._show:
+            return False
+        self._show()
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        next_run = self._next_run() if self._next_run else None
+        with self._lock:
+            sources = []
+            for source in self._sources:
+                entry = dict(source)
+                state = self._states.get(source['id'], {})
+                entry['paused'] = source['id'] in self.paused
+                entry['state'] = 'paused' if entry['paused'] else (state.get('state') if self.running else None) or 'idle'
+                entry['last'] = state.get('last')
+                entry['backfill'] = state.get('backfill')
+                entry['breaker'] = state.get('breaker')
+                sources.append(entry)
+            return {
+                'mode': self.mode,
+                'running': self.running,
+                'next_run_in': next_run,
+                'last_run': self.last_run,
+                'sources': sources,
+            }
+
+    # --- イベント配信 ---
+
+    def subscribe(self) -> queue.Queue:
+        subscriber = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def publish(self, event: Optional[Dict[str, Any]]):
+        """購読中のクライアントへイベントを送る。None はストリームの終了を表す"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # 読み出しが追いつかないクライアントのイベントは捨てる
+                pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'MailConsolidator'
+
+    @property
+    def control(self) -> 'ControlServer':
+        return self.server.control
+
+    def log_message(self, format, *args):
+        logger.debug(f"制御API: {self.address_string()} {format % args}")
+
+    def _authorized(self, query: Dict[str, List[str]]) -> bool:
+        header = self.headers.get('Authorization', '')
+        token = header[7:] if header.startswith('Bearer ') else (query.get('token') or [''])[0]
+        return hmac.compare_digest(token.encode('utf-8'), self.control.token.encode('utf-8'))
+
+    def _send_json(self, status: int, body: Dict[str, Any]):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self) -> Optional[Tuple[str, List[str]]]:
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if not self._authorized(query):
+            self._send_json(401, {'error': 'unauthorized'})
+            return None
+        return url.path.rstrip('/') or '/', [part for part in url.path.split('/') if part]
+
+    def do_GET(self):
+        route = self._route()
+        if route is None:
+            return
+        path, _ = route
+        if path == '/status':
+            self._send_json(200, self.control.state.status())
+        elif path == '/events':
+            self._stream_events()
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        # 本文は使わないが、接続を正しく扱うために読み捨てる
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        route = self._route()
+        if route is None:
+            return
+        path, parts = route
+        state = self.control.state
+        if path == '/run':
+            state.run_now()
+            self._send_json(200, {'ok': True})
+        elif path == '/show':
+            if state.show():
+                self._send_json(200, {'ok': True})
+            else:
+                self._send_json(404, {'error': 'not available in this mode'})
+        elif len(parts) == 3 and parts[0] == 'sources' and parts[2] in ('pause', 'resume'):
+            sid = state.set_paused(parts[1], parts[2] == 'pause')
+            if sid is None:
+                self._send_json(404, {'error': 'unknown source'})
+            else:
+                self._send_json(200, {'ok': True, 'id': sid})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def _stream_events(self):
+        state = self.control.state
+        subscriber = state.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(f"event: status\ndata: {json.dumps(state.status(), ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            while True:
+                try:
+                    event = subscriber.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+                    continue
+                if event is None:
+                    break
+                data = json.dumps(event, ensure_ascii=False, default=str)
+                self.wfile.write(f"event: {event.get('action', 'message')}\ndata: {data}\n\n".encode('utf-8'))
+                self.wfile.flush()
+        except OSError:
+            # クライアントが切断した
+            pass
+        finally:
+            state.unsubscribe(subscriber)
+
+
+class ControlServer:
+    """制御APIのHTTPサーバ。バックグラウンドスレッドで動作する"""
+
+    def __init__(self, state: ControlState, port: int = 0):
+        self.state = state
+        self.token = secrets.token_urlsafe(24)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.control = self
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='control-api', daemon=True)
+        self.thread.start()
+        logger.info(f"制御APIを開始しました (http://127.0.0.1:{self.port})")
+
+    def stop(self):
+        # 接続中のイベントストリームを終了させる
+        self.state.publish(None)
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
@@ -1,122 +1,35 @@
 import logging
 import threading
-import email
 import os
-import tempfile
-import psutil
-import socket
+import re
+import time
+import queue
 from email.header import decode_header
-from typing import Dict, Any, Optional, Callable, Tuple
-from mail_client import Pop3Source, ImapSource, ImapDestination
+from email.parser import BytesHeaderParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Callable, Tuple
+from routing import RoutingRules
+from journal import SourceJournal, FETCHED, PARTIAL, APPENDED, ACKED
+from backfill import BackfillState
+from circuit_breaker import CircuitBreaker
+from folder_state import FolderState
+from ratelimit import configure_rate_limits
+from report import RunReport, SourceMetrics, source_id
+from logging_setup import ProgressLog
+from config_model import RunConfig, SourceConfig, DestinationConfig, LOCAL_PROTOCOLS
+from mail_client import Pop3Source, ImapSource, ImapDestination, ImapConnectionPool, ShardedImapFetcher, MessageRecord, set_timeouts
 
-logger = logging.getLogger(__name__)
-
-PID_FILE = os.path.join(tempfile.gettempdir(), 'mailconsolidator.pid')
-
-def get_default_config_path() -> str:
-    """
-    プラットフォームに応じた適切な設定ファイルパスを返す
-    
-    Windows: %APPDATA%\MailConsolidator\config.yaml
-    Unix系: ~/.config/MailConsolidator/config.yaml
-    """
-    if os.name == 'nt':  # Windows
-        appdata = os.environ.get('APPDATA')
-        if appdata:
-            config_dir = os.path.join(appdata, 'MailConsolidator')
-        else:
-            # APPDATAが取得できない場合のフォールバック
-            config_dir = os.path.join(os.path.expanduser('~'), 'MailConsolidator')
-    else:  # Unix系
-        config_dir = os.path.join(os.path.expanduser('~'), '.config', 'MailConsolidator')
-    
-    # ディレクトリが存在しない場合は作成
-    os.makedirs(config_dir, exist_ok=True)
-    
-    return os.path.join(config_dir, 'config.yaml')
-
-def migrate_config_if_needed():
-    """
-    起動フォルダに古い設定ファイルがある場合、新しい場所にコピーする
-    既に新しい場所に設定ファイルがある場合は何もしない
-    """
-    old_config_path = 'config.yaml'
-    new_config_path = get_default_config_path()
-    
-    # 新しい場所に既に設定ファイルがある場合は何もしない
-    if os.path.exists(new_config_path):
-        return
-    
-    # 古い場所に設定ファイルがある場合はコピー
-    if os.path.exists(old_config_path):
-        try:
-            import shutil
-            shutil.copy2(old_config_path, new_config_path)
-            logger.info(f"設定ファイルを移行しました: {old_config_path} -> {new_config_path}")
-        except Exception as e:
-            logger.warning(f"設定ファイルの移行に失敗しました: {e}")
-
-
-class PIDManager:
-    @staticmethod
-    def write_pid(port: int = 0):
-        """PIDとポート番号をファイルに書き込む"""
-        try:
-            with open(PID_FILE, 'w') as f:
-                f.write(f"{os.getpid()}:{port}")
-            logger.info(f"PIDファイルを作成しました: {PID_FILE} (Port: {port})")
-        except Exception as e:
-            logger.error(f"PIDファイルの作成に失敗しました: {e}")
+from instance import get_default_config_path
 
-    @staticmethod
-    def read_pid_info() -> Tuple[Optional[int], Optional[int]]:
-        """PIDファイルから (pid, port) を読み込む"""
-        try:
-            if os.path.exists(PID_FILE):
-                with open(PID_FILE, 'r') as f:
-                    content = f.read().strip()
-                    if ':' in content:
-                        pid, port = content.split(':')
-                        return int(pid), int(port)
-                    else:
-                        return int(content), 0
-        except Exception as e:
-            logger.error(f"PIDファイルの読み込みに失敗しました: {e}")
-        return None, None
-
-    @staticmethod
-    def remove_pid():
-        """PIDファイルを削除する"""
-        try:
-            if os.path.exists(PID_FILE):
-                os.remove(PID_FILE)
-                logger.info(f"PIDファイルを削除しました: {PID_FILE}")
-        except Exception as e:
-            logger.error(f"PIDファイルの削除に失敗しました: {e}")
+logger = logging.getLogger(__name__)
 
-    @staticmethod
-    def is_process_running(pid):
-        """指定されたPIDのプロセスが実行中かチェック"""
-        try:
-            process = psutil.Process(pid)
-            return process.is_running()
-        except (psutil.NoSuchProcess, psutil.AccessDenied):
-            return False
+# keep_alive が有効なIMAP取得元のセッションを実行サイクル間で保持する
+_imap_pool = ImapConnectionPool()
 
-    @staticmethod
-    def send_show_command(port):
-        """指定されたポートにSHOWコマンドを送信する"""
-        if port <= 0:
-            return False
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(1)
-                s.connect(('127.0.0.1', port))
-                s.sendall(b'SHOW_WINDOW')
-                return True
-        except Exception as e:
-            logger.error(f"IPC通信エラー: {e}")
-            return False
+# 本文は解析せず、ヘッダだけを1回で取り出す
+_header_parser = BytesHeaderParser()
+# ヘッダと本文の区切り（空行）
+_HEADER_END_RE = re.compile(rb'\r?\n\r?\n')
 
 def decode_str(s):
     """メールヘッダのデコード処理"""
@@ -139,91 +52,866 @@ def decode_str(s):
         return result
     return ""
 
-def run_batch(config: Dict[str, Any], stop_event: Optional[threading.Event] = None, callback: Optional[Callable] = None) -> str:
+def close_connection_pool():
+    """保持中のIMAP取得元セッションをすべて切断する（終了時に呼び出す）"""
+    _imap_pool.close_all()
+
+def get_state_dir(config: Dict[str, Any]) -> str:
+    """ジャーナルなどの状態ファイルを保存するディレクトリを返す"""
+    state_dir = config.get('state_dir') or os.path.join(os.path.dirname(get_default_config_path()), 'state')
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+def _open_destination(dest_config: DestinationConfig):
+    """設定の type に応じた移動先を作成する"""
+    if dest_config.type == 'maildir':
+        from local_mail import MaildirDestination
+        return MaildirDestination(dest_config)
+    return ImapDestination(dest_config)
+
+class DestinationSet:
+    """
+    複数の移動先へ同じメッセージを並行して保存する。
+    取得元の削除・既読化は、必須(required)の移動先すべてが保存を確認した場合のみ行う。
+    """
+    def __init__(self, dest_configs: List[DestinationConfig]):
+        self.entries = [(_open_destination(c), c.required, c.apply_routing) for c in dest_configs]
+        self.executor = None
+
+    @property
+    def batched(self) -> bool:
+        """保存を flush() でまとめて確定する移動先を含むか"""
+        return any(destination.BATCHED for destination, _, _ in self.entries)
+
+    def flush_due(self) -> bool:
+        return any(destination.flush_due() for destination, _, _ in self.entries)
+
+    def flush(self) -> bool:
+        """
+        まとめて書き込んでいる移動先の保存を確定する
+        戻り値: 必須の移動先すべてで確定できた場合 True
+        """
+        confirmed = True
+        for destination, required, _ in self.entries:
+            try:
+                ok = destination.flush()
+            except Exception as e:
+                logger.error(f"移動先への保存の確定でエラーが発生しました ({destination.host}): {e}")
+                ok = False
+            if not ok and required:
+                confirmed = False
+        return confirmed
+
+    def connect(self):
+        connected = []
+        for destination, required, apply_routing in self.entries:
+            try:
+                destination.connect()
+                connected.append((destination, required, apply_routing))
+            except Exception as e:
+                if required:
+                    logger.error(f"移動先サーバへの接続に失敗しました ({destination.host}): {e}")
+                    for other, _, _ in connected:
+                        other.disconnect()
+                    raise e
+                logger.warning(f"任意の移動先に接続できないため、今回はスキップします ({destination.host}): {e}")
+        self.entries = connected
+        if not self.entries:
+            raise ConnectionError("接続できる移動先がありません")
+        if len(self.entries) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.entries), thread_name_prefix='destination')
+
+    def disconnect(self):
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        for destination, _, _ in self.entries:
+            try:
+                destination.disconnect()
+            except Exception as e:
+                logger.warning(f"移動先の切断に失敗しました ({destination.host}): {e}")
+
+    def server_side_target(self, source) -> Optional[Tuple[ImapDestination, bool]]:
+        """
+        移動先が取得元と同じIMAPアカウント1つだけの場合、(移動先, apply_routing) を返す。
+        この場合はメッセージをダウンロードせず、サーバ内でコピー・移動できる。
+        """
+        if len(self.entries) != 1 or not isinstance(source, ImapSource):
+            return None
+        destination, _, apply_routing = self.entries[0]
+        return (destination, apply_routing) if source.same_account(destination) else None
+
+    def account_folders(self, source, routing: Optional[RoutingRules] = None) -> set:
+        """
+        取得元と同じアカウントの移動先が保存に使うフォルダを返す。
+        これらのフォルダを取得元として処理すると、保存したメッセージを再び移動してしまう。
+        """
+        folders = set()
+        for destination, _, apply_routing in self.entries:
+            if isinstance(source, ImapSource) and source.same_account(destination):
+                folders.add(destination.folder)
+                if routing and apply_routing:
+                    folders.update(rule.folder for rule in routing.rules)
+        return folders
+
+    def append_message(self, message_bytes: bytes, folder: Optional[str] = None, stored: Optional[set] = None) -> bool:
+        """
+        同じバイト列をすべての移動先へ保存する。
+        stored を渡した場合、含まれている移動先はスキップし、保存できた移動先を追加する。
+        戻り値: 必須の移動先すべてで保存に成功した場合 True
+        """
+        stored = stored if stored is not None else set()
+        targets = [entry for entry in self.entries if entry[0].identity not in stored]
+
+        if len(targets) == 1 or not self.executor:
+            results = [
+                (destination, required, destination.append_message(message_bytes, folder if apply_routing else None))
+                for destination, required, apply_routing in targets
+            ]
+        else:
+            futures = [
+                (destination, required, self.executor.submit(destination.append_message, message_bytes, folder if apply_routing else None))
+                for destination, required, apply_routing in targets
+            ]
+            results = []
+            for destination, required, future in futures:
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    logger.error(f"移動先への保存でエラーが発生しました ({destination.host}): {e}")
+                    ok = False
+                results.append((destination, required, ok))
+
+        confirmed = True
+        for destination, required, ok in results:
+            if ok:
+                stored.add(destination.identity)
+            elif required:
+                confirmed = False
+            else:
+                logger.warning(f"任意の移動先への保存に失敗しました ({destination.host})")
+        return confirmed
+
+def run_batch(config: Dict[str, Any], stop_event: Optional[threading.Event] = None, callback: Optional[Callable] = None, report: Optional[RunReport] = None) -> str:
     """
     設定に基づいて一括処理を実行する
+    report を渡すと取得元ごとの結果を記録する
     戻り値: 実行結果のサマリ文字列
     """
-    # 移動先の設定
-    dest_config = config.get('destination')
-    if not dest_config:
-        raise ValueError("移動先(destination)の設定が見つかりません")
+    if report is None:
+        report = RunReport()
+    # 取得元・移動先の設定を検証して型付きの設定にする（不正な設定は ConfigError）
+    run_config = RunConfig.from_dict(config)
 
-    destination = ImapDestination(dest_config)
-    
-    try:
-        destination.connect()
-    except Exception as e:
-        logger.error(f"移動先サーバへの接続に失敗しました: {e}")
-        raise e
+    # アイドル上限を超えたプール済みセッションを先に整理
+    _imap_pool.evict_idle()
 
-    total_moved = 0
-    total_errors = 0
-    
+    # 振り分けルールは実行ごとに一度だけコンパイルする（不正な設定はここで検出）
+    routing = RoutingRules.from_config(config)
+    configure_rate_limits(config.get('rate_limits'))
+    set_timeouts(run_config.timeouts.connect, run_config.timeouts.read)
+
+    state_dir = get_state_dir(config)
+
+    destinations = DestinationSet(run_config.destinations)
+    destinations.connect()
+
+    def begin(job: _SourceJob) -> bool:
+        """取得元の処理を始める。サーキットブレーカーが開いていればスキップを記録して False を返す"""
+        job.started = time.monotonic()
+        job.breaker = CircuitBreaker.load(state_dir, job.source_config.raw, run_config.breaker)
+        if job.breaker and not job.breaker.allow():
+            error = job.breaker.skip_message()
+            logger.info(f"{job.source_config.user}: {error}")
+            breaker = job.breaker.to_dict()
+            report.add_source(job.source_config.raw, error=error, skipped=True, breaker=breaker)
+            if callback:
+                callback(dict(job.event, state='skipped', error=error, breaker=breaker))
+            return False
+        if callback:
+            callback(dict(job.event, state='running'))
+        return True
+
+    def finish(job: _SourceJob, error: Optional[str] = None):
+        extra = job.metrics.to_dict()
+        if job.breaker:
+            if not error:
+                job.breaker.record_success()
+            extra['breaker'] = job.breaker.to_dict()
+        report.add_source(job.source_config.raw, moved=job.moved, seconds=time.monotonic() - job.started,
+                          error=error, **extra)
+        if callback:
+            event = dict(job.event, breaker=extra['breaker']) if job.breaker else job.event
+            callback(dict(event, state='error', error=error) if error else dict(event, state='done', moved=job.moved))
+
+    def run_pass(job: _SourceJob, lane_destinations: DestinationSet, lane: Optional[SizeLane] = None) -> bool:
+        """取得元を1回処理する。失敗した場合は結果を記録して False を返す"""
+        try:
+            job.moved += process_source(job.source_config, lane_destinations, stop_event, callback, routing, state_dir, job.metrics, lane)
+            return True
+        except Exception as e:
+            logger.error(f"ソース処理エラー: {e}")
+            if job.breaker:
+                # 停止要求・処理時間の上限で打ち切った場合は取得元の障害として数えない
+                if isinstance(e, SourceAborted) or (stop_event and stop_event.is_set()):
+                    job.breaker.record_interrupted()
+                else:
+                    job.breaker.record_failure(str(e))
+            finish(job, str(e))
+            return False
+
+    lanes = None
     try:
         # 各ソースアカウントを処理
-        sources = config.get('sources', [])
+        sources = run_config.sources
+        # バックフィル中の取得元と、連続して失敗している取得元（サーキットブレーカーの試行）は
+        # 通常の取得元の後に回し、正常な取得元の新着メールの移動を遅らせない
+        sources = sorted(sources, key=lambda s: (_is_tripped(s, state_dir, run_config), _is_backfilling(s, state_dir)))
+        if run_config.lanes:
+            lanes = _start_lanes(run_config, destinations, begin, finish, run_pass, stop_event)
         for source_config in sources:
             if stop_event and stop_event.is_set():
                 logger.info("停止シグナルを検知しました。処理を中断します。")
                 break
-                
-            try:
-                moved = process_source(source_config, destination, stop_event, callback)
-                total_moved += moved
-            except Exception as e:
-                logger.error(f"ソース処理エラー: {e}")
-                total_errors += 1
+            job = _SourceJob(source_config)
+            if lanes:
+                lanes[0].submit(job)
+                continue
+            if begin(job) and run_pass(job, destinations):
+                finish(job)
             
     finally:
-        destination.disconnect()
+        if lanes:
+            # 小さいメッセージのレーンから大きいメッセージのレーンへ仕事が渡されるため、この順に待つ
+            for lane_threads in lanes:
+                lane_threads.join()
+        destinations.disconnect()
+        report.interrupted = bool(stop_event and stop_event.is_set())
+        report.finish()
         
-    return f"処理完了: 合計 {total_moved} 通移動しました (エラー: {total_errors} 件)"
+    return report.summary()
+
+class _SourceJob:
+    """1つの取得元の処理状況（サイズ別レーンの間で受け渡す）"""
+    __slots__ = ('source_config', 'event', 'metrics', 'moved', 'started', 'breaker')
+
+    def __init__(self, source_config: SourceConfig):
+        self.source_config = source_config
+        self.event = {'action': 'source', 'source_id': source_id(source_config.raw), 'source': source_config.user}
+        self.metrics = SourceMetrics()
+        self.moved = 0
+        self.started = time.monotonic()
+        self.breaker: Optional[CircuitBreaker] = None
+
+class SizeLane:
+    """
+    メッセージをサイズで分けて処理するレーン。
+    large=False のレーンは limit 以下、large=True のレーンは limit を超えるメッセージだけを処理する
+    """
+    __slots__ = ('name', 'limit', 'large')
+
+    def __init__(self, name: str, limit: int, large: bool):
+        self.name = name
+        self.limit = limit
+        self.large = large
+
+    def accepts(self, size: int) -> bool:
+        return (size > self.limit) == self.large
+
+class _LaneThreads:
+    """
+    1つのレーンを処理するスレッド群。
+    各スレッドは最初の仕事を受け取った時点で自分の移動先に接続し、投入された取得元を順に処理する。
+    destinations を渡した場合は1本目のスレッドがその接続を使う（切断は呼び出し側が行う）
+    """
+    def __init__(self, lane: SizeLane, concurrency: int, dest_configs: List[DestinationConfig],
+                 handler: Callable[[_SourceJob, Optional[DestinationSet], Optional[Exception]], None],
+                 destinations: Optional[DestinationSet] = None):
+        self.lane = lane
+        self._jobs: queue.Queue = queue.Queue()
+        self._dest_configs = dest_configs
+        self._handler = handler
+        self._threads = []
+        for index in range(concurrency):
+            thread = threading.Thread(target=self._run, args=(destinations if index == 0 else None,),
+                                      name=f"lane-{lane.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job: _SourceJob):
+        self._jobs.put(job)
+
+    def join(self):
+        """投入済みの仕事がすべて終わるまで待ち、スレッドを終了させる"""
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, destinations: Optional[DestinationSet]):
+        owned = destinations is None
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    return
+                error = None
+                if destinations is None:
+                    try:
+                        destinations = DestinationSet(self._dest_configs)
+                        destinations.connect()
+                    except Exception as e:
+                        destinations, error = None, e
+                try:
+                    self._handler(job, destinations, error)
+                except Exception as e:
+                    logger.error(f"レーン {self.lane.name} の処理中にエラーが発生しました: {e}")
+        finally:
+            if owned and destinations:
+                destinations.disconnect()
+
+def _start_lanes(run_config: RunConfig, destinations: DestinationSet, begin: Callable, finish: Callable,
+                 run_pass: Callable, stop_event: Optional[threading.Event]) -> Tuple[_LaneThreads, _LaneThreads]:
+    """
+    サイズ別レーンを起動する。
+    取得元はまず小さいメッセージのレーンで処理し、大きいメッセージが残っていれば
+    大きいメッセージのレーンに渡す。大きいメッセージの転送中も、他の取得元の小さいメッセージは
+    小さいメッセージのレーンで処理が進む。
+    """
+    config = run_config.lanes
+    small = SizeLane('small', config.large_message_size, large=False)
+    large = SizeLane('large', config.large_message_size, large=True)
+
+    def stopped() -> bool:
+        return bool(stop_event and stop_event.is_set())
+
+    def run_small(job: _SourceJob, lane_destinations: Optional[DestinationSet], error: Optional[Exception]):
+        if stopped() or not begin(job):
+            return
+        if error:
+            finish(job, f"移動先サーバへの接続に失敗しました: {error}")
+            return
+        if not run_pass(job, lane_destinations, small):
+            return
+        if job.metrics.deferred and not stopped():
+            large_threads.submit(job)
+        else:
+            finish(job)
+
+    def run_large(job: _SourceJob, lane_destinations: Optional[DestinationSet], error: Optional[Exception]):
+        if error:
+            finish(job, f"移動先サーバへの接続に失敗しました: {error}")
+        elif stopped() or run_pass(job, lane_destinations, large):
+            finish(job)
+
+    large_threads = _LaneThreads(large, config.large_concurrency, run_config.destinations, run_large)
+    small_threads = _LaneThreads(small, config.small_concurrency, run_config.destinations, run_small, destinations)
+    logger.info(
+        f"サイズ別レーンを使用します ({config.large_message_size} バイト超は大きいメッセージのレーン、"
+        f"並列数 {config.small_concurrency} / {config.large_concurrency})"
+    )
+    return small_threads, large_threads
+
+class SourceAborted(TimeoutError):
+    """処理時間の上限・停止要求により SourceWatchdog が処理を打ち切った"""
+
+class SourceWatchdog:
+    """
+    取得元1つの処理を別スレッドで監視する。
+    処理時間の上限 (time_budget) を超えた場合と、停止要求から STOP_GRACE 秒経っても
+    処理が終わらない場合に source.abort() で通信中の読み書きを打ち切る。
+    上限の手前（上限の1/4、最大 SOFT_RESERVE 秒）からは新しいメッセージの処理を始めず、
+    残りの時間で切断する
+    """
+    POLL_INTERVAL = 0.5
+    STOP_GRACE = 2.0
+    SOFT_RESERVE = 30.0
 
-def process_source(source_config: Dict[str, Any], destination: ImapDestination, stop_event: Optional[threading.Event] = None, callback: Optional[Callable] = None) -> int:
+    def __init__(self, source, budget: Optional[float], stop_event: Optional[threading.Event]):
+        self.source = source
+        self.budget = budget
+        self.stop_event = stop_event
+        # 打ち切った理由（打ち切っていなければ None）
+        self.reason: Optional[str] = None
+        started = time.monotonic()
+        self.deadline = started + budget if budget else None
+        self.soft_deadline = self.deadline - min(budget / 4, self.SOFT_RESERVE) if budget else None
+        self._done = threading.Event()
+        # source 以外に打ち切る接続（並列取得の各接続）
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.deadline is None and self.stop_event is None:
+            return
+        threading.Thread(target=self._run, name='source-watchdog', daemon=True).start()
+
+    def cancel(self):
+        self._done.set()
+
+    def attach(self, session):
+        """source 以外の接続も打ち切りの対象にする。すでに打ち切った後なら直ちに打ち切る"""
+        with self._lock:
+            if self.reason is None:
+                self._sessions.append(session)
+                return
+        session.abort()
+
+    def detach(self, session):
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+
+    def out_of_time(self) -> bool:
+        return self.soft_deadline is not None and time.monotonic() >= self.soft_deadline
+
+    def error(self) -> Exception:
+        return SourceAborted(self.reason)
+
+    def _run(self):
+        stop_seen = None
+        while True:
+            interval = self.POLL_INTERVAL
+            if self.deadline is not None:
+                interval = max(0.0, min(interval, self.deadline - time.monotonic()))
+            if self._done.wait(interval):
+                return
+            now = time.monotonic()
+            if self.deadline is not None and now >= self.deadline:
+                self._abort(f"処理時間の上限 ({self.budget:g}秒) を超えたため、通信を打ち切りました")
+                return
+            if self.stop_event is not None and self.stop_event.is_set():
+                if stop_seen is None:
+                    stop_seen = now
+                elif now - stop_seen >= self.STOP_GRACE:
+                    self._abort("停止要求を受けたため、通信を打ち切りました")
+                    return
+
+    def _abort(self, reason: str):
+        with self._lock:
+            self.reason = reason
+            sessions = list(self._sessions)
+        logger.warning(f"{self.source.user}: {reason}")
+        self.source.abort()
+        for session in sessions:
+            session.abort()
+
+def _read_headers(record: MessageRecord, display: bool):
+    """振り分けと画面表示に使うヘッダ項目を取り出す（本文は解析しない）"""
+    # 本文が memoryview の場合もあるため、ヘッダ部分だけを bytes にして解析する
+    match = _HEADER_END_RE.search(record.body)
+    record.headers = _header_parser.parsebytes(bytes(record.body[:match.end()] if match else record.body))
+    record.subject = decode_str(record.headers.get('Subject'))
+    if display:
+        record.sender = decode_str(record.headers.get('From'))
+        record.date = record.headers.get('Date')
+
+def _is_backfilling(source_config: SourceConfig, state_dir: Optional[str]) -> bool:
+    backfill = BackfillState.load(state_dir, source_config.raw, source_config.backfill)
+    return bool(backfill and backfill.active)
+
+def _is_tripped(source_config: SourceConfig, state_dir: Optional[str], run_config: RunConfig) -> bool:
+    breaker = CircuitBreaker.load(state_dir, source_config.raw, run_config.breaker)
+    return bool(breaker and breaker.tripped)
+
+def acknowledge_message(source, msg_id) -> bool:
+    """
+    保存済みメッセージを取得元で後処理する（削除、またはIMAP・ローカルの取得元なら既読化）。
+    戻り値: 後処理が完了した場合 True
+    """
+    if source.delete_after_move:
+        source.delete_message(msg_id)
+    elif source.MARKS_READ:
+        source.mark_as_read(msg_id)
+    return True
+
+def _recover_from_journal(source, journal: SourceJournal, message_ids: list, acked: Callable) -> list:
+    """
+    前回中断された処理の後始末を行う。
+    保存済み (appended) のメッセージは再取得・再保存せず、取得元での後処理だけ行う。
+    戻り値: 今回ダウンロードが必要なメッセージIDの一覧
+    """
+    recovered = set()
+    for key in journal.keys_in(APPENDED):
+        msg_id = source.find_message(key)
+        if msg_id is None:
+            # 既に取得元に存在しない（前回の後処理が完了していた）
+            journal.record(key, ACKED)
+            continue
+        try:
+            acknowledge_message(source, msg_id)
+            acked(key, msg_id)
+            recovered.add(msg_id)
+        except Exception as e:
+            logger.error(f"中断されたメッセージの後処理に失敗しました (ID: {msg_id}): {e}")
+            recovered.add(msg_id)
+    if recovered:
+        logger.info(f"前回中断された {len(recovered)} 件のメッセージの後処理を行いました")
+
+    unconfirmed = journal.keys_in(FETCHED)
+    if unconfirmed:
+        logger.warning(f"保存が確認できていないメッセージが {len(unconfirmed)} 件あります。再度移動します（重複する可能性があります）")
+    return [msg_id for msg_id in message_ids if msg_id not in recovered]
+
+def _transfer_on_server(source: ImapSource, destination: ImapDestination, apply_routing: bool, message_ids: list, routing: Optional[RoutingRules], journal: Optional[SourceJournal], acked: Callable, stop_event: Optional[threading.Event] = None) -> int:
+    """
+    取得元と移動先が同じアカウントの場合に、本文を転送せずサーバ内でフォルダ間を移動する。
+    振り分けルールがある場合はヘッダだけを取得して保存先ごとにまとめる。
+    戻り値: 移動したメッセージ数
+    """
+    groups: Dict[str, List[str]] = {}
+    if routing and apply_routing:
+        for uid, size, header in source.iter_headers(message_ids):
+            msg_obj = _header_parser.parsebytes(header)
+            folder = routing.match(source.user, msg_obj, decode_str(msg_obj.get('Subject')), size)
+            groups.setdefault(folder or destination.folder, []).append(uid)
+    else:
+        groups[destination.folder] = list(message_ids)
+
+    moved_count = 0
+    for folder, uids in groups.items():
+        if stop_event and stop_event.is_set():
+            logger.info("停止シグナルを検知しました。メッセージ移動を中断します。")
+            break
+        if folder == source.folder:
+            logger.warning(f"保存先が取得元と同じフォルダのため移動しません ({folder}: {len(uids)} 件)")
+            continue
+        destination.ensure_folder(folder)
+        keys = [source.message_key(uid) for uid in uids] if journal else []
+
+        def copied():
+            # COPYの後、削除・既読化の前に中断された場合は次回に後処理だけ行う
+            for key in keys:
+                journal.record(key, APPENDED, folder=folder)
+
+        if source.transfer_messages(uids, folder, source.delete_after_move, copied):
+            for key, uid in zip(keys, uids):
+                acked(key, uid)
+            moved_count += len(uids)
+    return moved_count
+
+def process_source(source_config: SourceConfig, destination: DestinationSet, stop_event: Optional[threading.Event] = None, callback: Optional[Callable] = None, routing: Optional[RoutingRules] = None, state_dir: Optional[str] = None, metrics: Optional[SourceMetrics] = None, lane: Optional[SizeLane] = None) -> int:
     """
-    1つのソースアカウントを処理する
+    1つのソースアカウントを処理する。
+    IMAPで複数のフォルダが指定されている場合は、1つのセッションで順に処理する。
+    metrics を渡すと転送量と処理段階ごとの所要時間を記録する
+    lane を渡すと、そのレーンが受け持つサイズのメッセージだけを処理する
     戻り値: 移動したメッセージ数
     """
-    protocol = source_config.get('protocol', '').lower()
-    host = source_config.get('host')
-    user = source_config.get('user')
+    if metrics is None:
+        metrics = SourceMetrics()
+    if isinstance(source_config, dict):
+        source_config = SourceConfig.from_dict(source_config)
+    protocol = source_config.protocol
+    user = source_config.user
     
-    logger.info(f"--- アカウント処理開始: {user} ({protocol}://{host}) ---")
+    logger.info(f"--- アカウント処理開始: {user} ({protocol}://{source_config.host or source_config.path}) ---")
 
-    source = None
     if protocol == 'pop3':
         source = Pop3Source(source_config)
-    elif protocol == 'imap':
-        source = ImapSource(source_config)
+    elif protocol in LOCAL_PROTOCOLS:
+        from local_mail import LOCAL_SOURCES
+        source = LOCAL_SOURCES[protocol](source_config, state_dir)
     else:
-        logger.error(f"未対応のプロトコルです: {protocol}")
-        return 0
+        source = ImapSource(source_config, pool=_imap_pool)
 
     moved_count = 0
+    watchdog = SourceWatchdog(source, source_config.time_budget, stop_event)
+    backfill = BackfillState.load(state_dir, source_config.raw, source_config.backfill)
+    if backfill and not backfill.active:
+        backfill = None
+    journals = []
+    # POP3の削除はQUITで確定するため、切断に成功してから完了を記録する
+    uncommitted = []
+
+    failed = False
+    # 停止・処理時間の上限・フォルダ単位のエラーで、処理しきれなかったフォルダがある
+    partial = False
+    watchdog.start()
     try:
-        source.connect()
-        messages = source.get_messages()
+        with metrics.phase('connect'):
+            if isinstance(source, ImapSource):
+                # SELECT はフォルダごとに必要になった時点で行う
+                source.connect(select=False)
+                folders = source.resolve_folders(destination.account_folders(source, routing))
+            else:
+                source.connect()
+                folders = [None]
+        if watchdog.reason:
+            raise watchdog.error()
+        if backfill:
+            backfill.begin()
+
+        for folder in folders:
+            if stop_event and stop_event.is_set():
+                logger.info("停止シグナルを検知しました。処理を中断します。")
+                partial = True
+                break
+            if watchdog.out_of_time():
+                logger.info("処理時間の上限に近づいたため、残りのフォルダは次回以降に処理します")
+                partial = True
+                break
+            if len(folders) > 1:
+                logger.info(f"フォルダ {folder} を処理します")
+            journal = SourceJournal.open(state_dir, source_config.raw, folder) if state_dir else None
+            if journal:
+                journals.append(journal)
+            try:
+                moved_count += _process_folder(source, source_config, folder, destination, journal, uncommitted,
+                                               backfill, stop_event, callback, routing, state_dir, metrics, lane, watchdog)
+            except Exception as e:
+                # フォルダ単位のエラーなら残りのフォルダの処理を続ける
+                if len(folders) == 1 or not isinstance(source, ImapSource) or ImapSource.is_session_error(e):
+                    raise
+                logger.error(f"フォルダ {folder} の処理中にエラーが発生しました: {e}")
+                partial = True
+
+    except Exception as e:
+        failed = True
+        if watchdog.reason:
+            # 打ち切りによる通信エラーは、打ち切った理由として報告する
+            e = watchdog.error()
+        logger.error(f"処理中にエラーが発生しました: {e}")
+        # 状態が不明なセッションはプールに戻さない
+        if isinstance(source, ImapSource):
+            source.invalidate()
+        raise e
+    finally:
+        try:
+            try:
+                # POP3 では QUIT で削除が確定するため、削除が多いとここに時間がかかる
+                with metrics.phase('disconnect'):
+                    source.disconnect()
+            except Exception as e:
+                if watchdog.reason:
+                    raise watchdog.error() from e
+                if not failed:
+                    raise
+                # 処理中のエラーを優先して報告する（切断できなかったため削除は確定していない）
+                logger.warning(f"切断時にエラーが発生しました: {e}")
+            else:
+                # 打ち切った場合は QUIT を送っていないため、削除は確定していない
+                if not source.aborted:
+                    for journal, key, msg_id in uncommitted:
+                        # DELE が拒否されたメッセージは保存済み (APPENDED) のまま次回に後処理する
+                        if not source.delete_failed(msg_id):
+                            journal.record(key, ACKED)
+                    # mbox は削除でファイルを書き直すと残ったメッセージのキーが変わる
+                    rekeyed = source.rekeyed_messages()
+                    if rekeyed is not None:
+                        for journal in journals:
+                            journal.rekey(rekeyed)
+        finally:
+            watchdog.cancel()
+            for journal in journals:
+                journal.close()
+            if backfill and backfill.started:
+                # エラーで中断した場合も、それまでに移動した分の進捗を保存する
+                backfill.finish(partial=failed or partial)
+                if callback:
+                    callback(backfill.to_event(user))
+
+    if source.aborted:
+        # 処理を終えた直後に打ち切られた場合も、削除が確定していないためエラーとする
+        raise watchdog.error()
+
+    return moved_count
+
+def _process_folder(source, source_config: SourceConfig, source_folder: Optional[str], destination: DestinationSet, journal: Optional[SourceJournal], uncommitted: list, backfill: Optional[BackfillState], stop_event: Optional[threading.Event], callback: Optional[Callable], routing: Optional[RoutingRules], state_dir: Optional[str], metrics: SourceMetrics, lane: Optional[SizeLane] = None, watchdog: Optional[SourceWatchdog] = None) -> int:
+    """
+    取得元の1つのフォルダ（POP3では受信箱全体）を処理する
+    戻り値: 移動したメッセージ数
+    """
+    user = source.user
+    if source_folder is not None:
+        source.folder = source_folder
+    moved_count = 0
+    transferred_bytes = 0
+    listed = 0
+    messages = None
+    folder_state = FolderState.load(state_dir, source_config.raw, source_folder) if state_dir and isinstance(source, ImapSource) else None
+    status = {}
+
+    # 削除の結果が切断時まで確定しないメッセージ（PIPELINING の DELE など）
+    deferred_deletes = []
+
+    def acked(key, msg_id):
+        if source.delete_after_move and source.COMMIT_ON_DISCONNECT:
+            deferred_deletes.append(msg_id)
+            if journal:
+                uncommitted.append((journal, key, msg_id))
+        elif journal:
+            journal.record(key, ACKED)
+
+    def settle(msg_id, key, unique_id) -> int:
+        """
+        保存を確認したメッセージを取得元で後処理する（設定に応じて削除または既読マーク）
+        戻り値: 移動件数に数える場合 1
+        """
+        if journal:
+            journal.record(key, APPENDED)
+        if callback:
+            callback({'action': 'update', 'id': unique_id, 'status': '保存完了'})
+
+        if source.delete_after_move:
+            # 削除する設定の場合
+            if callback:
+                callback({'action': 'update', 'id': unique_id, 'status': '削除中...'})
+            moved = 0
+            try:
+                with metrics.phase('ack'):
+                    source.delete_message(msg_id)
+                acked(key, msg_id)
+                moved = 1
+                if callback:
+                    callback({'action': 'update', 'id': unique_id, 'status': '削除完了'})
+            except Exception as e:
+                logger.error(f"メッセージ削除失敗 (ID: {msg_id}): {e}")
+                if callback:
+                    callback({'action': 'update', 'id': unique_id, 'status': '削除失敗'})
+
+            # 削除設定の場合のみリストから削除
+            if callback:
+                callback({'action': 'remove', 'id': unique_id})
+            return moved
+
+        # 削除しない設定の場合（リストから削除しない）
+        # IMAP・ローカルの取得元の場合は既読マークを付ける
+        if source.MARKS_READ:
+            if callback:
+                callback({'action': 'update', 'id': unique_id, 'status': '既読マーク中...'})
+            try:
+                with metrics.phase('ack'):
+                    source.mark_as_read(msg_id)
+                acked(key, msg_id)
+                if callback:
+                    callback({'action': 'update', 'id': unique_id, 'status': '完了（保持）'})
+            except Exception as e:
+                logger.error(f"既読マーク失敗 (ID: {msg_id}): {e}")
+                if callback:
+                    callback({'action': 'update', 'id': unique_id, 'status': '完了（エラー）'})
+        else:
+            # POP3の場合は何もしない（サーバに残る）
+            acked(key, msg_id)
+            if callback:
+                callback({'action': 'update', 'id': unique_id, 'status': '完了（保持）'})
+        return 1
+
+    # 書き込みの確定を待っているメッセージ (ID, ジャーナルのキー, 画面表示のID)
+    batched = destination.batched
+    unsettled = []
+
+    def settle_batch() -> int:
+        """まとめて書き込んだメッセージを確定させてから後処理する。戻り値: 移動件数"""
+        if not unsettled:
+            return 0
+        with metrics.phase('store'):
+            confirmed = destination.flush()
+        batch = list(unsettled)
+        unsettled.clear()
+        if not confirmed:
+            logger.error(f"移動先への保存を確定できなかったため、{len(batch)} 件の後処理をスキップします")
+            metrics.failed += len(batch)
+            if callback:
+                for _, _, unique_id in batch:
+                    callback({'action': 'update', 'id': unique_id, 'status': '移動失敗'})
+            return 0
+        return sum(settle(*item) for item in batch)
+
+    try:
+        search_started = time.monotonic()
+        # ID一覧だけ先に取得し、本文は逐次ダウンロードする
+        if isinstance(source, ImapSource):
+            # STATUS で未読がなければ SELECT も SEARCH も行わない
+            status = source.folder_status() if folder_state else {}
+            # 前回中断されたメッセージがあれば後処理のために検索する
+            recovering = bool(journal and journal.keys_in(APPENDED))
+            if status.get('UNSEEN') == 0 and not recovering:
+                logger.info("未読メッセージはありません (STATUS)")
+                message_ids = []
+            elif status and not recovering and folder_state.unchanged(status):
+                logger.info("前回の実行からフォルダは変更されていません (STATUS)")
+                message_ids = []
+            else:
+                message_ids = source.search_unseen(folder_state.changed_since(status) if status else None)
+        else:
+            message_ids = source.list_messages()
+        if journal:
+            message_ids = _recover_from_journal(source, journal, message_ids, acked)
+        listed = len(message_ids)
+        if backfill:
+            # 今回の実行で処理する分だけ切り出す（サイズはバイト数上限がある場合のみ取得）
+            message_ids = backfill.select(message_ids, source.message_sizes if backfill.max_bytes else None)
+        total = len(message_ids)
+
+        server_side = destination.server_side_target(source)
+        deferred = 0
+        if lane and message_ids and not server_side and not backfill:
+            # このレーンが受け持つサイズのメッセージだけを処理する（サイズ不明は小さいものとして扱う）
+            sizes = source.message_sizes(message_ids)
+            selected = [i for i in message_ids if lane.accepts(sizes.get(i, 0))]
+            deferred = len(message_ids) - len(selected)
+            message_ids = selected
+            total = len(message_ids)
+            if deferred and not lane.large:
+                metrics.deferred += deferred
+                logger.info(f"大きなメッセージ {deferred} 件は大きいメッセージのレーンで処理します")
+        if server_side:
+            # 本文はダウンロードしない
+            messages = []
+        elif isinstance(source, ImapSource) and source.parallel_connections > 1 and total > 1:
+            messages = ShardedImapFetcher(source_config, message_ids, source.parallel_connections, stop_event, source_folder, watchdog)
+        else:
+            messages = source.iter_messages(message_ids)
+        metrics.add_phase('search', time.monotonic() - search_started)
         
-        if not messages:
-            logger.info("新しいメッセージはありません")
+        if not total:
+            if not deferred:
+                logger.info("新しいメッセージはありません" if not listed else "今回の処理上限に達したため、次回以降に処理します")
+            if folder_state:
+                folder_state.update(status, pending=listed)
             return 0
 
-        logger.info(f"{len(messages)} 件のメッセージを移動します...")
+        logger.info(f"{total} 件のメッセージを移動します...")
+
+        if server_side:
+            logger.info("移動先が同じアカウントのため、サーバ内でコピー・移動します")
+            with metrics.phase('server_move'):
+                moved_count = _transfer_on_server(source, *server_side, message_ids, routing, journal, acked, stop_event)
 
-        for msg_id, msg_bytes in messages:
+        # メッセージごとのログは DEBUG とし、INFO では一定間隔で進捗だけを出す
+        progress = ProgressLog(logger, total, f" ({source_folder})" if source_folder else '')
+        # 取得 (fetch) の時間は、前のメッセージの処理を終えてから次の本文が届くまでの待ち時間
+        fetch_started = time.monotonic()
+        for record in messages:
+            message_started = time.monotonic()
+            fetch_seconds = message_started - fetch_started
+            metrics.add_phase('fetch', fetch_seconds)
             if stop_event and stop_event.is_set():
                 logger.info("停止シグナルを検知しました。メッセージ移動を中断します。")
                 break
+            if backfill and backfill.out_of_time():
+                logger.info("バックフィルの時間上限に達しました。残りは次回以降に処理します。")
+                break
+            if watchdog and watchdog.out_of_time():
+                logger.info("処理時間の上限に近づいたため、残りは次回以降に処理します")
+                break
+            progress.step()
+            msg_id = record.id
 
-            # ヘッダ解析
-            msg_obj = email.message_from_bytes(msg_bytes)
-            subject = decode_str(msg_obj.get('Subject'))
-            sender = decode_str(msg_obj.get('From'))
-            date = msg_obj.get('Date')
+            # ヘッダは振り分けと画面表示にだけ使うため、どちらもなければ解析しない
+            if routing or callback:
+                _read_headers(record, display=callback is not None)
+            folder = routing.match(user, record.headers, record.subject, record.size) if routing else None
             
             # ユニークID生成 (簡易的)
-            unique_id = f"{user}-{msg_id}"
+            unique_id = None
+            if callback:
+                unique_id = f"{user}-{source_folder}-{msg_id}" if source_folder else f"{user}-{msg_id}"
+            key = source.message_key(msg_id) if journal else None
+            stored = journal.stored_destinations(key) if journal else set()
+            if journal:
+                journal.record(key, FETCHED, folder=folder, destinations=sorted(stored))
 
             # GUI更新: 取得完了
             if callback:
@@ -231,9 +919,9 @@ def process_source(source_config: Dict[str, Any], destination: ImapDestination,
                     'action': 'add',
                     'id': unique_id,
                     'source': user,
-                    'date': date,
-                    'sender': sender,
-                    'subject': subject,
+                    'date': record.date,
+                    'sender': record.sender,
+                    'subject': record.subject,
                     'status': '取得完了'
                 })
 
@@ -241,62 +929,53 @@ def process_source(source_config: Dict[str, Any], destination: ImapDestination,
             if callback:
                 callback({'action': 'update', 'id': unique_id, 'status': '保存中...'})
             
-            if destination.append_message(msg_bytes):
-                if callback:
-                    callback({'action': 'update', 'id': unique_id, 'status': '保存完了'})
-
-                # 成功したら、設定に応じて削除または既読マーク
-                if source.delete_after_move:
-                    # 削除する設定の場合
-                    if callback:
-                        callback({'action': 'update', 'id': unique_id, 'status': '削除中...'})
-                    try:
-                        source.delete_message(msg_id)
-                        moved_count += 1
-                        if callback:
-                            callback({'action': 'update', 'id': unique_id, 'status': '削除完了'})
-                    except Exception as e:
-                        logger.error(f"メッセージ削除失敗 (ID: {msg_id}): {e}")
-                        if callback:
-                            callback({'action': 'update', 'id': unique_id, 'status': '削除失敗'})
-                    
-                    # 削除設定の場合のみリストから削除
-                    if callback:
-                        callback({'action': 'remove', 'id': unique_id})
+            with metrics.phase('store'):
+                appended = destination.append_message(record.body, folder, stored)
+            if appended:
+                transferred_bytes += record.size
+                if batched:
+                    # 移動先がまとめて書き込みを確定するまで、取得元の後処理を待つ
+                    unsettled.append((msg_id, key, unique_id))
+                    if destination.flush_due():
+                        moved_count += settle_batch()
                 else:
-                    # 削除しない設定の場合
-                    moved_count += 1
-                    
-                    # IMAPの場合は既読マークを付ける
-                    if isinstance(source, ImapSource):
-                        if callback:
-                            callback({'action': 'update', 'id': unique_id, 'status': '既読マーク中...'})
-                        try:
-                            source.mark_as_read(msg_id)
-                            if callback:
-                                callback({'action': 'update', 'id': unique_id, 'status': '完了（保持）'})
-                        except Exception as e:
-                            logger.error(f"既読マーク失敗 (ID: {msg_id}): {e}")
-                            if callback:
-                                callback({'action': 'update', 'id': unique_id, 'status': '完了（エラー）'})
-                    else:
-                        # POP3の場合は何もしない（サーバに残る）
-                        if callback:
-                            callback({'action': 'update', 'id': unique_id, 'status': '完了（保持）'})
-                    
-                    # リストから削除しない（保持）
+                    moved_count += settle(msg_id, key, unique_id)
             else:
+                if journal and stored:
+                    # 保存できた移動先を記録し、次回はそれ以外にだけ保存する
+                    journal.record(key, PARTIAL, folder=folder, destinations=sorted(stored))
                 logger.warning(f"メッセージ移動失敗 (ID: {msg_id}) - 削除はスキップします")
+                metrics.failed += 1
                 if callback:
                     callback({'action': 'update', 'id': unique_id, 'status': '移動失敗'})
 
-        logger.info(f"処理完了: {moved_count}/{len(messages)} 件移動しました")
+            metrics.message(time.monotonic() - message_started + fetch_seconds,
+                            folder=source_folder, id=str(msg_id), size=record.size)
+            fetch_started = time.monotonic()
+
+        moved_count += settle_batch()
+        if deferred_deletes:
+            # まとめて送信した削除の応答を確認し、拒否されたメッセージは移動件数に数えない
+            source.flush_deletes()
+            rejected = sum(1 for msg_id in deferred_deletes if source.delete_failed(msg_id))
+            if rejected:
+                logger.warning(f"{rejected} 件のメッセージは削除できなかったため、次回に削除を再試行します")
+                moved_count -= rejected
+        logger.info(f"処理完了{f' ({source_folder})' if source_folder else ''}: {moved_count}/{total} 件移動しました")
+        if folder_state:
+            pending = listed - moved_count
+            if journal:
+                # 既読化・削除に失敗したメッセージは保存済み (APPENDED) のまま未読で残る。
+                # 次回も MODSEQ の差分ではなく全件を検索して後処理する
+                pending = max(pending, len(journal.keys_in(APPENDED)))
+            folder_state.update(status, pending=pending)
 
-    except Exception as e:
-        logger.error(f"処理中にエラーが発生しました: {e}")
-        raise e
     finally:
-        if source:
-            source.disconnect()
-            
+        metrics.bytes += transferred_bytes
+        if backfill:
+            # 途中でエラーになった場合も、それまでに移動した分を進捗に加える
+            backfill.record(moved_count, transferred_bytes, max(listed - moved_count, 0))
+        if isinstance(messages, ShardedImapFetcher):
+            messages.close()
+
     return moved_count
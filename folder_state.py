@@ -0,0 +1,79 @@
+"""
+IMAPフォルダの変更検出
+
+前回の実行時に STATUS で取得した UIDVALIDITY / UIDNEXT / HIGHESTMODSEQ と、
+処理しきれずに残った未読メッセージ数を取得元フォルダごとに保存します。
+
+- STATUS の UNSEEN が 0 のフォルダは SELECT も SEARCH も行わずにスキップする
+- 前回すべて処理できていて、UIDNEXT と HIGHESTMODSEQ が前回と同じフォルダも
+  同様にスキップする（古い未読メッセージが残っていても再検索しない）
+- 前回すべて処理できていて、サーバが CONDSTORE (RFC 7162) に対応していれば、
+  前回以降に変更されたメッセージだけを SEARCH UNSEEN MODSEQ で検索する
+"""
+
+import os
+import json
+import logging
+from typing import Any, Dict, Optional
+from journal import state_file_name
+
+logger = logging.getLogger(__name__)
+
+
+class FolderState:
+    """1つの取得元フォルダの前回の STATUS"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.previous: Dict[str, Any] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.previous = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"フォルダ状態の読み込みに失敗しました: {e}")
+
+    @classmethod
+    def load(cls, state_dir: str, source_config: Dict[str, Any], folder: Optional[str] = None) -> 'FolderState':
+        return cls(os.path.join(state_dir, state_file_name('folder', source_config, folder)))
+
+    def unchanged(self, status: Dict[str, int]) -> bool:
+        """
+        前回すべて処理できていて、前回の実行からフォルダが変更されていなければ True。
+        HIGHESTMODSEQ がないサーバではフラグの変更を検出できないため常に False
+        """
+        previous = self.previous
+        if not previous or previous.get('pending') or 'HIGHESTMODSEQ' not in status:
+            return False
+        return all(previous.get(name) == status.get(name) for name in ('UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'))
+
+    def changed_since(self, status: Dict[str, int]) -> Optional[int]:
+        """
+        今回の STATUS と比較し、差分検索に使える MODSEQ を返す。
+        全件を検索する必要がある場合は None。
+        """
+        previous = self.previous
+        if not previous:
+            return None
+        if previous.get('UIDVALIDITY') != status.get('UIDVALIDITY'):
+            logger.warning("UIDVALIDITY が変わったため、フォルダ全体を検索します")
+            return None
+        if previous.get('pending'):
+            # 前回処理できなかったメッセージは変更されていなくても再度対象にする
+            return None
+        if 'HIGHESTMODSEQ' in status and 'HIGHESTMODSEQ' in previous:
+            return previous['HIGHESTMODSEQ'] + 1
+        return None
+
+    def update(self, status: Dict[str, int], pending: int):
+        """今回の STATUS と、処理しきれずに残ったメッセージ数を保存する"""
+        if not status:
+            return
+        self.previous = dict(status, pending=pending)
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.previous, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"フォルダ状態の保存に失敗しました: {e}")
@@ -2,18 +2,21 @@ import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
 import yaml
 import threading
-import time
 import logging
 import queue
 import os
+import sys
+from datetime import datetime
 from typing import Dict, Any
 
-# core.py からロジックをインポート
-# core.py からロジックをインポート
-from core import run_batch, PIDManager, get_default_config_path
+# メール処理のロジック (core.py) はウィンドウの表示を遅らせないよう、最初の実行時に読み込む
+from instance import PIDManager, get_default_config_path
+from backfill import format_duration
+from scheduler import Scheduler
+from report import RunReport, source_user
+from control_api import ControlState, ControlServer
 from crypto_helper import PasswordCrypto
 import copy
-import socket
 
 # Windows環境でのみシステムトレイをインポート
 if os.name == 'nt':
@@ -25,43 +28,6 @@ if os.name == 'nt':
 else:
     TRAY_AVAILABLE = False
 
-class IPCServer:
-    def __init__(self, app):
-        self.app = app
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.bind(('127.0.0.1', 0)) # 0 means auto-assign port
-        self.port = self.sock.getsockname()[1]
-        self.sock.listen(1)
-        self.running = True
-        self.thread = threading.Thread(target=self._listen_loop, daemon=True)
-        self.thread.start()
-        logging.info(f"IPCサーバーを開始しました (Port: {self.port})")
-
-    def _listen_loop(self):
-        self.sock.settimeout(1.0)  # タイムアウトを設定して終了を検知できるように
-        while self.running:
-            try:
-                conn, addr = self.sock.accept()
-                with conn:
-                    data = conn.recv(1024)
-                    if data == b'SHOW_WINDOW':
-                        logging.info("GUI表示リクエストを受信しました")
-                        self.app.root.after(0, self.app.show_window)
-            except socket.timeout:
-                continue  # タイムアウトしたらループを続ける
-            except Exception as e:
-                if self.running:  # 終了中でない場合のみエラーを表示
-                    logging.error(f"IPCサーバーエラー: {e}")
-                break
-    
-    def stop(self):
-        """サーバーを停止"""
-        self.running = False
-        try:
-            self.sock.close()
-        except Exception:
-            pass
-
 class QueueHandler(logging.Handler):
     """ログをキューに保存するハンドラ"""
     def __init__(self, log_queue):
@@ -111,20 +77,28 @@ class MailConsolidatorApp:
         self.is_running = False
         self.is_background_running = False  # トレイメニュー用
         self.stop_event = threading.Event()
+        self.scheduler = None
         self.bg_thread = None
         self.tray_icon = None
-        self.ipc_server = None
+        self.control_server = None
 
         self.create_widgets()
         self.setup_logging()
         
-        # IPCサーバー起動とPIDファイル作成
+        # 制御APIの起動とPIDファイル作成（Tkの操作はメインスレッドで行う）
+        self.control = ControlState(
+            'gui',
+            run_now=lambda: self.root.after(0, self.run_now),
+            next_run=self._seconds_until_next_run,
+            show=lambda: self.root.after(0, self.show_window),
+        )
+        self.control.set_sources(self.config.get('sources', []))
         try:
-            self.ipc_server = IPCServer(self)
-            PIDManager.write_pid(self.ipc_server.port)
+            self.control_server = ControlServer(self.control, self.config.get('control_port', 0))
+            PIDManager.write_pid(self.control_server.port, self.control_server.token)
         except Exception as e:
-            logging.error(f"IPCサーバーの起動に失敗しました: {e}")
-            # IPC失敗しても起動は継続するが、PIDファイルは作成されないかも
+            logging.error(f"制御APIの起動に失敗しました: {e}")
+            # 制御APIが使えなくても起動は継続するが、PIDファイルは作成されないかも
         
         # Windows環境ならシステムトレイを初期化
         if TRAY_AVAILABLE:
@@ -194,6 +168,11 @@ class MailConsolidatorApp:
                         if crypto.is_encrypted(pwd):
                             config['destination']['password'] = crypto.decrypt(pwd)
                     
+                    # 複数の移動先 (destinations) のパスワード
+                    for dest in config.get('destinations') or []:
+                        if 'password' in dest and crypto.is_encrypted(dest['password']):
+                            dest['password'] = crypto.decrypt(dest['password'])
+                    
                     # 取得元パスワード
                     if 'sources' in config:
                         for source in config['sources']:
@@ -224,6 +203,12 @@ class MailConsolidatorApp:
                 if pwd and not crypto.is_encrypted(pwd):
                     config_to_save['destination']['password'] = crypto.encrypt(pwd)
             
+            # 複数の移動先 (destinations) のパスワード暗号化
+            for dest in config_to_save.get('destinations') or []:
+                pwd = dest.get('password')
+                if pwd and not crypto.is_encrypted(pwd):
+                    dest['password'] = crypto.encrypt(pwd)
+            
             # 取得元パスワード暗号化
             if 'sources' in config_to_save:
                 for source in config_to_save['sources']:
@@ -287,6 +272,16 @@ class MailConsolidatorApp:
         self.btn_quit = ttk.Button(controls, text="アプリを終了", command=self.quit_app)
         self.btn_quit.pack(side="right", padx=5)
 
+        # バックフィル（初回同期）の進捗。バックフィル中の取得元がなければ空
+        self.backfill_progress = {}
+        self.lbl_backfill = ttk.Label(frame, text="", foreground="gray")
+        self.lbl_backfill.pack(fill="x")
+
+        # 連続して失敗しているため、スキップ中（または試行中）の取得元
+        self.breaker_status = {}
+        self.lbl_breaker = ttk.Label(frame, text="", foreground="#b05000")
+        self.lbl_breaker.pack(fill="x")
+
         # ログ表示エリア
         log_frame = ttk.LabelFrame(frame, text="実行ログ", padding="5")
         log_frame.pack(fill="both", expand=True, pady=5)
@@ -324,7 +319,7 @@ class MailConsolidatorApp:
         """
         コアロジックからのステータス更新を受け取るコールバック
         data: {
-            'action': 'add' | 'update' | 'remove',
+            'action': 'add' | 'update' | 'remove' | 'backfill' | 'source',
             'id': unique_id,
             'source': str,
             'date': str,
@@ -358,6 +353,35 @@ class MailConsolidatorApp:
             if self.tree.exists(uid):
                 self.tree.delete(uid)
 
+        elif action == 'backfill':
+            source = data.get('source', '')
+            if data.get('complete'):
+                self.backfill_progress.pop(source, None)
+            else:
+                text = f"{source}: {data.get('done', 0)}/{data.get('total', 0)} 件"
+                if data.get('eta') is not None:
+                    text += f" (残り約 {format_duration(data['eta'])})"
+                self.backfill_progress[source] = text
+            if self.backfill_progress:
+                self.lbl_backfill.config(text="バックフィル中: " + " / ".join(self.backfill_progress.values()))
+            else:
+                self.lbl_backfill.config(text="")
+
+        elif action == 'source' and data.get('breaker'):
+            source = data.get('source', '')
+            breaker = data['breaker']
+            if breaker.get('state') == 'closed':
+                self.breaker_status.pop(source, None)
+            elif breaker.get('state') == 'open' and breaker.get('retry_at'):
+                retry = datetime.fromtimestamp(breaker['retry_at']).strftime('%H:%M')
+                self.breaker_status[source] = f"{source} ({breaker.get('failures', 0)} 回失敗、{retry} に再試行)"
+            else:
+                self.breaker_status[source] = f"{source} (再試行中)"
+            if self.breaker_status:
+                self.lbl_breaker.config(text="接続を控えている取得元: " + " / ".join(self.breaker_status.values()))
+            else:
+                self.lbl_breaker.config(text="")
+
     def create_settings_tab(self, parent):
         frame = ttk.Frame(parent, padding="10")
         frame.pack(fill="both", expand=True)
@@ -462,7 +486,7 @@ class MailConsolidatorApp:
         self.source_listbox.delete(0, tk.END)
         sources = self.config.get('sources', [])
         for src in sources:
-            label = f"{src.get('user')} ({src.get('protocol')})"
+            label = f"{source_user(src)} ({src.get('protocol')})"
             self.source_listbox.insert(tk.END, label)
 
     def get_source_from_entries(self):
@@ -552,6 +576,11 @@ class MailConsolidatorApp:
         if self.is_running_now:
             return
         
+        if self.scheduler and not self.scheduler.stopped:
+            # 定期実行中は待機を打ち切って今すぐ実行する（同時に2回実行しない）
+            self.scheduler.run_now('batch')
+            return
+
         self.btn_run_now.config(state='disabled')
         threading.Thread(target=self._run_task, daemon=True).start()
 
@@ -559,10 +588,26 @@ class MailConsolidatorApp:
     def is_running_now(self):
         return self.btn_run_now['state'] == 'disabled'
 
+    def _seconds_until_next_run(self):
+        scheduler = self.scheduler
+        if scheduler and not scheduler.stopped:
+            return scheduler.seconds_until('batch')
+        return None
+
+    def _run_batch(self):
+        """一時停止中の取得元を除いて一括処理を実行し、結果を制御APIに記録する"""
+        from core import run_batch
+        config = self.control.begin_run(self.config)
+        report = RunReport()
+        try:
+            run_batch(config, self.stop_event, self.control.callback(self.update_status_callback), report)
+        finally:
+            self.control.end_run(report)
+
     def _run_task(self):
         try:
             logging.info("=== 手動実行開始 ===")
-            run_batch(self.config, self.stop_event, self.update_status_callback)
+            self._run_batch()
         except Exception as e:
             logging.error(f"実行エラー: {e}")
         finally:
@@ -577,9 +622,15 @@ class MailConsolidatorApp:
                 raise ValueError
             
             # 設定に保存
+            if interval == self.config.get('interval'):
+                return
             self.config['interval'] = interval
             self.save_config()
             logging.info(f"実行間隔を {interval} 分に変更しました")
+            if self.is_running and self.scheduler:
+                # 待機中であれば次回の実行時刻をすぐに計算し直す
+                self.scheduler.reschedule('batch', interval * 60)
+                self.lbl_status.config(text=f"実行中 (間隔: {interval}分)", foreground="green")
         except ValueError:
             # 無効な値の場合は元の値に戻す
             self.interval_var.set(str(self.config.get('interval', 3)))
@@ -590,6 +641,7 @@ class MailConsolidatorApp:
             # 停止処理
             logging.info("停止シグナルを送信中...")
             self.stop_event.set()
+            self.scheduler.stop()
             # ボタンを一時的に無効化（連打防止）
             self.btn_toggle_bg.config(state='disabled')
             
@@ -621,7 +673,9 @@ class MailConsolidatorApp:
             self.btn_toggle_bg.config(text="定期実行を停止")
             self.lbl_status.config(text=f"実行中 (間隔: {interval}分)", foreground="green")
             
-            self.bg_thread = threading.Thread(target=self._background_loop, args=(interval,), daemon=True)
+            self.scheduler = Scheduler()
+            self.scheduler.add_job('batch', self._scheduled_run, interval * 60)
+            self.bg_thread = threading.Thread(target=self._background_loop, daemon=True)
             self.bg_thread.start()
             logging.info(f"定期実行を開始しました (間隔: {interval}分)")
         
@@ -629,29 +683,24 @@ class MailConsolidatorApp:
         if TRAY_AVAILABLE and self.tray_icon:
             self.tray_icon.update_menu()
 
-    def _background_loop(self, interval_minutes):
+    def _background_loop(self):
         try:
-            while not self.stop_event.is_set():
-                try:
-                    logging.info("=== 定期実行開始 ===")
-                    run_batch(self.config, self.stop_event, self.update_status_callback)
-                except Exception as e:
-                    logging.error(f"定期実行エラー: {e}")
-                
-                if self.stop_event.is_set():
-                    break
-
-                logging.info(f"次回実行まで待機中... ({interval_minutes}分)")
-                
-                # interval分待機 (1秒ごとにstopフラグチェック)
-                for _ in range(interval_minutes * 60):
-                    if self.stop_event.is_set():
-                        break
-                    time.sleep(1)
+            # 次の実行時刻まで眠り、停止・今すぐ実行・間隔変更で即座に起きる
+            self.scheduler.run()
         finally:
             # スレッド終了時にUIをリセット
             self.root.after(0, self._reset_ui_state)
 
+    def _scheduled_run(self):
+        try:
+            logging.info("=== 定期実行開始 ===")
+            self._run_batch()
+        except Exception as e:
+            logging.error(f"定期実行エラー: {e}")
+
+        if not self.stop_event.is_set():
+            logging.info(f"次回実行まで待機中... ({self.config.get('interval', 3)}分)")
+
     def _reset_ui_state(self):
         self.is_running = False
         self.is_background_running = False
@@ -680,13 +729,18 @@ class MailConsolidatorApp:
         # バックグラウンドタスクを停止
         if self.is_running:
             self.stop_event.set()
+            self.scheduler.stop()
             # スレッドが終了するまで少し待つ
             if self.bg_thread and self.bg_thread.is_alive():
                 self.bg_thread.join(timeout=2)
         
-        # IPCサーバーを停止
-        if self.ipc_server:
-            self.ipc_server.stop()
+        # 制御APIを停止
+        if self.control_server:
+            self.control_server.stop()
+
+        # 保持中のIMAPセッションを切断（一度も実行していなければ core は読み込まれていない）
+        if 'core' in sys.modules:
+            sys.modules['core'].close_connection_pool()
         
         # PIDファイルを削除
         PIDManager.remove_pid()
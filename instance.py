@@ -0,0 +1,146 @@
+"""
+単一インスタンス制御と設定ファイルの場所
+
+PIDファイルの読み書き、実行中のインスタンスの制御APIの呼び出し、設定ファイルの
+パスの決定を行います。-k や起動済みインスタンスの確認など、メールの送受信を
+行わない起動経路から使うため、標準ライブラリ以外は必要になるまで読み込みません。
+"""
+
+import os
+import json
+import logging
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PID_FILE = os.path.join(tempfile.gettempdir(), 'mailconsolidator.pid')
+
+def get_default_config_path() -> str:
+    """
+    プラットフォームに応じた適切な設定ファイルパスを返す
+    
+    Windows: %APPDATA%\MailConsolidator\config.yaml
+    Unix系: ~/.config/MailConsolidator/config.yaml
+    """
+    if os.name == 'nt':  # Windows
+        appdata = os.environ.get('APPDATA')
+        if appdata:
+            config_dir = os.path.join(appdata, 'MailConsolidator')
+        else:
+            # APPDATAが取得できない場合のフォールバック
+            config_dir = os.path.join(os.path.expanduser('~'), 'MailConsolidator')
+    else:  # Unix系
+        config_dir = os.path.join(os.path.expanduser('~'), '.config', 'MailConsolidator')
+    
+    # ディレクトリが存在しない場合は作成
+    os.makedirs(config_dir, exist_ok=True)
+    
+    return os.path.join(config_dir, 'config.yaml')
+
+def migrate_config_if_needed():
+    """
+    起動フォルダに古い設定ファイルがある場合、新しい場所にコピーする
+    既に新しい場所に設定ファイルがある場合は何もしない
+    """
+    old_config_path = 'config.yaml'
+    new_config_path = get_default_config_path()
+    
+    # 新しい場所に既に設定ファイルがある場合は何もしない
+    if os.path.exists(new_config_path):
+        return
+    
+    # 古い場所に設定ファイルがある場合はコピー
+    if os.path.exists(old_config_path):
+        try:
+            import shutil
+            shutil.copy2(old_config_path, new_config_path)
+            logger.info(f"設定ファイルを移行しました: {old_config_path} -> {new_config_path}")
+        except Exception as e:
+            logger.warning(f"設定ファイルの移行に失敗しました: {e}")
+
+
+class PIDManager:
+    @staticmethod
+    def write_pid(port: int = 0, token: str = ''):
+        """PIDと制御APIのポート番号・トークンをファイルに書き込む"""
+        try:
+            # トークンを含むため、所有者以外は読めないようにする
+            fd = os.open(PID_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(f"{os.getpid()}:{port}:{token}")
+            logger.info(f"PIDファイルを作成しました: {PID_FILE} (Port: {port})")
+        except Exception as e:
+            logger.error(f"PIDファイルの作成に失敗しました: {e}")
+
+    @staticmethod
+    def _read_fields() -> List[str]:
+        with open(PID_FILE, 'r') as f:
+            return f.read().strip().split(':')
+
+    @staticmethod
+    def read_pid_info() -> Tuple[Optional[int], Optional[int]]:
+        """PIDファイルから (pid, port) を読み込む"""
+        try:
+            if os.path.exists(PID_FILE):
+                fields = PIDManager._read_fields()
+                if len(fields) >= 2:
+                    return int(fields[0]), int(fields[1])
+                else:
+                    return int(fields[0]), 0
+        except Exception as e:
+            logger.error(f"PIDファイルの読み込みに失敗しました: {e}")
+        return None, None
+
+    @staticmethod
+    def read_control_info() -> Tuple[Optional[int], str]:
+        """PIDファイルから制御APIの (port, token) を読み込む"""
+        try:
+            if os.path.exists(PID_FILE):
+                fields = PIDManager._read_fields()
+                if len(fields) >= 3:
+                    return int(fields[1]), fields[2]
+        except Exception as e:
+            logger.error(f"PIDファイルの読み込みに失敗しました: {e}")
+        return None, ''
+
+    @staticmethod
+    def remove_pid():
+        """PIDファイルを削除する"""
+        try:
+            if os.path.exists(PID_FILE):
+                os.remove(PID_FILE)
+                logger.info(f"PIDファイルを削除しました: {PID_FILE}")
+        except Exception as e:
+            logger.error(f"PIDファイルの削除に失敗しました: {e}")
+
+    @staticmethod
+    def is_process_running(pid):
+        """指定されたPIDのプロセスが実行中かチェック"""
+        import psutil
+        try:
+            process = psutil.Process(pid)
+            return process.is_running()
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return False
+
+
+def control_request(port: int, token: str, method: str, path: str, timeout: float = 2.0) -> Optional[Dict[str, Any]]:
+    """実行中のインスタンスの制御APIを呼び出す。失敗した場合は None"""
+    if not port or port <= 0:
+        return None
+    import http.client
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request(method, path, headers={'Authorization': f"Bearer {token or ''}"})
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            logger.error(f"制御APIがエラーを返しました: {response.status} {body.decode('utf-8', errors='replace')}")
+            return None
+        return json.loads(body)
+    except (OSError, ValueError) as e:
+        logger.error(f"制御APIとの通信エラー: {e}")
+        return None
+    finally:
+        conn.close()
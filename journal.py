@@ -0,0 +1,147 @@
+"""
+取得元ごとの先行書き込みジャーナル
+
+メッセージの処理状況を JSON Lines 形式で追記し、処理が中断された場合でも
+次回の実行で「保存済みだが取得元での削除・既読化が済んでいない」メッセージを
+再ダウンロード・再保存せずに後処理だけ行えるようにします。
+
+状態遷移:
+    fetched  -> 取得元からダウンロードした
+    partial  -> 一部の移動先にのみ保存できた（保存済みの移動先を記録）
+    appended -> 必須の移動先すべてに保存した
+    acked    -> 取得元で削除・既読化した（エントリは次回のコンパクションで消える）
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+FETCHED = 'fetched'
+PARTIAL = 'partial'
+APPENDED = 'appended'
+ACKED = 'acked'
+
+
+def state_file_name(prefix: str, source_config: Dict[str, Any], folder: Optional[str] = None, suffix: str = '.json') -> str:
+    """取得元アカウントとフォルダから状態ファイルのファイル名を決める"""
+    if source_config.get('path'):
+        # ローカルの取得元 (maildir / mbox) はパスで区別する
+        identity = '{}:{}'.format(source_config.get('protocol', ''), source_config['path'])
+    else:
+        identity = '{}:{}@{}:{}/{}'.format(
+            source_config.get('protocol', ''),
+            source_config.get('user', ''),
+            source_config.get('host', ''),
+            source_config.get('port', ''),
+            folder or source_config.get('folder', 'INBOX'),
+        )
+    return f"{prefix}-{hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]}{suffix}"
+
+
+def journal_name(source_config: Dict[str, Any], folder: Optional[str] = None) -> str:
+    """取得元アカウントとフォルダからジャーナルのファイル名を決める"""
+    return state_file_name('journal', source_config, folder, '.jsonl')
+
+
+class SourceJournal:
+    """1つの取得元（フォルダ）のジャーナル"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._load()
+        # 完了済みのエントリを除いて書き直してから追記を始める
+        self._rewrite()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    @classmethod
+    def open(cls, state_dir: str, source_config: Dict[str, Any], folder: Optional[str] = None) -> 'SourceJournal':
+        os.makedirs(state_dir, exist_ok=True)
+        return cls(os.path.join(state_dir, journal_name(source_config, folder)))
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で停止した最終行は無視する
+                    continue
+                key = record.get('key')
+                if not key:
+                    continue
+                if record.get('state') == ACKED:
+                    self.entries.pop(key, None)
+                else:
+                    self.entries[key] = record
+        if self.entries:
+            logger.info(f"未完了のジャーナルエントリが {len(self.entries)} 件あります: {self.path}")
+
+    def _rewrite(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in self.entries.values():
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def record(self, key: Optional[str], state: str, **info):
+        """状態遷移を追記する。保存完了 (appended) は確実にディスクへ書き込む"""
+        if key is None:
+            return
+        record = {'key': key, 'state': state}
+        record.update(info)
+        with self._lock:
+            if state == ACKED:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = record
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+            if state in (APPENDED, PARTIAL):
+                os.fsync(self._file.fileno())
+
+    def keys_in(self, state: str) -> List[str]:
+        with self._lock:
+            return [key for key, record in self.entries.items() if record.get('state') == state]
+
+    def stored_destinations(self, key: Optional[str]) -> set:
+        """一部の移動先に保存済みのメッセージについて、保存済みの移動先を返す"""
+        if key is None:
+            return set()
+        with self._lock:
+            record = self.entries.get(key)
+        return set(record.get('destinations', [])) if record else set()
+
+    def rekey(self, keys: Dict[str, str]):
+        """
+        取得元でキーが変わったメッセージのエントリを新しいキーに付け替える。
+        keys に含まれないエントリは取得元に存在しないため除く
+        """
+        with self._lock:
+            entries = {}
+            for key, record in self.entries.items():
+                new_key = keys.get(key)
+                if new_key is not None:
+                    entries[new_key] = dict(record, key=new_key)
+            self.entries = entries
+            self._file.close()
+            self._rewrite()
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            if self.entries:
+                self._rewrite()
+            elif os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,613 @@
+"""
+ローカルのメールファイルの読み書き (maildir / mbox)
+
+旧システムから書き出したアーカイブを、一時的なIMAPサーバにアップロードせずに
+そのまま取り込みます。MailSource を実装しているため、移動先への保存・ジャーナル・
+バックフィル・サイズ別レーンは POP3 / IMAP の取得元と同じように動作します。
+また、ローカルの Maildir を移動先 (MaildirDestination) として使えます。
+
+    sources:
+      - protocol: mbox
+        path: /archive/old-server/inbox.mbox
+      - protocol: maildir
+        path: /archive/old-server/Maildir
+
+- maildir: new/ と cur/ のファイルを名前順に1通ずつ読み込む
+- mbox: ファイルを mmap で開き、"From " 行（メッセージの境界）の位置を索引として
+  状態ディレクトリに保存する。次回は索引の最後のメッセージから先だけを走査するため、
+  数GBのファイルでも全体を読み込んだり走査し直したりしない
+- delete_after_move: false の場合は取り込んだメッセージを状態ディレクトリに記録し、
+  次回以降は対象にしない（元のファイルは変更しない）
+- delete_after_move: true の場合、maildir はファイルを削除する。mbox は切断時に
+  残ったメッセージだけでファイルを書き直す
+
+    destinations:
+      - type: maildir
+        path: /archive/Maildir
+
+- 移動先の Maildir には tmp/ に書き込んでから new/ へ rename する手順で保存する。
+  fsync はメッセージごとではなく一定件数・一定時間ごとにまとめて行い、
+  取得元の削除・既読化はまとめた書き込みが確定してから行う
+- 保存したメッセージのハッシュを Maildir 内の索引に記録し、同じメッセージは再度保存しない
+"""
+
+import os
+import re
+import json
+import mmap
+import time
+import shutil
+import socket
+import hashlib
+import logging
+import itertools
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from config_model import SourceConfig, DestinationConfig
+from journal import state_file_name
+from mail_client import MailSource, MessageRecord
+
+logger = logging.getLogger(__name__)
+
+# mboxrd 形式でエスケープされた From 行 (">From ", ">>From " ...)
+_ESCAPED_FROM_RE = re.compile(rb'^>(>*From )', re.MULTILINE)
+# mbox の書き直し時に1回でコピーする量
+COPY_CHUNK = 1024 * 1024
+# Maildir のファイル名の連番（同じプロセスの複数の移動先で共有する）
+_delivery_counter = itertools.count()
+
+
+class _ImportedLog:
+    """取り込み済みメッセージのキー（1行1件の追記ファイル。path が None なら記録しない）"""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.keys: Set[str] = set()
+        self._file = None
+        if not path:
+            return
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.keys = {line.rstrip('\n') for line in f if line.strip()}
+            except OSError as e:
+                logger.warning(f"取り込み済みメッセージの記録の読み込みに失敗しました: {e}")
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+
+    def add(self, key: str):
+        self.keys.add(key)
+        if self._file:
+            self._file.write(key + '\n')
+            self._file.flush()
+
+    def clear(self):
+        self.keys.clear()
+        if self._file:
+            self._file.seek(0)
+            self._file.truncate()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class LocalSource(MailSource):
+    """ローカルのメールファイルを読み込む取得元の基底クラス"""
+    # 削除しない設定では mark_as_read() で取り込み済みとして記録する
+    MARKS_READ = True
+
+    def __init__(self, config: SourceConfig, state_dir: Optional[str] = None):
+        super().__init__(config)
+        self.path = self.config.path
+        self.state_dir = state_dir
+        self.folder = None
+        self.imported: Optional[_ImportedLog] = None
+        self._by_key: Dict[str, Any] = {}
+
+    def _state_path(self, prefix: str, suffix: str) -> Optional[str]:
+        if not self.state_dir:
+            return None
+        return os.path.join(self.state_dir, state_file_name(prefix, self.config.raw, suffix=suffix))
+
+    def connect(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"{self.path} が見つかりません")
+        if not self.delete_after_move:
+            if not self.state_dir:
+                logger.warning("state_dir がないため、取り込み済みのメッセージを記録できません。次回も同じメッセージを取り込みます")
+            self.imported = _ImportedLog(self._state_path('imported', '.txt'))
+        logger.info(f"{self.path} を開きました")
+
+    def disconnect(self):
+        if self.imported:
+            self.imported.close()
+            self.imported = None
+
+    def get_messages(self) -> List[MessageRecord]:
+        return list(self.iter_messages(self.list_messages()))
+
+    def abort(self):
+        # ファイルの読み込みは止まらないため、処理時間の上限はメッセージの合間でだけ確認する
+        pass
+
+    def mark_as_read(self, message_id: Any):
+        """取り込み済みとして記録する（元のファイルは変更しない）"""
+        if self.imported:
+            self.imported.add(self.message_key(message_id))
+
+    def find_message(self, key: str) -> Optional[Any]:
+        return self._by_key.get(key)
+
+    def _pending(self, key: str) -> bool:
+        return not (self.imported and key in self.imported)
+
+
+class MaildirSource(LocalSource):
+    """Maildir (new/ と cur/) からのメール取得"""
+    PROTOCOL = 'maildir'
+
+    def connect(self):
+        super().connect()
+        if not os.path.isdir(os.path.join(self.path, 'cur')) and not os.path.isdir(os.path.join(self.path, 'new')):
+            raise ValueError(f"{self.path} は Maildir ではありません (new/ と cur/ がありません)")
+
+    def list_messages(self) -> List[str]:
+        """
+        処理対象のメッセージを名前順（配送時刻順）に返す
+        戻り値: new/ または cur/ からの相対パスのリスト
+        """
+        names = []
+        for subdir in ('new', 'cur'):
+            directory = os.path.join(self.path, subdir)
+            if not os.path.isdir(directory):
+                continue
+            with os.scandir(directory) as entries:
+                names.extend((entry.name, f"{subdir}/{entry.name}") for entry in entries
+                             if entry.is_file() and not entry.name.startswith('.'))
+        names.sort()
+        self._by_key = {}
+        message_ids = []
+        for name, message_id in names:
+            key = self.message_key(message_id)
+            self._by_key[key] = message_id
+            if self._pending(key):
+                message_ids.append(message_id)
+        skipped = len(names) - len(message_ids)
+        if skipped:
+            logger.info(f"取り込み済みの {skipped} 件を除きます")
+        return message_ids
+
+    def message_key(self, message_id: str) -> str:
+        # new/ から cur/ への移動やフラグの変更では「:2,」より前の部分は変わらない
+        return os.path.basename(message_id).split(':', 1)[0]
+
+    def message_sizes(self, message_ids: List[str]) -> Dict[str, int]:
+        sizes = {}
+        for message_id in message_ids:
+            try:
+                sizes[message_id] = os.path.getsize(os.path.join(self.path, message_id))
+            except OSError:
+                pass
+        return sizes
+
+    def iter_messages(self, message_ids: List[str]) -> Iterator[MessageRecord]:
+        for message_id in message_ids:
+            try:
+                with open(os.path.join(self.path, message_id), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                # 他のメールソフトが cur/ へ移動したか、削除した
+                logger.warning(f"メッセージファイルが見つかりません: {message_id}")
+                continue
+            yield MessageRecord(message_id, data)
+
+    def delete_message(self, message_id: str):
+        os.remove(os.path.join(self.path, message_id))
+
+
+class MboxIndex:
+    """
+    mbox ファイルのメッセージ境界の索引。
+    先頭位置を array('Q') のバイナリ (.idx) に、対象ファイルの情報を JSON に保存する。
+    ファイルが追記されただけなら既存の索引を使い、最後のメッセージから先だけを走査する
+    """
+
+    def __init__(self, path: Optional[str]):
+        # path は拡張子なしの状態ファイル名
+        self.path = path + '.idx' if path else None
+        self._meta_path = path + '.json' if path else None
+        self.starts = array('Q')
+
+    def load(self, stat: os.stat_result) -> bool:
+        """保存済みの索引を読み込む。対象ファイルが置き換えられていた場合などは False"""
+        if not self.path or not os.path.exists(self.path) or not os.path.exists(self._meta_path):
+            return False
+        try:
+            with open(self._meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('inode') != stat.st_ino or stat.st_size < meta.get('size', 0):
+                return False
+            count = meta.get('count', 0)
+            starts = array('Q')
+            with open(self.path, 'rb') as f:
+                starts.fromfile(f, count)
+        except (OSError, ValueError, EOFError) as e:
+            logger.warning(f"mbox の索引の読み込みに失敗しました: {e}")
+            return False
+        self.starts = starts
+        return True
+
+    def save(self, stat: os.stat_result, size: int):
+        """索引を書き直す"""
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'wb') as f:
+                self.starts.tofile(f)
+            tmp_path = self._meta_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'inode': stat.st_ino, 'size': size, 'count': len(self.starts)}, f)
+            os.replace(tmp_path, self._meta_path)
+        except OSError as e:
+            logger.warning(f"mbox の索引の保存に失敗しました: {e}")
+
+    def scan(self, mm: mmap.mmap, size: int) -> int:
+        """
+        索引の最後のメッセージ以降から境界を探す（最後のメッセージは追記で伸びている可能性がある）
+        戻り値: 新たに見つかったメッセージ数
+        """
+        found = len(self.starts)
+        if not self.starts:
+            if mm[:5] != b'From ':
+                raise ValueError("mbox 形式ではありません（先頭が \"From \" 行ではありません）")
+            self.starts.append(0)
+        position = self.starts[-1]
+        while True:
+            position = mm.find(b'\nFrom ', position, size)
+            if position < 0:
+                break
+            position += 1
+            self.starts.append(position)
+        return len(self.starts) - found
+
+
+class MboxSource(LocalSource):
+    """mbox ファイルからのメール取得（メッセージIDは索引の番号）"""
+    PROTOCOL = 'mbox'
+    # 削除は切断時にファイルを書き直した時点で確定する
+    COMMIT_ON_DISCONNECT = True
+
+    def __init__(self, config: SourceConfig, state_dir: Optional[str] = None):
+        super().__init__(config, state_dir)
+        self._file = None
+        self._mm: Optional[mmap.mmap] = None
+        self._size = 0
+        self._deleted: Set[int] = set()
+        # 書き直しで開始位置が変わったメッセージの旧キーから新キーへの対応
+        self._rekeyed: Optional[Dict[str, str]] = None
+        self.index = MboxIndex(self._state_path('mboxindex', ''))
+
+    def connect(self):
+        super().connect()
+        self._file = open(self.path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self._size = stat.st_size
+        self._deleted = set()
+        self._rekeyed = None
+        if not self._size:
+            return
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.index.load(stat) and (not self.index.starts or self._mm[self.index.starts[-1]:self.index.starts[-1] + 5] == b'From '):
+            found = self.index.scan(self._mm, self._size)
+            if found:
+                logger.info(f"追記された {found} 件のメッセージを索引に追加しました")
+                self.index.save(stat, self._size)
+        else:
+            if self.imported and self.imported.keys:
+                logger.warning("mbox ファイルが置き換えられたため、取り込み済みの記録を破棄します")
+                self.imported.clear()
+            self.index.starts = array('Q')
+            logger.info("mbox の索引を作成しています...")
+            self.index.scan(self._mm, self._size)
+            self.index.save(stat, self._size)
+        logger.info(f"mbox に {len(self.index.starts)} 件のメッセージがあります")
+
+    def disconnect(self):
+        try:
+            if self._deleted:
+                self._rewrite()
+        finally:
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
+            if self._file:
+                self._file.close()
+                self._file = None
+            super().disconnect()
+
+    def list_messages(self) -> List[int]:
+        count = len(self.index.starts) if self._mm is not None else 0
+        self._by_key = {self.message_key(i): i for i in range(count)}
+        message_ids = [i for i in range(count) if self._pending(self.message_key(i))]
+        if count > len(message_ids):
+            logger.info(f"取り込み済みの {count - len(message_ids)} 件を除きます")
+        return message_ids
+
+    def message_key(self, message_id: int) -> str:
+        # ファイル内の開始位置。追記では変わらないが、削除による書き直しで変わるため
+        # 書き直した後は rekeyed_messages() でジャーナルのキーを付け替える
+        return str(self.index.starts[message_id])
+
+    def rekeyed_messages(self) -> Optional[Dict[str, str]]:
+        return self._rekeyed
+
+    def _bounds(self, message_id: int):
+        starts = self.index.starts
+        end = starts[message_id + 1] if message_id + 1 < len(starts) else self._size
+        return starts[message_id], end
+
+    def message_sizes(self, message_ids: List[int]) -> Dict[int, int]:
+        sizes = {}
+        for message_id in message_ids:
+            start, end = self._bounds(message_id)
+            sizes[message_id] = end - start
+        return sizes
+
+    def iter_messages(self, message_ids: List[int]) -> Iterator[MessageRecord]:
+        if self._mm is None:
+            return
+        mm = self._mm
+        for message_id in message_ids:
+            start, end = self._bounds(message_id)
+            # 先頭の "From " 行は mbox の区切りなのでメッセージに含めない
+            body_start = mm.find(b'\n', start, end) + 1 or end
+            # 次のメッセージとの間の空行を除く
+            if mm[end - 4:end] == b'\r\n\r\n' and end - 2 >= body_start:
+                end -= 2
+            elif mm[end - 2:end] == b'\n\n' and end - 1 >= body_start:
+                end -= 1
+            data = mm[body_start:end]
+            if b'>From ' in data:
+                data = _ESCAPED_FROM_RE.sub(rb'\1', data)
+            yield MessageRecord(message_id, data)
+
+    def delete_message(self, message_id: int):
+        self._deleted.add(message_id)
+
+    def _rewrite(self):
+        """削除したメッセージを除いてファイルを書き直す"""
+        stat = os.stat(self.path)
+        if stat.st_ino != os.fstat(self._file.fileno()).st_ino:
+            logger.error("mbox ファイルが置き換えられたため、削除を行いません")
+            return
+        mm = self._mm
+        # 処理中に追記された部分もそのまま残す
+        kept = [i for i in range(len(self.index.starts)) if i not in self._deleted]
+        ranges = [self._bounds(i) for i in kept]
+        if stat.st_size > self._size:
+            ranges.append((self._size, stat.st_size))
+        if not ranges:
+            with open(self.path, 'r+b') as f:
+                f.truncate(0)
+            self.index.starts = array('Q')
+            self._rekeyed = {}
+            self.index.save(os.stat(self.path), 0)
+            logger.info(f"すべてのメッセージを移動したため、{self.path} を空にしました")
+            return
+
+        starts = array('Q')
+        tmp_path = self.path + '.tmp'
+        written = 0
+        with open(tmp_path, 'wb') as out, open(self.path, 'rb') as tail:
+            for start, end in ranges:
+                if start >= self._size:
+                    # 追記された部分は mmap の範囲外なので通常の読み込みでコピーする
+                    tail.seek(start)
+                    shutil.copyfileobj(tail, out, COPY_CHUNK)
+                    break
+                starts.append(written)
+                for offset in range(start, end, COPY_CHUNK):
+                    out.write(mm[offset:min(offset + COPY_CHUNK, end)])
+                written += end - start
+            out.flush()
+            os.fsync(out.fileno())
+        shutil.copymode(self.path, tmp_path)
+        os.replace(tmp_path, self.path)
+        self._rekeyed = {self.message_key(i): str(start) for i, start in zip(kept, starts)}
+        self.index.starts = starts
+        # 追記された部分は次回の接続時に走査する
+        self.index.save(os.stat(self.path), written)
+        logger.info(f"{len(self._deleted)} 件のメッセージを {self.path} から削除しました")
+
+
+LOCAL_SOURCES = {
+    'maildir': MaildirSource,
+    'mbox': MboxSource,
+}
+
+
+class MaildirDestination:
+    """
+    ローカルの Maildir への保存。
+    append_message() は tmp/ への書き込みだけを行い、flush() で fsync と new/ への rename を
+    まとめて行う。DestinationSet は BATCHED の移動先があると、flush() が成功するまで
+    取得元の後処理を待つ。フォルダは Maildir++ のサブフォルダ (.Folder) に保存する
+    """
+    BATCHED = True
+    # 件数が fsync_batch に達しなくても、この秒数が経てば確定する
+    FLUSH_INTERVAL = 1.0
+    # fsync を並行して行うスレッド数（SSD では並行させた方が速い）
+    FSYNC_WORKERS = 8
+    # 保存済みメッセージのハッシュ（8バイトずつ）を記録するファイル
+    INDEX_NAME = '.mailconsolidator-hashes'
+
+    def __init__(self, config: DestinationConfig):
+        if isinstance(config, dict):
+            config = DestinationConfig.from_dict(dict(config, type='maildir'))
+        self.path = config.path
+        self.folder = config.folder
+        self.batch_size = config.fsync_batch
+        # ログ表示と同一アカウントの判定に使う
+        self.host = self.path
+        self.port = 0
+        self.user = ''
+        self.identity = f"maildir:{self.path}"
+        self._hashes: Set[int] = set()
+        # (fd, tmp のパス, new のパス, ハッシュ)
+        self._pending: List[Tuple[int, str, str, int]] = []
+        self._pending_hashes: Set[int] = set()
+        self._first_pending = 0.0
+        self._known_folders: Set[str] = set()
+        self._index = None
+        self._executor = None
+        self._hostname = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+
+    def connect(self):
+        self._known_folders = set()
+        self._folder_path(self.folder)
+        index_path = os.path.join(self.path, self.INDEX_NAME)
+        hashes = array('Q')
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'rb') as f:
+                    data = f.read()
+                hashes.frombytes(data[:len(data) - len(data) % hashes.itemsize])
+            except OSError as e:
+                logger.warning(f"保存済みメッセージの索引の読み込みに失敗しました: {e}")
+        self._hashes = set(hashes)
+        self._index = open(index_path, 'ab')
+        self._executor = ThreadPoolExecutor(max_workers=self.FSYNC_WORKERS, thread_name_prefix='fsync')
+        logger.info(f"移動先 Maildir {self.path} を開きました（保存済み {len(self._hashes)} 件）")
+
+    def disconnect(self):
+        try:
+            self.flush()
+        finally:
+            if self._executor:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            if self._index:
+                self._index.close()
+                self._index = None
+
+    def _folder_path(self, folder: Optional[str]) -> str:
+        """フォルダのディレクトリを返す（なければ tmp/ new/ cur/ を作成する）"""
+        if not folder or folder.upper() == 'INBOX':
+            directory = self.path
+        else:
+            directory = os.path.join(self.path, '.' + folder.replace('/', '.'))
+        if directory not in self._known_folders:
+            for subdir in ('tmp', 'new', 'cur'):
+                os.makedirs(os.path.join(directory, subdir), exist_ok=True)
+            self._known_folders.add(directory)
+        return directory
+
+    def _unique_name(self) -> str:
+        now = time.time()
+        return f"{int(now)}.M{int(now % 1 * 1000000)}P{os.getpid()}Q{next(_delivery_counter)}.{self._hostname}"
+
+    def append_message(self, message_bytes: bytes, folder: Optional[str] = None) -> bool:
+        """tmp/ に書き込む。new/ に現れるのは flush() の後"""
+        if not self._index:
+            raise ConnectionError("接続されていません")
+        try:
+            directory = self._folder_path(folder or self.folder)
+        except OSError as e:
+            logger.error(f"フォルダを作成できません ({folder}): {e}")
+            return False
+        # Maildir の各行は LF で終える
+        data = bytes(message_bytes).replace(b'\r\n', b'\n')
+        # 同じ内容でもフォルダが違えば別のメッセージとして扱う
+        hasher = hashlib.blake2b(os.path.relpath(directory, self.path).encode('utf-8') + b'\0', digest_size=8)
+        hasher.update(data)
+        digest = int.from_bytes(hasher.digest(), 'little')
+        if digest in self._hashes or digest in self._pending_hashes:
+            logger.debug("同じメッセージが保存済みのため、書き込みを省略します")
+            return True
+
+        name = self._unique_name()
+        tmp_path = os.path.join(directory, 'tmp', name)
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o600)
+        except OSError as e:
+            logger.error(f"メッセージの書き込みに失敗しました ({tmp_path}): {e}")
+            return False
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        except OSError as e:
+            os.close(fd)
+            os.remove(tmp_path)
+            logger.error(f"メッセージの書き込みに失敗しました ({tmp_path}): {e}")
+            return False
+        if not self._pending:
+            self._first_pending = time.monotonic()
+        self._pending.append((fd, tmp_path, os.path.join(directory, 'new', name), digest))
+        self._pending_hashes.add(digest)
+        return True
+
+    def flush_due(self) -> bool:
+        return bool(self._pending) and (len(self._pending) >= self.batch_size
+                                        or time.monotonic() - self._first_pending >= self.FLUSH_INTERVAL)
+
+    def flush(self) -> bool:
+        """
+        書き込み中のメッセージを fsync し、new/ へ rename してディレクトリを fsync する。
+        戻り値: すべてのメッセージが確定した場合 True（失敗した場合は tmp/ のファイルを削除する）
+        """
+        if not self._pending:
+            return True
+        pending, self._pending = self._pending, []
+        self._pending_hashes = set()
+        fds = [fd for fd, _, _, _ in pending]
+        try:
+            if self._executor:
+                list(self._executor.map(os.fsync, fds))
+            else:
+                for fd in fds:
+                    os.fsync(fd)
+        except OSError as e:
+            logger.error(f"Maildir への書き込みを確定できませんでした: {e}")
+            for fd, tmp_path, _, _ in pending:
+                os.close(fd)
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return False
+
+        directories = set()
+        stored = []
+        for fd, tmp_path, new_path, digest in pending:
+            os.close(fd)
+            try:
+                os.rename(tmp_path, new_path)
+            except OSError as e:
+                logger.error(f"メッセージを new/ に移せませんでした ({tmp_path}): {e}")
+                continue
+            directories.add(os.path.dirname(new_path))
+            self._hashes.add(digest)
+            stored.append(digest)
+        if hasattr(os, 'O_DIRECTORY'):
+            # rename を確定させる（Windows ではディレクトリを fsync できない）
+            try:
+                for directory in directories:
+                    dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+                    try:
+                        os.fsync(dir_fd)
+                    finally:
+                        os.close(dir_fd)
+            except OSError as e:
+                logger.error(f"Maildir への書き込みを確定できませんでした: {e}")
+                return False
+        # 索引は失われても重複を防げなくなるだけなので fsync しない
+        self._index.write(array('Q', stored).tobytes())
+        self._index.flush()
+        logger.debug(f"Maildir に {len(stored)} 件のメッセージを確定しました")
+        return len(stored) == len(pending)
@@ -0,0 +1,182 @@
+"""
+ログ出力の設定
+
+各スレッド・モジュールのログは QueueHandler で上限つきのキューに入れるだけにし、
+ファイルやコンソールへの書き込みは1つの QueueListener スレッドで行います。
+遅いディスクやネットワーク共有にログを書いても、メールの転送処理は待たされません。
+
+- ファイルは RotatingFileHandler でサイズごとにローテーションする
+- log_format='json' では1行1レコードの JSON (JSON Lines) で出力する
+- キューがあふれた場合、INFO 以下のレコードは捨てて件数を記録し、後で警告として出力する
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional, TextIO
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# キューに保持するレコード数の上限
+QUEUE_SIZE = 10000
+# WARNING 以上のレコードはキューに空きができるまでこの秒数だけ待つ
+IMPORTANT_PUT_TIMEOUT = 1.0
+# ログファイルのローテーション
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """1行1レコードの JSON で出力する"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.processName != 'MainProcess':
+            entry['process'] = record.processName
+        if record.threadName != 'MainThread':
+            entry['thread'] = record.threadName
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """キューがあふれたときに処理を止めず、重要度の低いレコードを捨てる QueueHandler"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=IMPORTANT_PUT_TIMEOUT)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+            return
+        if self.dropped:
+            self._report_dropped()
+
+    def _report_dropped(self):
+        with self._dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if not dropped:
+            return
+        record = logging.LogRecord(
+            'logging_setup', logging.WARNING, __file__, 0,
+            f"ログの出力が追いつかないため {dropped} 件のレコードを破棄しました", None, None,
+        )
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += dropped
+
+
+def setup_logging(verbose: bool, log_file: Optional[str] = None, log_format: str = 'text',
+                  stream: Optional[TextIO] = None):
+    """
+    ログ設定を初期化する
+    verbose: コンソールに出力する / log_file: 指定した場合のみファイルに出力する
+    log_format: 'text' または 'json'
+    stream: コンソール出力先（デフォルトは標準出力）
+    """
+    global _listener
+    shutdown_logging()
+
+    formatter = JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+    handlers = []
+    if verbose:
+        handlers.append(logging.StreamHandler(stream or sys.stdout))
+    if log_file:
+        handlers.append(RotatingFileHandler(log_file, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.setLevel(logging.INFO)
+
+    if not handlers:
+        # ハンドラがない場合はNullHandlerを追加（エラー抑制）
+        root.addHandler(logging.NullHandler())
+        return
+
+    log_queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+    root.addHandler(BoundedQueueHandler(log_queue))
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    """キューに残っているログを書き出してリスナーを停止する"""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+def _reinit_after_fork():
+    """
+    フォークした子プロセスにはリスナーのスレッドが引き継がれないため、
+    新しいキューとリスナーで出力を再開する
+    """
+    global _listener
+    if _listener is None:
+        return
+    log_queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, BoundedQueueHandler):
+            handler.queue = log_queue
+            handler._dropped_lock = threading.Lock()
+    _listener = QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+atexit.register(shutdown_logging)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
+
+
+class ProgressLog:
+    """
+    件数の多い処理の進捗を、一定間隔ごとに1行だけ INFO で出力する
+    （メッセージごとのログは DEBUG）
+    """
+    INTERVAL = 10.0
+
+    def __init__(self, logger: logging.Logger, total: int, label: str = ''):
+        self.logger = logger
+        self.total = total
+        self.label = label
+        self.count = 0
+        self._next = time.monotonic() + self.INTERVAL
+
+    def step(self, count: int = 1):
+        self.count += count
+        now = time.monotonic()
+        if now >= self._next and self.count < self.total:
+            self._next = now + self.INTERVAL
+            self.logger.info(f"進捗{self.label}: {self.count}/{self.total} 件")
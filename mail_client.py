@@ -1,15 +1,21 @@
 import poplib
 import imaplib
 import email
+import queue
+import re
+import socket
 from abc import ABC, abstractmethod
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterator, Tuple, Callable, Union
 import logging
 import ssl
-import ssl
+import threading
+import time
+import zlib
+from ratelimit import limiter_for, is_throttle_response
+from config_model import SourceConfig, DestinationConfig
 # import certifi  <-- Removed top-level import to avoid ModuleNotFoundError in frozen app
 
 # ログ設定
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 import sys
@@ -27,15 +33,351 @@ def create_ssl_context():
     context.load_default_certs()
     return context
 
+# 接続（TLSハンドシェイクとグリーティングを含む）と応答待ちのタイムアウト（秒）
+CONNECT_TIMEOUT = 30.0
+READ_TIMEOUT = 120.0
+
+def set_timeouts(connect: float, read: float):
+    """以降に作成する POP3 / IMAP 接続のタイムアウトを設定する"""
+    global CONNECT_TIMEOUT, READ_TIMEOUT
+    CONNECT_TIMEOUT = connect
+    READ_TIMEOUT = read
+
+def _shutdown_socket(sock):
+    """別スレッドで読み書き中のソケットを打ち切る（待機中の recv / send は直ちに失敗する）"""
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+# imaplib は未知のコマンドを送信できないため COMPRESS (RFC 4978) を登録する
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+# MOVE (RFC 6851) は古いPythonの imaplib に含まれていない
+imaplib.Commands.setdefault('MOVE', ('SELECTED',))
+
+class _DeflateMixin:
+    """
+    COMPRESS=DEFLATE (RFC 4978) に対応した imaplib 接続。
+    有効化後は imaplib の read/readline/send がすべて zlib ストリームを経由する。
+    """
+    _compressor = None
+    _decompressor = None
+    _inbuf = b''
+
+    def enable_compression(self) -> bool:
+        """サーバが COMPRESS=DEFLATE を広告していれば圧縮を開始する"""
+        typ, data = self.capability()
+        capabilities = (data[0] or b'').decode(errors='replace').upper().split() if typ == 'OK' and data else []
+        if 'COMPRESS=DEFLATE' not in capabilities:
+            return False
+        typ, data = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            return False
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        self._inbuf = b''
+        return True
+
+    def send(self, data):
+        if self._compressor:
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        super().send(data)
+
+    def _fill(self) -> bool:
+        """ソケットから圧縮データを読み、展開して内部バッファに追加する"""
+        chunk = self.file.read1(65536)
+        if not chunk:
+            return False
+        self._inbuf += self._decompressor.decompress(chunk)
+        return True
+
+    def read(self, size):
+        if not self._decompressor:
+            return super().read(size)
+        while len(self._inbuf) < size:
+            if not self._fill():
+                break
+        data, self._inbuf = self._inbuf[:size], self._inbuf[size:]
+        return data
+
+    def readline(self):
+        if not self._decompressor:
+            return super().readline()
+        while True:
+            pos = self._inbuf.find(b'\n')
+            if pos >= 0:
+                line, self._inbuf = self._inbuf[:pos + 1], self._inbuf[pos + 1:]
+                return line
+            if len(self._inbuf) > imaplib._MAXLINE:
+                raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+            if not self._fill():
+                line, self._inbuf = self._inbuf, b''
+                return line
+
+
+class _RateLimitMixin:
+    """
+    ホストごとのレート制限 (ratelimit.HostLimiter) を imaplib 接続に適用する。
+    バイト数は圧縮前のデータ量で数える（圧縮時は実際の通信量より多めに制限される）。
+    大きなリテラルは RATE_CHUNK ごとに読み書きして数え、転送しながら少しずつ待つ。
+    """
+    rate_limiter = None
+    RATE_CHUNK = 64 * 1024
+    # abort() で打ち切られた接続。レート制限の待機も打ち切る
+    aborted = False
+
+    def _cancelled(self) -> bool:
+        return self.aborted
+
+    def _command(self, name, *args):
+        if self.rate_limiter:
+            self.rate_limiter.command(1, self._cancelled)
+        return super()._command(name, *args)
+
+    def _command_complete(self, name, tag):
+        try:
+            typ, data = super()._command_complete(name, tag)
+        except self.error as e:
+            if self.rate_limiter and is_throttle_response(str(e)):
+                self.rate_limiter.throttled(e)
+            raise
+        if typ == 'NO' and self.rate_limiter and data and is_throttle_response(data[-1]):
+            self.rate_limiter.throttled(data[-1])
+        return typ, data
+
+    def send(self, data):
+        if not self.rate_limiter:
+            super().send(data)
+            return
+        with memoryview(data) as view:
+            for start in range(0, len(view), self.RATE_CHUNK):
+                chunk = view[start:start + self.RATE_CHUNK]
+                super().send(chunk)
+                self.rate_limiter.transfer(len(chunk), self._cancelled)
+
+    def read(self, size):
+        if not self.rate_limiter:
+            return super().read(size)
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = super().read(min(remaining, self.RATE_CHUNK))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            self.rate_limiter.transfer(len(chunk), self._cancelled)
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+    def readline(self):
+        line = super().readline()
+        if self.rate_limiter:
+            self.rate_limiter.transfer(len(line), self._cancelled)
+        return line
+
+
+class _ImapTimeoutMixin:
+    """
+    imaplib 接続に接続タイムアウトと応答待ちタイムアウトを設定する
+    （imaplib の timeout 引数は Python 3.9 以降のため、ソケットの作成を置き換える）
+    """
+
+    def _create_socket(self, timeout=None):
+        host = None if not self.host else self.host
+        return socket.create_connection((host, self.port), CONNECT_TIMEOUT)
+
+    def open(self, *args, **kwargs):
+        # グリーティングの受信までは接続タイムアウト、以降は応答待ちタイムアウト
+        super().open(*args, **kwargs)
+        self.sock.settimeout(READ_TIMEOUT)
+
+
+class DeflateIMAP4(_RateLimitMixin, _DeflateMixin, _ImapTimeoutMixin, imaplib.IMAP4):
+    pass
+
+
+class DeflateIMAP4_SSL(_RateLimitMixin, _DeflateMixin, _ImapTimeoutMixin, imaplib.IMAP4_SSL):
+
+    def _create_socket(self, timeout=None):
+        # IMAP4_SSL は IMAP4._create_socket を直接呼び出すため、TLS の開始もここで行う
+        sock = _ImapTimeoutMixin._create_socket(self, timeout)
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+
+
+def open_imap(host: str, port: int, use_ssl: bool, user: str, password: str, compress: bool = True):
+    """IMAPサーバに接続してログインし、対応していれば通信を圧縮する"""
+    if use_ssl:
+        context = create_ssl_context()
+        connection = DeflateIMAP4_SSL(host, port, ssl_context=context)
+    else:
+        connection = DeflateIMAP4(host, port)
+    connection.rate_limiter = limiter_for(host)
+    connection.login(user, password)
+    if compress and connection.enable_compression():
+        logger.info("COMPRESS=DEFLATE を有効にしました")
+    return connection
+
+
+class _Pop3RateLimitMixin:
+    """ホストごとのレート制限を poplib 接続に適用する"""
+    rate_limiter = None
+    # abort() で打ち切られた接続。レート制限の待機も打ち切る
+    aborted = False
+
+    def _cancelled(self) -> bool:
+        return self.aborted
+
+    def _putcmd(self, line):
+        if self.rate_limiter:
+            self.rate_limiter.command(1, self._cancelled)
+        super()._putcmd(line)
+
+    def _getline(self):
+        line, octets = super()._getline()
+        if self.rate_limiter:
+            self.rate_limiter.transfer(octets, self._cancelled)
+        return line, octets
+
+    def _getresp(self):
+        try:
+            return super()._getresp()
+        except poplib.error_proto as e:
+            if self.rate_limiter and is_throttle_response(e.args[0] if e.args else ''):
+                self.rate_limiter.throttled(e)
+            raise
+
+
+class _Pop3RetrMixin:
+    """
+    RETR の応答を行ごとのバイト列に分けず、1つのバッファに直接読み込む。
+
+    poplib.POP3.retr は1行ごとに bytes を作り、呼び出し側でさらに連結するため、
+    大きなメッセージでは本文の2回のコピーと行数分のオブジェクトが必要になる。
+    ここでは LIST のサイズで確保した bytearray に受信データを readinto し、
+    ドットスタッフィングもバッファ内で戻して memoryview を返す。
+    PIPELINING で後続の応答が同じバッファに届いていても、終端の後は読み込まない。
+    """
+    # 受信済みデータを確認する単位
+    READ_CHUNK = 64 * 1024
+    # LIST のサイズにドットスタッフィングと終端の分を見込んで確保する
+    BODY_SLACK = 1024
+    # LIST のサイズが過大な場合に備え、先に確保するのはこの大きさまで
+    MAX_PREALLOC = 64 * 1024 * 1024
+
+    def retr_into(self, which: int, size_hint: int = 0) -> memoryview:
+        """RETR を送信し、本文を返す（poplib の retr を行で連結したものと同じ内容）"""
+        self._putcmd(f'RETR {which}')
+        return self.read_retr_response(size_hint)
+
+    def read_retr_response(self, size_hint: int = 0) -> memoryview:
+        """送信済みの RETR の応答を読む。-ERR の場合は error_proto"""
+        self._getresp()
+        return self._read_body(size_hint)
+
+    def _read_body(self, size_hint: int) -> memoryview:
+        buf = bytearray(min(max(size_hint, 0), self.MAX_PREALLOC) + self.BODY_SLACK)
+        length = 0
+        # 直前の4バイト。本文の先頭は行頭なので CRLF があるものとして扱う
+        tail = b'\r\n'
+        while True:
+            chunk = self.file.peek(self.READ_CHUNK)
+            if not chunk:
+                raise poplib.error_proto('-ERR EOF')
+            # 終端 (CRLF . CRLF) が前回の残りにまたがる場合も探す
+            found = (tail + chunk[:4]).find(_POP3_TERMINATOR)
+            end = found + len(_POP3_TERMINATOR) - len(tail) if found >= 0 else -1
+            if end < 0:
+                found = chunk.find(_POP3_TERMINATOR)
+                end = found + len(_POP3_TERMINATOR) if found >= 0 else -1
+            take = end if end >= 0 else len(chunk)
+            if length + take > len(buf):
+                buf.extend(bytes(max(take, len(buf) // 2)))
+            with memoryview(buf)[length:length + take] as target:
+                self.file.readinto(target)
+            length += take
+            if self.rate_limiter:
+                self.rate_limiter.transfer(take, self._cancelled)
+            if end >= 0:
+                break
+            tail = (tail + chunk[max(0, take - 4):take])[-4:]
+        # 最終行の CRLF と終端の ".\r\n" を除く
+        length = _unstuff(buf, max(0, length - len(_POP3_TERMINATOR)))
+        return memoryview(buf)[:length]
+
+
+_POP3_TERMINATOR = b'\r\n.\r\n'
+
+
+def _unstuff(buf: bytearray, length: int) -> int:
+    """
+    行頭の ".." を "." に戻す（poplib と同じ扱い）。バッファ内で詰めて新しい長さを返す
+    """
+    dots = [0] if length >= 2 and buf.startswith(b'..') else []
+    pos = buf.find(b'\r\n..', 0, length)
+    while pos >= 0:
+        dots.append(pos + 2)
+        pos = buf.find(b'\r\n..', pos + 3, length)
+    if not dots:
+        return length
+    view = memoryview(buf)
+    write = read = 0
+    for dot in dots:
+        count = dot - read
+        view[write:write + count] = view[read:dot]
+        write += count
+        read = dot + 1
+    count = length - read
+    view[write:write + count] = view[read:length]
+    view.release()
+    return write + count
+
+
+class LimitedPOP3(_Pop3RetrMixin, _Pop3RateLimitMixin, poplib.POP3):
+    pass
+
+
+class LimitedPOP3_SSL(_Pop3RetrMixin, _Pop3RateLimitMixin, poplib.POP3_SSL):
+    pass
+
+
+class MessageRecord:
+    """
+    取得したメッセージ1通。本文は受信したバイト列（POP3 では memoryview）をそのまま参照する
+    ヘッダ項目は解析した時点で設定される
+    """
+    __slots__ = ('id', 'body', 'size', 'headers', 'subject', 'sender', 'date')
+
+    def __init__(self, message_id: Any, body: Union[bytes, memoryview]):
+        self.id = message_id
+        self.body = body
+        self.size = len(body)
+        self.headers = None
+        self.subject = None
+        self.sender = None
+        self.date = None
+
+
 class MailSource(ABC):
     """メール取得元の基底クラス"""
-    def __init__(self, config: Dict[str, Any]):
-        self.host = config['host']
-        self.port = config['port']
-        self.user = config['user']
-        self.password = config['password']
-        self.ssl = config.get('ssl', True)
-        self.delete_after_move = config.get('delete_after_move', False)
+    # 設定の protocol の値
+    PROTOCOL = ''
+    # 削除が切断時に確定するプロトコルか
+    COMMIT_ON_DISCONNECT = False
+    # 削除しない設定のとき mark_as_read() で既読（取り込み済み）にできるか
+    MARKS_READ = False
+
+    def __init__(self, config: SourceConfig):
+        if isinstance(config, dict):
+            config = SourceConfig.from_dict(dict({'protocol': self.PROTOCOL}, **config))
+        self.config = config
+        self.host = config.host
+        self.port = config.port
+        self.user = config.user
+        self.password = config.password
+        self.ssl = config.ssl
+        self.delete_after_move = config.delete_after_move
 
     @abstractmethod
     def connect(self):
@@ -48,8 +390,8 @@ class MailSource(ABC):
         pass
 
     @abstractmethod
-    def get_messages(self) -> List[bytes]:
-        """メッセージのリスト（バイト列）を取得する"""
+    def get_messages(self) -> List[MessageRecord]:
+        """メッセージのリストを取得する"""
         pass
 
     @abstractmethod
@@ -57,84 +399,477 @@ class MailSource(ABC):
         """メッセージを削除する"""
         pass
 
+    def message_key(self, message_id: Any) -> Optional[str]:
+        """
+        セッションをまたいでも変わらないメッセージの識別子（ジャーナル用）。
+        安定した識別子がない場合は None。
+        """
+        return None
+
+    def find_message(self, key: str) -> Optional[Any]:
+        """message_key() の値から現在のセッションでのメッセージIDを返す。存在しなければ None"""
+        return None
+
+    def message_sizes(self, message_ids: List[Any]) -> Dict[Any, int]:
+        """メッセージIDごとのサイズ（バイト）を返す。取得できないIDは含まれない"""
+        return {}
+
+    def flush_deletes(self):
+        """保留中の削除をまとめて送信する（削除をまとめて送る取得元のみ）"""
+        pass
+
+    def delete_failed(self, message_id: Any) -> bool:
+        """まとめて送信した削除がサーバに拒否されたか"""
+        return False
+
+    def rekeyed_messages(self) -> Optional[Dict[str, str]]:
+        """
+        切断時の削除でメッセージのキーが変わった場合に、旧キーから新キーへの対応を返す。
+        キーが変わっていなければ None
+        """
+        return None
+
+    # abort() で通信を打ち切ったか
+    aborted = False
+
+    def abort(self):
+        """
+        別スレッドから通信中の処理を打ち切る。待機中の読み書きはエラーになり、
+        その後の disconnect() では QUIT / LOGOUT を送らずに接続を閉じる
+        """
+        self.aborted = True
+        connection = getattr(self, 'connection', None)
+        if connection is not None:
+            # レート制限で待機中のスレッドも打ち切る
+            connection.aborted = True
+        _shutdown_socket(getattr(connection, 'sock', None))
+
 class Pop3Source(MailSource):
     """POP3サーバからのメール取得クラス"""
-    def __init__(self, config: Dict[str, Any]):
+    PROTOCOL = 'pop3'
+    # DELEはQUITが成功した時点で確定する
+    COMMIT_ON_DISCONNECT = True
+    # PIPELINING時に1回で送信するコマンド数
+    PIPELINE_DEPTH = 16
+
+    def __init__(self, config: SourceConfig):
         super().__init__(config)
+        self.pipelining = self.config.pipelining
         self.connection = None
+        self.use_pipelining = False
+        self._pending_deletes = []
+        # PIPELINING で送信した DELE のうち -ERR が返ったメッセージ番号
+        self._failed_deletes = set()
+        self._uidl: Dict[int, str] = {}
+        self._numbers: Dict[str, int] = {}
+        self._sizes: Dict[int, int] = {}
 
     def connect(self):
         logger.info(f"POP3サーバ {self.host}:{self.port} に接続中...")
+        self.aborted = False
+        self._pending_deletes = []
+        self._failed_deletes = set()
         if self.ssl:
             context = create_ssl_context()
-            self.connection = poplib.POP3_SSL(self.host, self.port, context=context)
+            self.connection = LimitedPOP3_SSL(self.host, self.port, timeout=CONNECT_TIMEOUT, context=context)
         else:
-            self.connection = poplib.POP3(self.host, self.port)
+            self.connection = LimitedPOP3(self.host, self.port, timeout=CONNECT_TIMEOUT)
+        self.connection.sock.settimeout(READ_TIMEOUT)
+        self.connection.rate_limiter = limiter_for(self.host)
         self.connection.user(self.user)
         self.connection.pass_(self.password)
-        logger.info("POP3接続成功")
+        self.use_pipelining = self.pipelining and self._supports_pipelining()
+        logger.info(f"POP3接続成功{' (PIPELINING有効)' if self.use_pipelining else ''}")
+
+    def _supports_pipelining(self) -> bool:
+        """CAPAでPIPELINING (RFC 2449) が広告されているか確認する"""
+        try:
+            return 'PIPELINING' in self.connection.capa()
+        except poplib.error_proto:
+            # CAPA未対応のサーバ
+            return False
 
     def disconnect(self):
-        if self.connection:
-            self.connection.quit()
+        if self.connection and self.aborted:
+            # QUIT を送らないため、今回の削除は確定しない
+            self.connection.close()
             self.connection = None
-            logger.info("POP3切断完了")
+            logger.info("POP3接続を打ち切りました")
+            return
+        if self.connection:
+            try:
+                self.flush_deletes()
+            finally:
+                self.connection.quit()
+                self.connection = None
+                logger.info("POP3切断完了")
 
-    def get_messages(self) -> List[tuple]:
+    def list_messages(self) -> List[int]:
         """
-        メッセージを取得する。
-        戻り値: (message_index, message_bytes) のリスト
+        LISTでメッセージ番号の一覧を取得する。
+        削除マーク済みのメッセージはLISTに含まれないため、番号は連番とは限らない。
         """
         if not self.connection:
             raise ConnectionError("接続されていません")
 
-        num_messages = len(self.connection.list()[1])
-        logger.info(f"{num_messages} 件のメッセージが見つかりました")
-        
-        messages = []
-        # POP3は1-based index
-        for i in range(1, num_messages + 1):
+        self._sizes = {}
+        for line in self.connection.list()[1]:
+            # "番号 オクテット数"
+            fields = line.split()
+            self._sizes[int(fields[0])] = int(fields[1]) if len(fields) > 1 else 0
+        numbers = list(self._sizes)
+        logger.info(f"{len(numbers)} 件のメッセージが見つかりました")
+        self._load_uidl()
+        return numbers
+
+    def _load_uidl(self):
+        """UIDLでメッセージ番号と一意IDの対応を取得する（未対応サーバでは空）"""
+        try:
+            lines = self.connection.uidl()[1]
+        except poplib.error_proto:
+            self._uidl = {}
+            return
+        self._uidl = {}
+        for line in lines:
+            number, _, uid = line.decode(errors='replace').partition(' ')
+            self._uidl[int(number)] = uid.strip()
+        self._numbers = {uid: number for number, uid in self._uidl.items()}
+
+    def message_key(self, message_id: Any) -> Optional[str]:
+        return self._uidl.get(message_id)
+
+    def find_message(self, key: str) -> Optional[Any]:
+        return self._numbers.get(key)
+
+    def message_sizes(self, message_ids: List[Any]) -> Dict[Any, int]:
+        # LISTの応答で取得済み
+        return {i: self._sizes[i] for i in message_ids if i in self._sizes}
+
+    def iter_messages(self, numbers: List[int]) -> Iterator[MessageRecord]:
+        """
+        指定した番号のメッセージを取得する。
+        PIPELINING対応サーバではRETRをまとめて送信し、応答を順に読み取る。
+        戻り値: MessageRecord (id はメッセージ番号) のイテレータ
+        """
+        if not self.connection:
+            raise ConnectionError("接続されていません")
+
+        # 本文は LIST のサイズで確保したバッファに直接読み込む (retr_into)
+        if not self.use_pipelining:
+            for i in numbers:
+                try:
+                    body = self.connection.retr_into(i, self._sizes.get(i, 0))
+                except poplib.error_proto as e:
+                    logger.error(f"メッセージ {i} の取得に失敗しました: {e}")
+                    continue
+                yield MessageRecord(i, body)
+            return
+
+        for start in range(0, len(numbers), self.PIPELINE_DEPTH):
+            batch = numbers[start:start + self.PIPELINE_DEPTH]
+            # 後続の DELE と応答が混ざらないよう、1回分の応答はすべて読んでから返す
+            results = self._pipeline(
+                [f'RETR {i}' for i in batch],
+                [lambda i=i: self.connection.read_retr_response(self._sizes.get(i, 0)) for i in batch],
+            )
+            for i, result in zip(batch, results):
+                if isinstance(result, poplib.error_proto):
+                    logger.error(f"メッセージ {i} の取得に失敗しました: {result}")
+                    continue
+                yield MessageRecord(i, result)
+
+    def _pipeline(self, commands: List[str], readers: Optional[List[Callable[[], Any]]] = None) -> List[Any]:
+        """
+        複数のコマンドを応答を待たずに一括送信し、応答を送信順に読み取る。
+        readers を省略した場合は1行の応答を読む。
+        -ERR 応答はその位置に error_proto として格納する（後続の応答との同期は保たれる）。
+        """
+        if self.connection.rate_limiter:
+            # 一括送信は _putcmd を経由しないため、ここでまとめて数える
+            self.connection.rate_limiter.command(len(commands), self.connection._cancelled)
+        self.connection.sock.sendall(''.join(f'{command}\r\n' for command in commands).encode())
+        results = []
+        for reader in readers or [self.connection._getresp] * len(commands):
             try:
-                # retrは (response, lines, octets) を返す
-                response, lines, octets = self.connection.retr(i)
-                message_bytes = b'\r\n'.join(lines)
-                messages.append((i, message_bytes))
-            except Exception as e:
-                logger.error(f"メッセージ {i} の取得に失敗しました: {e}")
-        
-        return messages
+                results.append(reader())
+            except poplib.error_proto as e:
+                results.append(e)
+        return results
+
+    def get_messages(self) -> List[MessageRecord]:
+        """
+        メッセージを取得する。
+        戻り値: MessageRecord (id はメッセージ番号) のリスト
+        """
+        return list(self.iter_messages(self.list_messages()))
 
     def delete_message(self, message_id: Any):
         """
         POP3での削除。message_idはメッセージ番号(int)。
+        DELEはQUIT時に確定するため、PIPELINING有効時はまとめて送信する。
         """
         if not self.connection:
             raise ConnectionError("接続されていません")
+        if self.use_pipelining:
+            self._pending_deletes.append(message_id)
+            if len(self._pending_deletes) >= self.PIPELINE_DEPTH:
+                self.flush_deletes()
+            return
         self.connection.dele(message_id)
-        logger.info(f"メッセージ {message_id} を削除マークしました")
+        logger.debug(f"メッセージ {message_id} を削除マークしました")
+
+    def delete_failed(self, message_id: Any) -> bool:
+        return message_id in self._failed_deletes
+
+    def flush_deletes(self):
+        """保留中のDELEをまとめて送信する"""
+        if not self._pending_deletes:
+            return
+        pending, self._pending_deletes = self._pending_deletes, []
+        for message_id, result in zip(pending, self._pipeline([f'DELE {i}' for i in pending])):
+            if isinstance(result, poplib.error_proto):
+                self._failed_deletes.add(message_id)
+                logger.error(f"メッセージ削除失敗 (ID: {message_id}): {result}")
+            else:
+                logger.debug(f"メッセージ {message_id} を削除マークしました")
+
+
+class ImapConnectionPool:
+    """
+    認証済みIMAPセッションを実行サイクル間で保持するプール。
+    キーは (host, port, user, ssl)。取り出したセッションは呼び出し側が占有する。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle: Dict[tuple, tuple] = {}  # key -> (connection, 最終使用時刻, max_idle)
+
+    def take(self, key: tuple):
+        """保持中のセッションを取り出す。アイドル上限を超えたものは破棄する"""
+        with self._lock:
+            entry = self._idle.pop(key, None)
+        if not entry:
+            return None
+        connection, last_used, max_idle = entry
+        if time.monotonic() - last_used > max_idle:
+            logger.info("アイドル上限を超えたIMAPセッションを破棄します")
+            _close_quietly(connection)
+            return None
+        return connection
+
+    def put(self, key: tuple, connection, max_idle: float):
+        """セッションをプールに戻す"""
+        with self._lock:
+            old = self._idle.pop(key, None)
+            self._idle[key] = (connection, time.monotonic(), max_idle)
+        if old:
+            _close_quietly(old[0])
+
+    def evict_idle(self):
+        """アイドル上限を超えたセッションを切断する"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (_, last_used, max_idle) in self._idle.items() if now - last_used > max_idle]
+            connections = [self._idle.pop(key)[0] for key in expired]
+        for connection in connections:
+            _close_quietly(connection)
+        if connections:
+            logger.info(f"アイドル状態のIMAPセッションを {len(connections)} 件切断しました")
+
+    def close_all(self):
+        """保持中のセッションをすべて切断する"""
+        with self._lock:
+            connections = [entry[0] for entry in self._idle.values()]
+            self._idle.clear()
+        for connection in connections:
+            _close_quietly(connection)
+
+
+def _close_quietly(connection):
+    """エラーを無視してIMAP接続をログアウトする"""
+    try:
+        connection.logout()
+    except Exception:
+        pass
 
 
 class ImapSource(MailSource):
     """IMAPサーバからのメール取得クラス"""
-    def __init__(self, config: Dict[str, Any]):
+    PROTOCOL = 'imap'
+    MARKS_READ = True
+    # 1回の UID FETCH でまとめて取得する件数
+    FETCH_BATCH = 20
+    # サイズだけの FETCH は応答が小さいため多めにまとめる
+    SIZE_BATCH = 500
+    HEADER_BATCH = 200
+    # ワイルドカードの解決に使う LIST の結果を再利用する期間（秒）
+    LIST_CACHE_SECONDS = 600
+
+    def __init__(self, config: SourceConfig, pool: Optional[ImapConnectionPool] = None, readonly: bool = False):
         super().__init__(config)
-        self.folder = config.get('folder', 'INBOX')
+        config = self.config
+        # 処理するフォルダ（ワイルドカードを含むパターン可）。folder は現在のフォルダ
+        self.folders = list(config.folders)
+        self.folder = config.folder
+        self.readonly = readonly
+        self.parallel_connections = config.parallel_connections
+        self.compress = config.compress
+        self.keep_alive = config.keep_alive
+        self.max_idle = config.max_idle
+        self.pool = pool if self.keep_alive else None
         self.connection = None
 
-    def connect(self):
+    def _pool_key(self) -> tuple:
+        # 同じアカウントのフォルダはすべて1つのセッションで処理する
+        return (self.host, self.port, self.user, self.ssl)
+
+    def connect(self, select: bool = True):
+        """
+        ログインしてフォルダを選択する。
+        select=False の場合、SELECT は最初に検索するまで遅らせる（STATUS だけで済む場合に省略できる）。
+        """
+        self.aborted = False
+        if self.pool:
+            connection = self.pool.take(self._pool_key())
+            if connection and self._is_alive(connection):
+                self.connection = connection
+                logger.info(f"プール済みIMAPセッションを再利用します (フォルダ: {self.folder})")
+                if select:
+                    self._ensure_selected()
+                return
+
         logger.info(f"IMAPサーバ {self.host}:{self.port} に接続中...")
-        if self.ssl:
-            context = create_ssl_context()
-            self.connection = imaplib.IMAP4_SSL(self.host, self.port, ssl_context=context)
-        else:
-            self.connection = imaplib.IMAP4(self.host, self.port)
-        
-        self.connection.login(self.user, self.password)
-        self.connection.select(self.folder)
+        self.connection = open_imap(self.host, self.port, self.ssl, self.user, self.password, self.compress)
+        if select:
+            self._select()
         logger.info(f"IMAP接続成功 (フォルダ: {self.folder})")
 
+    def _select(self):
+        """フォルダを選択し、UIDVALIDITYを接続に記録する（プールで再利用しても参照できるように）"""
+        typ, data = self.connection.select(_quote_mailbox(self.folder), readonly=self.readonly)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"フォルダ {self.folder} を選択できません: {data}")
+        typ, data = self.connection.response('UIDVALIDITY')
+        self.connection.uidvalidity = data[0].decode() if data and data[0] else None
+        self.connection.selected_folder = self.folder
+
+    def _ensure_selected(self):
+        if getattr(self.connection, 'selected_folder', None) != self.folder:
+            self._select()
+
+    def resolve_folders(self, exclude: Optional[set] = None) -> List[str]:
+        """
+        folders の設定を実際のフォルダ名の一覧にする。
+        * と % (RFC 3501 のワイルドカード) を含むパターンは LIST の結果と照合する。
+        exclude に含まれるフォルダ（同じアカウントの保存先など）は除く。
+        """
+        exclude = exclude or set()
+        folders = []
+        for pattern in self.folders:
+            if '*' in pattern or '%' in pattern:
+                names, delimiter = self._list_folders()
+                regex = _wildcard_regex(pattern, delimiter)
+                matched = [name for name in names if regex.match(name)]
+                if not matched:
+                    logger.warning(f"パターン {pattern} に一致するフォルダがありません")
+            else:
+                matched = [pattern]
+            for name in matched:
+                if name in exclude:
+                    logger.info(f"フォルダ {name} は保存先のため取得元として処理しません")
+                elif name not in folders:
+                    folders.append(name)
+        return folders
+
+    def _list_folders(self) -> Tuple[List[str], Optional[str]]:
+        """
+        選択可能なフォルダ名と階層区切り文字を返す。
+        結果は接続に保存し、プールで再利用される間も LIST_CACHE_SECONDS の間は再利用する。
+        """
+        cached = getattr(self.connection, 'folder_list', None)
+        if cached and time.monotonic() - cached[0] < self.LIST_CACHE_SECONDS:
+            return cached[1], cached[2]
+
+        typ, data = self.connection.list('""', '*')
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"フォルダ一覧を取得できません: {data}")
+        names = []
+        delimiter = None
+        for item in data:
+            # フォルダ名がリテラルで返された場合は (行, 名前) のタプルになる
+            line, literal = item if isinstance(item, tuple) else (item, None)
+            match = _LIST_RE.match(line or b'')
+            if not match:
+                continue
+            if match.group('delimiter') != b'NIL':
+                delimiter = _unquote(match.group('delimiter'))
+            flags = match.group('flags').upper()
+            if b'\\NOSELECT' in flags or b'\\NONEXISTENT' in flags:
+                continue
+            names.append(literal.decode('utf-8', errors='replace') if literal is not None else _unquote(match.group('name')))
+        self.connection.folder_list = (time.monotonic(), names, delimiter)
+        return names, delimiter
+
+    @staticmethod
+    def is_session_error(error: Exception) -> bool:
+        """セッションが使えなくなったエラーか（フォルダ単位のエラーなら False）"""
+        return isinstance(error, (imaplib.IMAP4.abort, OSError))
+
+    def folder_status(self) -> Dict[str, int]:
+        """
+        SELECT せずに STATUS でフォルダの UIDVALIDITY / UIDNEXT / UNSEEN を取得する。
+        CONDSTORE (RFC 7162) 対応サーバでは HIGHESTMODSEQ も取得する。
+        取得できなければ空の辞書を返す。
+        """
+        if not self.connection:
+            raise ConnectionError("接続されていません")
+
+        items = ['UIDVALIDITY', 'UIDNEXT', 'UNSEEN']
+        if 'CONDSTORE' in self._capabilities():
+            items.append('HIGHESTMODSEQ')
+        try:
+            typ, data = self.connection.status(_quote_mailbox(self.folder), f"({' '.join(items)})")
+        except imaplib.IMAP4.error as e:
+            logger.warning(f"STATUS に失敗しました: {e}")
+            return {}
+        if typ != 'OK' or not data or not isinstance(data[-1], bytes):
+            return {}
+        # フォルダ名に括弧が含まれていてもよいように、最後の括弧の中だけを見る
+        items_text = data[-1][data[-1].rfind(b'(') + 1:]
+        return {name.decode().upper(): int(value) for name, value in _STATUS_ITEM_RE.findall(items_text)}
+
+    def message_key(self, message_id: Any) -> Optional[str]:
+        uidvalidity = getattr(self.connection, 'uidvalidity', None)
+        return f"{uidvalidity}:{message_id}" if uidvalidity else None
+
+    def find_message(self, key: str) -> Optional[Any]:
+        uidvalidity, _, uid = key.partition(':')
+        # UIDVALIDITYが変わった場合、以前のUIDは別のメッセージを指す可能性がある
+        if uidvalidity != getattr(self.connection, 'uidvalidity', None):
+            return None
+        return uid
+
+    @staticmethod
+    def _is_alive(connection) -> bool:
+        """NOOPでセッションが有効か確認する（BYE受信やソケットエラーなら無効）"""
+        try:
+            typ, _ = connection.noop()
+            return typ == 'OK'
+        except (imaplib.IMAP4.error, OSError) as e:
+            logger.info(f"プール済みIMAPセッションが切断されていたため再接続します: {e}")
+            _close_quietly(connection)
+            return False
+
     def disconnect(self):
+        if self.connection and self.aborted:
+            self.invalidate()
+            logger.info("IMAP接続を打ち切りました")
+            return
         if self.connection:
+            if self.pool:
+                self.pool.put(self._pool_key(), self.connection, self.max_idle)
+                self.connection = None
+                logger.info("IMAPセッションをプールに戻しました")
+                return
             try:
                 self.connection.close()
             except:
@@ -143,90 +878,400 @@ class ImapSource(MailSource):
             self.connection = None
             logger.info("IMAP切断完了")
 
-    def get_messages(self) -> List[tuple]:
+    def invalidate(self):
+        """エラー発生時など、セッションを再利用せずに破棄する"""
+        if self.connection:
+            _close_quietly(self.connection)
+            self.connection = None
+
+    def search_unseen(self, changed_since: Optional[int] = None) -> List[str]:
         """
-        メッセージを取得する。
-        戻り値: (message_uid, message_bytes) のリスト
+        未読メッセージのUID一覧を取得する。
+        UIDはセッションをまたいでも変わらないため、複数接続での並列取得でも同じIDで扱える。
+        changed_since を指定すると、MODSEQ がその値以上のメッセージだけを検索する (CONDSTORE)。
         """
         if not self.connection:
             raise ConnectionError("接続されていません")
 
-        # 未読メッセージを検索
-        typ, data = self.connection.search(None, 'UNSEEN')
+        self._ensure_selected()
+        criteria = ['UNSEEN']
+        if changed_since:
+            criteria += ['MODSEQ', str(changed_since)]
+        typ, data = self.connection.uid('SEARCH', None, *criteria)
         if typ != 'OK':
             logger.warning("メッセージの検索に失敗しました")
             return []
 
-        message_ids = data[0].split()
-        logger.info(f"{len(message_ids)} 件のメッセージが見つかりました")
+        # MODSEQ 検索の応答の末尾には "(MODSEQ n)" が付く
+        uids = [uid.decode() for uid in (data[0] or b'').split(b'(')[0].split()]
+        logger.info(f"{len(uids)} 件のメッセージが見つかりました")
+        return uids
+
+    def message_sizes(self, uids: List[str]) -> Dict[str, int]:
+        """UID FETCH (RFC822.SIZE) で本文をダウンロードせずにサイズを取得する"""
+        if not self.connection:
+            raise ConnectionError("接続されていません")
+
+        sizes = {}
+        for i in range(0, len(uids), self.SIZE_BATCH):
+            batch = uids[i:i + self.SIZE_BATCH]
+            typ, data = self.connection.uid('FETCH', _uid_set(batch), '(UID RFC822.SIZE)')
+            if typ != 'OK':
+                logger.warning(f"メッセージサイズの取得に失敗しました (UID: {batch[0]}～{batch[-1]})")
+                continue
+            for item in data:
+                if isinstance(item, tuple):
+                    item = item[0]
+                uid = _UID_RE.search(item or b'')
+                size = _SIZE_RE.search(item or b'')
+                if uid and size:
+                    sizes[uid.group(1).decode()] = int(size.group(1))
+        return sizes
+
+    def iter_headers(self, uids: List[str]) -> Iterator[Tuple[str, int, bytes]]:
+        """
+        本文をダウンロードせずにヘッダとサイズだけを取得する（振り分けの判定用）。
+        戻り値: (message_uid, size, header_bytes) のイテレータ
+        """
+        if not self.connection:
+            raise ConnectionError("接続されていません")
+
+        for i in range(0, len(uids), self.HEADER_BATCH):
+            batch = uids[i:i + self.HEADER_BATCH]
+            typ, data = self.connection.uid('FETCH', _uid_set(batch), '(UID RFC822.SIZE BODY.PEEK[HEADER])')
+            if typ != 'OK':
+                logger.warning(f"ヘッダの取得に失敗しました (UID: {batch[0]}～{batch[-1]})")
+                continue
+            for meta, header in _iter_fetch_items(data):
+                uid = _UID_RE.search(meta)
+                size = _SIZE_RE.search(meta)
+                if uid:
+                    yield uid.group(1).decode(), int(size.group(1)) if size else len(header), header
+
+    def same_account(self, destination: 'ImapDestination') -> bool:
+        """移動先が同じサーバの同じアカウントか（サーバ内でコピー・移動できるか）"""
+        return (self.host.lower() == destination.host.lower()
+                and self.port == destination.port
+                and self.user == destination.user)
+
+    def _capabilities(self) -> set:
+        """ログイン後のCAPABILITYを取得する（接続ごとに1回だけ問い合わせる）"""
+        capabilities = getattr(self.connection, 'server_capabilities', None)
+        if capabilities is None:
+            typ, data = self.connection.capability()
+            capabilities = set((data[0] or b'').decode(errors='replace').upper().split()) if typ == 'OK' and data else set()
+            self.connection.server_capabilities = capabilities
+        return capabilities
+
+    def transfer_messages(self, uids: List[str], folder: str, delete: bool, on_copied: Optional[Callable] = None) -> bool:
+        """
+        同じアカウント内の別フォルダへサーバ側でコピー・移動する（本文はダウンロードしない）。
+        delete=True の場合は UID MOVE (RFC 6851)、未対応サーバでは UID COPY の後に
+        削除フラグを立てて EXPUNGE する。delete=False の場合はコピー後に既読にする。
+        on_copied はコピーが完了し、取得元の後処理を行う前に呼び出される。
+        """
+        if not self.connection:
+            raise ConnectionError("接続されていません")
+
+        uid_set = _uid_set(uids)
+        mailbox = _quote_mailbox(folder)
+        capabilities = self._capabilities()
+        if delete and 'MOVE' in capabilities:
+            typ, data = self.connection.uid('MOVE', uid_set, mailbox)
+            if typ != 'OK':
+                logger.error(f"サーバ内でのメッセージ移動に失敗しました ({folder}): {data}")
+                return False
+            logger.info(f"{len(uids)} 件のメッセージをサーバ内で {folder} へ移動しました")
+            return True
+
+        typ, data = self.connection.uid('COPY', uid_set, mailbox)
+        if typ != 'OK':
+            logger.error(f"サーバ内でのメッセージコピーに失敗しました ({folder}): {data}")
+            return False
+        if on_copied:
+            on_copied()
+        if delete:
+            self.connection.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+            if 'UIDPLUS' in capabilities:
+                # 対象のメッセージだけを削除する
+                self.connection.uid('EXPUNGE', uid_set)
+            else:
+                self.connection.expunge()
+        else:
+            self.connection.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Seen)')
+        logger.info(f"{len(uids)} 件のメッセージをサーバ内で {folder} へコピーしました")
+        return True
 
-        messages = []
-        for num in message_ids:
+    def iter_messages(self, uids: List[str]) -> Iterator[MessageRecord]:
+        """
+        指定したUIDのメッセージを FETCH_BATCH 件ずつまとめて取得する。
+        BODY.PEEK[] を使うため、取得しただけでは既読にならない。
+        戻り値: MessageRecord (id はUID) のイテレータ
+        """
+        if not self.connection:
+            raise ConnectionError("接続されていません")
+
+        for i in range(0, len(uids), self.FETCH_BATCH):
+            batch = uids[i:i + self.FETCH_BATCH]
             try:
-                typ, msg_data = self.connection.fetch(num, '(RFC822)')
+                typ, data = self.connection.uid('FETCH', _uid_set(batch), '(UID BODY.PEEK[])')
                 if typ != 'OK':
+                    logger.warning(f"メッセージの取得に失敗しました (UID: {batch[0]}～{batch[-1]})")
                     continue
-                
-                # msg_data[0] は (header, body) のタプル、bodyがメッセージ本体
-                message_bytes = msg_data[0][1]
-                messages.append((num, message_bytes))
             except Exception as e:
-                logger.error(f"メッセージ {num} の取得に失敗しました: {e}")
-        
-        return messages
+                # 接続が切れた・応答がない場合は残りのバッチも取得できないため、呼び出し側に伝える
+                if self.is_session_error(e):
+                    raise
+                logger.error(f"メッセージ {batch[0]}～{batch[-1]} の取得に失敗しました: {e}")
+                continue
+            for uid, body in _parse_fetch_response(data):
+                yield MessageRecord(uid, body)
+
+    def get_messages(self) -> List[MessageRecord]:
+        """
+        メッセージを取得する。
+        戻り値: MessageRecord (id はUID) のリスト
+        """
+        return list(self.iter_messages(self.search_unseen()))
 
     def mark_as_read(self, message_id: Any):
         """
-        IMAPでメッセージを既読にマークする。message_idはメッセージ番号(bytes)。
+        IMAPでメッセージを既読にマークする。message_idはUID(str)。
         """
         if not self.connection:
             raise ConnectionError("接続されていません")
         
-        self.connection.store(message_id, '+FLAGS', '\\Seen')
-        logger.info(f"メッセージ {message_id} を既読にマークしました")
+        self.connection.uid('STORE', message_id, '+FLAGS', '(\\Seen)')
+        logger.debug(f"メッセージ {message_id} を既読にマークしました")
 
     def delete_message(self, message_id: Any):
         """
-        IMAPでの削除。message_idはメッセージ番号(bytes)。
+        IMAPでの削除。message_idはUID(str)。
         Deletedフラグを立ててexpungeする。
         """
         if not self.connection:
             raise ConnectionError("接続されていません")
         
-        self.connection.store(message_id, '+FLAGS', '\\Deleted')
+        self.connection.uid('STORE', message_id, '+FLAGS', '(\\Deleted)')
         self.connection.expunge()
-        logger.info(f"メッセージ {message_id} を削除しました")
+        logger.debug(f"メッセージ {message_id} を削除しました")
+
+
+def _uid_set(uids: List[str]) -> str:
+    """UIDのリストを 1:5,7,9:12 形式のシーケンスセットに変換する"""
+    numbers = sorted(int(uid) for uid in uids)
+    ranges = []
+    start = prev = numbers[0]
+    for n in numbers[1:]:
+        if n != prev + 1:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+            start = n
+        prev = n
+    ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ','.join(ranges)
+
+
+_UID_RE = re.compile(rb'UID (\d+)')
+_SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+_STATUS_ITEM_RE = re.compile(rb'([A-Za-z]+) (\d+)')
+_LIST_RE = re.compile(rb'^\((?P<flags>[^)]*)\) (?P<delimiter>"(?:[^"\\]|\\.)*"|NIL) (?P<name>.*)$')
+
+
+def _unquote(value: bytes) -> str:
+    """IMAPの引用文字列をデコードする"""
+    text = value.decode('utf-8', errors='replace')
+    if len(text) >= 2 and text.startswith('"') and text.endswith('"'):
+        text = re.sub(r'\\(.)', r'\1', text[1:-1])
+    return text
+
+
+def _wildcard_regex(pattern: str, delimiter: Optional[str]) -> 're.Pattern':
+    """LIST のワイルドカード (* は階層を含む任意の文字列、% は階層を含まない) を正規表現にする"""
+    parts = []
+    for char in pattern:
+        if char == '*':
+            parts.append('.*')
+        elif char == '%':
+            parts.append(f'[^{re.escape(delimiter)}]*' if delimiter else '.*')
+        else:
+            parts.append(re.escape(char))
+    return re.compile('^' + ''.join(parts) + '$')
+
+def _iter_fetch_items(data: list) -> Iterator[Tuple[bytes, bytes]]:
+    """
+    imaplib の FETCH 応答から (メタデータ, リテラル) を取り出す。
+    メタデータにはリテラルの前後の両方を含めるため、UIDなどがどちらに現れてもよい。
+    """
+    current = None
+    for item in data:
+        if isinstance(item, tuple):
+            if current:
+                yield current
+            current = item
+        elif current is not None and isinstance(item, bytes):
+            yield current[0] + b' ' + item, current[1]
+            current = None
+    if current:
+        yield current
+
+
+def _parse_fetch_response(data: list) -> Iterator[Tuple[str, bytes]]:
+    """imaplib の UID FETCH 応答から (UID, 本文) を取り出す"""
+    for meta, body in _iter_fetch_items(data):
+        match = _UID_RE.search(meta)
+        if match:
+            yield match.group(1).decode(), body
+        else:
+            logger.warning("UIDを含まないFETCH応答を無視しました")
+
+
+class ShardedImapFetcher:
+    """
+    1つのIMAPフォルダのUID範囲を分割し、複数の接続で並列にダウンロードする。
+    取得済みメッセージは到着順に MessageRecord として返し、既読化・削除は呼び出し側が
+    UIDで行う（UIDは接続に依存しないため、どの範囲のメッセージでも正しく反映される）。
+    """
+    _DONE = object()
+    # キューを待つ間に停止要求・打ち切りを確認する間隔（秒）
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, config: SourceConfig, uids: List[str], shards: int, stop_event: Optional[threading.Event] = None,
+                 folder: Optional[str] = None, watchdog=None):
+        self.config = config.replace(folder=folder) if folder else config
+        self.stop_event = stop_event
+        # 取得元の処理を監視する core.SourceWatchdog。各接続を打ち切りの対象に加える
+        self.watchdog = watchdog
+        self.closed = threading.Event()
+        self.failed_shards = 0
+        self._sessions: List[ImapSource] = []
+        # _sessions と failed_shards を保護する（各範囲のスレッドから更新される）
+        self._lock = threading.Lock()
+        # UID昇順で連続した範囲に分割する
+        uids = sorted(uids, key=int)
+        shards = max(1, min(shards, len(uids)))
+        size, rest = divmod(len(uids), shards)
+        self.ranges = []
+        pos = 0
+        for i in range(shards):
+            end = pos + size + (1 if i < rest else 0)
+            self.ranges.append(uids[pos:end])
+            pos = end
+        # メモリ使用量を抑えるため、未処理のメッセージ数を制限する
+        self.queue = queue.Queue(maxsize=shards * 2)
+        self.threads = []
+
+    def __iter__(self) -> Iterator[MessageRecord]:
+        for index, uids in enumerate(self.ranges):
+            thread = threading.Thread(target=self._fetch_range, args=(index, uids), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"{len(self.ranges)} 本の接続で並列取得を開始します")
+
+        remaining = len(self.threads)
+        while remaining:
+            try:
+                item = self.queue.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                if self.watchdog and self.watchdog.reason:
+                    raise self.watchdog.error()
+                if self.stop_event and self.stop_event.is_set():
+                    # 残りの接続は close() で打ち切る
+                    return
+                continue
+            if item is self._DONE:
+                remaining -= 1
+                continue
+            yield item
+        if self.failed_shards:
+            # 取得できなかった範囲が残っている。取得元の処理を失敗として扱う
+            raise ConnectionError(f"{len(self.ranges)} 本中 {self.failed_shards} 本の接続で取得に失敗しました")
+
+    def _fetch_range(self, index: int, uids: List[str]):
+        source = ImapSource(self.config, readonly=True)
+        try:
+            source.connect()
+            with self._lock:
+                self._sessions.append(source)
+            if self.closed.is_set():
+                source.abort()
+            if self.watchdog:
+                self.watchdog.attach(source)
+            for item in source.iter_messages(uids):
+                if not self._put(item):
+                    break
+            logger.info(f"範囲 #{index + 1} (UID {uids[0]}～{uids[-1]}) の取得が完了しました")
+        except Exception as e:
+            with self._lock:
+                self.failed_shards += 1
+            logger.error(f"範囲 #{index + 1} (UID {uids[0]}～{uids[-1]}) の取得に失敗しました: {e}")
+        finally:
+            if self.watchdog:
+                self.watchdog.detach(source)
+            with self._lock:
+                if source in self._sessions:
+                    self._sessions.remove(source)
+            try:
+                source.disconnect()
+            except Exception:
+                pass
+            self._put(self._DONE, force=True)
+
+    def _put(self, item, force: bool = False) -> bool:
+        """キューに空きができるまで待つ。中断された場合は False を返す"""
+        while True:
+            if not force and (self.closed.is_set() or (self.stop_event and self.stop_event.is_set())):
+                return False
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                if force and self.closed.is_set():
+                    return False
+
+    def close(self):
+        """並列取得を中断し、全接続の終了を待つ（取得中の接続は打ち切る）"""
+        self.closed.set()
+        with self._lock:
+            sessions = list(self._sessions)
+        for source in sessions:
+            source.abort()
+        for thread in self.threads:
+            while thread.is_alive():
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+                thread.join(timeout=0.1)
 
 
 class ImapDestination:
     """移動先IMAPサーバクラス"""
-    def __init__(self, config: Dict[str, Any]):
-        self.host = config['host']
-        self.port = config['port']
-        self.user = config['user']
-        self.password = config['password']
-        self.ssl = config.get('ssl', True)
-        self.folder = config.get('folder', 'INBOX')
+    # 保存を flush() でまとめて確定する移動先か（IMAPは APPEND の応答で確定する）
+    BATCHED = False
+
+    def __init__(self, config: DestinationConfig):
+        if isinstance(config, dict):
+            config = DestinationConfig.from_dict(config)
+        self.host = config.host
+        self.port = config.port
+        self.user = config.user
+        self.password = config.password
+        self.ssl = config.ssl
+        self.folder = config.folder
+        self.compress = config.compress
+        # ジャーナルで保存済みの移動先を識別するためのID
+        self.identity = f"{self.user}@{self.host}:{self.port}"
         self.connection = None
+        self._known_folders = set()
 
     def connect(self):
+        self._known_folders = set()
         logger.info(f"移動先IMAPサーバ {self.host}:{self.port} に接続中...")
-        if self.ssl:
-            context = create_ssl_context()
-            self.connection = imaplib.IMAP4_SSL(self.host, self.port, ssl_context=context)
-        else:
-            self.connection = imaplib.IMAP4(self.host, self.port)
+        self.connection = open_imap(self.host, self.port, self.ssl, self.user, self.password, self.compress)
         
-        self.connection.login(self.user, self.password)
-        
-        # フォルダが存在するか確認、なければ作成（オプション）
-        # ここでは単純にselectする
-        try:
-            self.connection.select(self.folder)
-        except imaplib.IMAP4.error:
-            logger.warning(f"フォルダ {self.folder} が見つかりません。作成を試みます。")
-            self.connection.create(self.folder)
-            self.connection.select(self.folder)
+        # フォルダが存在するか確認、なければ作成
+        # APPENDはフォルダ名を指定するため、SELECTは不要
+        self.ensure_folder(self.folder)
             
         logger.info("移動先IMAP接続成功")
 
@@ -240,18 +1285,51 @@ class ImapDestination:
             self.connection = None
             logger.info("移動先IMAP切断完了")
 
-    def append_message(self, message_bytes: bytes) -> bool:
+    def flush_due(self) -> bool:
+        return False
+
+    def flush(self) -> bool:
+        return True
+
+    def ensure_folder(self, folder: str):
+        """
+        フォルダの存在を確認し、なければ作成する。
+        確認済みのフォルダは記録しておき、同じセッションでは再確認しない（SELECTは不要）。
+        """
+        if folder in self._known_folders:
+            return
+        typ, data = self.connection.list('""', _quote_mailbox(folder))
+        if typ != 'OK' or not [d for d in data if d]:
+            logger.info(f"フォルダ {folder} が見つかりません。作成します。")
+            self.connection.create(_quote_mailbox(folder))
+        self._known_folders.add(folder)
+
+    def append_message(self, message_bytes: bytes, folder: Optional[str] = None) -> bool:
         """
-        メッセージをフォルダに追加する。
+        メッセージをフォルダに追加する。folder を省略した場合は設定のフォルダに保存する。
         """
         if not self.connection:
             raise ConnectionError("接続されていません")
         
+        folder = folder or self.folder
         try:
+            self.ensure_folder(folder)
             # append(mailbox, flags, date_time, message)
             # flagsとdate_timeはNoneでよい（現在時刻とデフォルトフラグ）
-            self.connection.append(self.folder, None, None, message_bytes)
+            typ, data = self.connection.append(_quote_mailbox(folder), None, None, message_bytes)
+            if typ != 'OK':
+                logger.error(f"メッセージのアップロードに失敗しました ({folder}): {data}")
+                return False
             return True
         except Exception as e:
             logger.error(f"メッセージのアップロードに失敗しました: {e}")
             return False
+
+
+_ATOM_RE = re.compile(r'^[^\s(){%*"\\\]]+$')
+
+def _quote_mailbox(name: str) -> str:
+    """空白などを含むフォルダ名をIMAPの引用文字列にする"""
+    if _ATOM_RE.match(name) or (name.startswith('"') and name.endswith('"')):
+        return name
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
@@ -1,129 +1,251 @@
-import yaml
 import logging
 import sys
 import argparse
-import time
 import os
 import signal
 import threading
 import subprocess
-import tempfile
-import psutil
-import atexit
-from typing import Dict, Any
-
-# コアロジックをインポート
-from core import run_batch, PIDManager, get_default_config_path, migrate_config_if_needed
-from crypto_helper import PasswordCrypto
-
-def setup_logging(verbose: bool, log_file: str = None):
-    """ログ設定を初期化"""
-    handlers = []
-    if verbose:
-        handlers.append(logging.StreamHandler(sys.stdout))
-    
-    if log_file:
-        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
-    
-    # ハンドラがない場合はNullHandlerを追加（エラー抑制）
-    if not handlers:
-        handlers.append(logging.NullHandler())
-    
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=handlers,
-        force=True  # 既存の設定を上書き
-    )
+from typing import Dict, Any, Optional
+
+# 起動経路ごとに必要なモジュールだけを読み込む。
+# -k や --help、起動済みインスタンスの確認では、メール処理・暗号化・YAML のライブラリを読み込まない
+from instance import PIDManager, get_default_config_path, migrate_config_if_needed, control_request
+from logging_setup import setup_logging
 
 logger = logging.getLogger(__name__)
 
 def load_config(config_path: str) -> Dict[str, Any]:
-    """設定ファイルを読み込み、パスワードを復号化する"""
+    """
+    設定ファイルを読み込み、パスワードを復号化する。
+    読み込めない場合や内容が不正な場合は ConfigError を送出する
+    """
+    import yaml
+    from crypto_helper import PasswordCrypto
+    from config_model import RunConfig, ConfigError
+    if not os.path.exists(config_path):
+        raise ConfigError(f"設定ファイルが見つかりません: {config_path}")
     try:
-        if not os.path.exists(config_path):
-            logger.error(f"設定ファイルが見つかりません: {config_path}")
-            sys.exit(1)
-            
         with open(config_path, 'r', encoding='utf-8') as f:
             config = yaml.safe_load(f) or {}
-        
-        # パスワードを復号化
-        crypto = PasswordCrypto()
-        
+    except Exception as e:
+        raise ConfigError(f"設定ファイルの読み込みに失敗しました: {e}") from e
+
+    # パスワードを復号化
+    crypto = PasswordCrypto()
+
+    def decrypt(password: str, label: str) -> str:
+        try:
+            return crypto.decrypt(password)
+        except Exception as e:
+            raise ConfigError(f"{label}のパスワード復号化に失敗しました: {e}") from e
+
+    try:
         # 移動先パスワードを復号化
         if 'destination' in config and 'password' in config['destination']:
             password = config['destination']['password']
             if crypto.is_encrypted(password):
-                try:
-                    config['destination']['password'] = crypto.decrypt(password)
-                except Exception as e:
-                    logger.error(f"移動先パスワードの復号化に失敗しました: {e}")
-                    sys.exit(1)
-        
+                config['destination']['password'] = decrypt(password, "移動先")
+
+        # 複数の移動先 (destinations) のパスワードを復号化
+        for i, dest in enumerate(config.get('destinations') or []):
+            if 'password' in dest and crypto.is_encrypted(dest['password']):
+                dest['password'] = decrypt(dest['password'], f"移動先 #{i+1} ")
+
         # 取得元パスワードを復号化
         if 'sources' in config:
             for i, source in enumerate(config['sources']):
                 if 'password' in source:
                     password = source['password']
                     if crypto.is_encrypted(password):
-                        try:
-                            source['password'] = crypto.decrypt(password)
-                        except Exception as e:
-                            logger.error(f"取得元 #{i+1} のパスワード復号化に失敗しました: {e}")
-                            sys.exit(1)
-        
-        return config
+                        source['password'] = decrypt(password, f"取得元 #{i+1} ")
+
+        # 取得元・移動先の設定の誤りは、実行を始める前にここで報告する
+        RunConfig.from_dict(config)
+    except ConfigError as e:
+        raise ConfigError(f"設定ファイルの内容が不正です: {e}") from e
     except Exception as e:
-        logger.error(f"設定ファイルの読み込みに失敗しました: {e}")
+        raise ConfigError(f"設定ファイルの読み込みに失敗しました: {e}") from e
+    return config
+
+def load_config_or_exit(config_path: str) -> Dict[str, Any]:
+    """起動時に設定を読み込む。読み込めない場合はエラーを出力して終了する"""
+    from config_model import ConfigError
+    try:
+        return load_config(config_path)
+    except ConfigError as e:
+        logger.error(str(e))
         sys.exit(1)
 
-def run_daemon(config_path: str):
-    """デーモンモードで実行"""
+def run_daemon(config_path: str, workers: int = None):
+    """
+    デーモンモードで実行
+    workers が2以上なら、取得元をワーカープロセスに分けて処理する
+    """
     logger.info("デーモンモードで起動しました")
-    
-    # PIDファイルを作成
-    PIDManager.write_pid(0)  # デーモンモードではポート不要
+
+    from core import run_batch, close_connection_pool
+    from scheduler import Scheduler
+    from report import RunReport
+    from config_model import ConfigError
+    import control_api
     
     stop_event = threading.Event()
+    scheduler = Scheduler()
+
+    config = load_config_or_exit(config_path)
+    if workers is None:
+        workers = config.get('workers', 1)
+    supervisor = None
+    if workers and workers > 1:
+        from supervisor import Supervisor
+        supervisor = Supervisor(workers)
+        supervisor.start()
+
+    # 制御APIを起動し、ポート番号とトークンをPIDファイルに書き込む
+    control = control_api.ControlState(
+        'daemon',
+        run_now=lambda: scheduler.run_now('batch'),
+        next_run=lambda: scheduler.seconds_until('batch'),
+    )
+    control.set_sources(config.get('sources', []))
+    control_server = None
+    try:
+        control_server = control_api.ControlServer(control, config.get('control_port', 0))
+        PIDManager.write_pid(control_server.port, control_server.token)
+    except OSError as e:
+        logger.error(f"制御APIの起動に失敗しました: {e}")
+        PIDManager.write_pid(0)
 
     def signal_handler(signum, frame):
         logger.info(f"シグナル {signum} を受信しました。終了処理を開始します...")
         stop_event.set()
+        if supervisor:
+            supervisor.stop()
+        scheduler.request_stop()
         # PIDファイルを削除
         PIDManager.remove_pid()
 
+    def reload_handler(signum, frame):
+        # 設定は実行ごとに読み直すため、待機を打ち切って今すぐ実行する
+        logger.info("設定の再読み込みを要求されました。今すぐ実行します")
+        scheduler.request_run('batch')
+
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
-    
-    while not stop_event.is_set():
-        config = load_config(config_path)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, reload_handler)
+
+    def run_cycle():
+        try:
+            config = load_config(config_path)
+        except ConfigError as e:
+            # 実行中のデーモンは終了させず、設定が直るまで実行を見送る
+            logger.error(f"{e}（今回の実行はスキップします）")
+            return
         interval = config.get('interval', 3)
+        # 設定ファイルで実行間隔が変更されていれば次回から反映する
+        scheduler.reschedule('batch', interval * 60)
         
         try:
             logger.info("=== 定期実行開始 ===")
-            result = run_batch(config, stop_event)
+            active_config = control.begin_run(config)
+            report = RunReport()
+            try:
+                if supervisor:
+                    report = supervisor.run_cycle(active_config, control.callback())
+                    result = report.summary()
+                else:
+                    result = run_batch(active_config, stop_event, control.callback(), report)
+            finally:
+                control.end_run(report)
             logger.info(result)
         except Exception as e:
             logger.error(f"実行エラー: {e}")
             
-        if stop_event.is_set():
-            break
-            
-        logger.info(f"次回実行まで待機中... ({interval}分)")
-        
-        # interval分待機 (1秒ごとにstopフラグチェック)
-        for _ in range(interval * 60):
-            if stop_event.is_set():
-                break
-            time.sleep(1)
+        if not stop_event.is_set():
+            logger.info(f"次回実行まで待機中... ({interval}分)")
+
+    interval = config.get('interval', 3)
+    scheduler.add_job('batch', run_cycle, interval * 60)
+    # 次の実行時刻まで眠り、停止・再読み込みで即座に起きる
+    scheduler.run()
             
+    if control_server:
+        control_server.stop()
+    if supervisor:
+        supervisor.close()
+    # 保持中のIMAPセッションを切断
+    close_connection_pool()
+
     # 正常終了時もPIDファイルを削除
     PIDManager.remove_pid()
     logger.info("デーモンプロセスを終了します")
 
+def run_once(config_path: str, report_path: Optional[str] = None, workers: int = None) -> int:
+    """
+    一括処理を1回だけフォアグラウンドで実行する（cron や systemd タイマー向け）
+    report_path を指定すると実行結果を JSON で書き出す（'-' は標準出力）
+    戻り値: 終了コード（すべての取得元が成功した場合 0、それ以外は 1）
+    """
+    from report import RunReport
+
+    report = RunReport()
+    stop_event = threading.Event()
+    supervisor = None
+
+    def signal_handler(signum, frame):
+        logger.info(f"シグナル {signum} を受信しました。処理を中断します...")
+        stop_event.set()
+        if supervisor:
+            supervisor.stop()
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    from config_model import ConfigError
+    try:
+        config = load_config(config_path)
+    except ConfigError as e:
+        logger.error(str(e))
+        config = None
+        report.error = str(e)
+
+    if config is not None:
+        from core import run_batch, close_connection_pool
+        if workers is None:
+            workers = config.get('workers', 1)
+        try:
+            if workers and workers > 1:
+                from supervisor import Supervisor
+                supervisor = Supervisor(workers)
+                supervisor.start()
+                report = supervisor.run_cycle(config)
+                report.interrupted = report.interrupted or stop_event.is_set()
+            else:
+                run_batch(config, stop_event, report=report)
+            logger.info(report.summary())
+        except Exception as e:
+            logger.error(f"実行エラー: {e}")
+            report.error = str(e)
+        finally:
+            if supervisor:
+                supervisor.close()
+            close_connection_pool()
+    report.finish()
+
+    if report.interrupted:
+        logger.warning("処理は中断されました")
+    if report_path:
+        try:
+            report.write_json(report_path)
+        except OSError as e:
+            logger.error(f"実行結果の書き出しに失敗しました: {e}")
+            return 1
+    return 0 if report.status == 'ok' else 1
+
 def kill_daemon():
     """バックグラウンドで実行中のデーモンを停止する"""
+    import psutil
     pid, port = PIDManager.read_pid_info()
     
     if pid is None:
@@ -163,7 +285,27 @@ def kill_daemon():
         logger.error(f"プロセスの停止中にエラーが発生しました: {e}")
         return False
 
+def get_argv_option(argv, name: str, default: str = None) -> str:
+    """内部フラグで起動されたときに、オプションの値を取り出す"""
+    if name in argv:
+        idx = argv.index(name)
+        if idx + 1 < len(argv):
+            return argv[idx + 1]
+    return default
+
+def parse_workers_arg(argv) -> int:
+    """--daemon-worker 起動時の --workers の値を取り出す"""
+    try:
+        return int(get_argv_option(argv, '--workers'))
+    except (TypeError, ValueError):
+        return None
+
 def main():
+    if getattr(sys, 'frozen', False):
+        # PyInstallerで凍結された実行ファイルからワーカープロセスを起動できるようにする
+        import multiprocessing
+        multiprocessing.freeze_support()
+
     # PyInstallerの一時ディレクトリ削除エラーを抑制
     # この問題は既知のPyInstallerの制限で、アプリケーションの機能には影響しない
     if getattr(sys, 'frozen', False):
@@ -189,8 +331,8 @@ def main():
             if idx + 1 < len(sys.argv):
                 log_file = sys.argv[idx + 1]
         
-        setup_logging(verbose, log_file)
-        run_daemon(config_path)
+        setup_logging(verbose, log_file, get_argv_option(sys.argv, '--log-format', 'text'))
+        run_daemon(config_path, parse_workers_arg(sys.argv))
         return
     
     if '--gui-worker' in sys.argv:
@@ -211,7 +353,7 @@ def main():
         
         # ログファイルが指定されている場合のみログ出力
         if log_file:
-            setup_logging(False, log_file)
+            setup_logging(False, log_file, get_argv_option(sys.argv, '--log-format', 'text'))
             try:
                 import tkinter as tk
                 from gui import MailConsolidatorApp
@@ -246,20 +388,33 @@ def main():
     parser.add_argument('-c', '--config', default=get_default_config_path(), help=f'設定ファイルのパス (デフォルト: {get_default_config_path()})')
     parser.add_argument('-v', '--verbose', action='store_true', help='詳細ログをコンソールに表示（GUIモード）')
     parser.add_argument('-l', '--log-file', help='ログファイルのパス（指定した場合のみファイルに出力）')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text', help='ログの出力形式 (json: 1行1レコードのJSON)')
+    parser.add_argument('--workers', type=int, help='デーモンモード・--once で使うワーカープロセス数 (デフォルト: 設定ファイルの workers、未指定なら1)')
+    parser.add_argument('--once', action='store_true', help='一括処理を1回だけフォアグラウンドで実行して終了 (cron・systemd タイマー向け)')
+    parser.add_argument('--report', metavar='PATH', help='--once の実行結果を JSON で書き出すファイル (- で標準出力)')
     
     args = parser.parse_args()
+    if args.report and not args.once:
+        parser.error('--report は --once と組み合わせて指定してください')
     
     # -k オプションが指定された場合、デーモンを停止して終了
     if args.kill:
-        setup_logging(True, args.log_file)
+        setup_logging(True, args.log_file, args.log_format)
         kill_daemon()
         sys.exit(0)
     
     config_path = args.config
+
+    if args.once:
+        # --once: 1回だけ実行し、結果を終了コードで返す
+        # 結果を標準出力に書く場合、ログは標準エラー出力に出す
+        setup_logging(args.verbose, args.log_file, args.log_format,
+                      sys.stderr if args.report == '-' else None)
+        sys.exit(run_once(config_path, args.report, args.workers))
     
     if args.daemon:
         # -d オプション: GUIなしでバックグラウンド実行
-        setup_logging(args.verbose, args.log_file)
+        setup_logging(args.verbose, args.log_file, args.log_format)
         
         if os.name == 'nt':  # Windows
             # 自分自身を再起動（--daemon-worker フラグ付き）
@@ -275,6 +430,10 @@ def main():
             
             if args.log_file:
                 cmd.extend(['-l', args.log_file])
+                cmd.extend(['--log-format', args.log_format])
+
+            if args.workers:
+                cmd.extend(['--workers', str(args.workers)])
             
             # DETACHED_PROCESS フラグでバックグラウンド起動
             DETACHED_PROCESS = 0x00000008
@@ -293,12 +452,12 @@ def main():
                 logger.info(f"デーモンをバックグラウンドで起動しました (PID: {pid})")
                 sys.exit(0)
             # 子プロセスでデーモン実行
-            run_daemon(config_path)
+            run_daemon(config_path, args.workers)
     else:
         # デフォルト: GUIモード
         if args.verbose:
             # -v オプション: フォアグラウンドでGUI起動（ログ表示）
-            setup_logging(True, args.log_file)
+            setup_logging(True, args.log_file, args.log_format)
             try:
                 import tkinter as tk
                 from gui import MailConsolidatorApp
@@ -321,16 +480,17 @@ def main():
             if existing_pid and PIDManager.is_process_running(existing_pid):
                 # 既存のプロセスが実行中
                 if existing_port and existing_port > 0:
-                    # IPCでGUI表示を要求
+                    # 制御APIでGUI表示を要求
                     print(f"既存のインスタンスが見つかりました (PID: {existing_pid})")
-                    if PIDManager.send_show_command(existing_port):
+                    _, token = PIDManager.read_control_info()
+                    if control_request(existing_port, token, 'POST', '/show') is not None:
                         print("GUIを表示しました")
                         sys.exit(0)
                     else:
                         print("既存インスタンスとの通信に失敗しました。新しいインスタンスを起動します...")
                         PIDManager.remove_pid()  # 古いPIDファイルを削除
                 else:
-                    print("既存のインスタンスが見つかりましたが、IPC情報がありません。新しいインスタンスを起動します...")
+                    print("既存のインスタンスが見つかりましたが、制御APIの情報がありません。新しいインスタンスを起動します...")
                     PIDManager.remove_pid()
             elif existing_pid:
                 # PIDファイルは存在するがプロセスが動いていない
@@ -348,6 +508,7 @@ def main():
                 
                 if args.log_file:
                     cmd.extend(['-l', args.log_file])
+                    cmd.extend(['--log-format', args.log_format])
                 
                 # DETACHED_PROCESS フラグでバックグラウンド起動
                 DETACHED_PROCESS = 0x00000008
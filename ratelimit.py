@@ -0,0 +1,240 @@
+"""
+サーバごとの転送レート制限
+
+プロバイダのコマンド数・帯域の制限を超えないよう、ホストごとのトークンバケットで
+コマンド送信数 (commands/s) と送受信バイト数 (bytes/s) を制限します。
+制限はホスト単位で、取得元・移動先のすべての接続とスレッドで共有されます。
+
+サーバがスロットリングを示す応答を返した場合は制限を半分に下げ、その後は
+時間とともに設定値まで少しずつ戻します (AIMD)。制限を設定していないホストでも、
+スロットリングされた時点の実測レートを基準に同じように減速します。
+
+    rate_limits:
+      imap.gmail.com:
+        commands_per_second: 10
+        bytes_per_second: 5000000
+"""
+
+import re
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# スロットリングを示す応答
+# IMAP: [THROTTLED] (Gmail など), [LIMIT] / [UNAVAILABLE] (RFC 5530)
+# POP3: [SYS/TEMP] (RFC 3206) と各社の文言
+# [IN-USE] はメールボックスが他のセッションにロックされているだけで、スロットリングではない
+_THROTTLE_RE = re.compile(
+    r'\[(THROTTLED|LIMIT|UNAVAILABLE|SYS/TEMP)\]|throttl|too many|rate limit|try again later',
+    re.IGNORECASE,
+)
+
+
+def is_throttle_response(text: Any) -> bool:
+    """サーバの応答テキストがスロットリングを示しているか"""
+    if isinstance(text, bytes):
+        text = text.decode(errors='replace')
+    return bool(_THROTTLE_RE.search(str(text or '')))
+
+
+class TokenBucket:
+    """
+    スレッドセーフなトークンバケット。
+    容量を超える量の要求も受け付け、不足分を前借りとして後続の呼び出しを待たせる。
+    """
+    # 待ち時間をこの秒数ごとに区切り、打ち切られていないか確認する
+    SLEEP_SLICE = 0.25
+
+    def __init__(self, rate: float):
+        self.rate = float(rate)
+        # 1秒分のバーストを許容する
+        self.capacity = max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = float(rate)
+            self.capacity = max(self.rate, 1.0)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def drain(self):
+        """貯まっているトークンを捨てる（スロットリング直後のバーストを防ぐ）"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0.0)
+
+    def acquire(self, amount: float, cancelled: Optional[Callable[[], bool]] = None):
+        """
+        amount 分のトークンを消費し、不足していれば待つ。
+        cancelled が True を返したら待機を打ち切る（消費したトークンは戻さない）。
+        打ち切られた後の呼び出しはトークンを消費しない（他の接続を待たせない）
+        """
+        if cancelled and cancelled():
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        deadline = now + wait
+        while wait > 0:
+            if cancelled and cancelled():
+                return
+            time.sleep(min(wait, self.SLEEP_SLICE))
+            wait = deadline - time.monotonic()
+
+
+class HostLimiter:
+    """1つのホストのコマンド数・バイト数の制限"""
+    # スロットリング時に制限へ掛ける係数と、下げられる下限
+    DECREASE = 0.5
+    MIN_FACTOR = 0.05
+    # スロットリングがなければ、設定値に対するこの割合ずつ毎秒戻す
+    RECOVERY_PER_SECOND = 0.01
+    # 複数の接続が同時にスロットリングされても1回だけ減速する
+    THROTTLE_HOLDOFF = 2.0
+    # 制限未設定のホストで実測レートを求める区間（秒）
+    WINDOW = 10.0
+
+    def __init__(self, host: str, commands_per_second: Optional[float] = None, bytes_per_second: Optional[float] = None):
+        self.host = host
+        self._lock = threading.Lock()
+        self.configure(commands_per_second, bytes_per_second)
+
+    def configure(self, commands_per_second: Optional[float], bytes_per_second: Optional[float]):
+        with self._lock:
+            # 設定ファイルで指定された値（スロットリングで学習した値とは区別する）
+            self.configured_limits = (commands_per_second, bytes_per_second)
+            self.max_commands = commands_per_second
+            self.max_bytes = bytes_per_second
+            self.factor = 1.0
+            self.throttle_count = 0
+            self._last_adjust = time.monotonic()
+            self._last_throttle = 0.0
+            self.commands = TokenBucket(commands_per_second) if commands_per_second else None
+            self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+            self._window_start = self._last_adjust
+            self._window = [0, 0]
+            self._observed = (0.0, 0.0)
+
+    def _observe(self, commands: int, nbytes: int):
+        """直近の区間のコマンド数・バイト数を数える（減速の基準に使う）"""
+        now = time.monotonic()
+        with self._lock:
+            self._window[0] += commands
+            self._window[1] += nbytes
+            elapsed = now - self._window_start
+            if elapsed >= self.WINDOW:
+                self._observed = (self._window[0] / elapsed, self._window[1] / elapsed)
+                self._window = [0, 0]
+                self._window_start = now
+            if self.factor < 1.0:
+                self._recover(now)
+
+    def _recover(self, now: float):
+        factor = min(1.0, self.factor + (now - self._last_adjust) * self.RECOVERY_PER_SECOND)
+        self._last_adjust = now
+        if factor != self.factor:
+            self.factor = factor
+            self._apply()
+            if factor == 1.0:
+                if self.configured_limits == (None, None):
+                    # 学習した上限まで戻ったら制限を外し、より高いレートを試す
+                    self.max_commands = self.max_bytes = None
+                    self.commands = self.bytes = None
+                logger.info(f"{self.host} の転送レートを元に戻しました")
+
+    def _apply(self):
+        if self.commands and self.max_commands:
+            self.commands.set_rate(self.max_commands * self.factor)
+        if self.bytes and self.max_bytes:
+            self.bytes.set_rate(self.max_bytes * self.factor)
+
+    def command(self, count: int = 1, cancelled: Optional[Callable[[], bool]] = None):
+        """コマンドを送信する前に呼び出す。cancelled は待機を打ち切る条件"""
+        self._observe(count, 0)
+        if self.commands:
+            self.commands.acquire(count, cancelled)
+
+    def transfer(self, nbytes: int, cancelled: Optional[Callable[[], bool]] = None):
+        """データを送受信した後に呼び出す。cancelled は待機を打ち切る条件"""
+        if not nbytes:
+            return
+        self._observe(0, nbytes)
+        if self.bytes:
+            self.bytes.acquire(nbytes, cancelled)
+
+    def throttled(self, reason: Any = None):
+        """サーバからスロットリング応答を受け取ったときに呼び出す"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_throttle < self.THROTTLE_HOLDOFF:
+                return
+            self._last_throttle = now
+            self.throttle_count += 1
+            if not self.max_commands and not self.max_bytes:
+                # 制限未設定のホストは、スロットリングされた時点の実測レートを上限とする
+                elapsed = max(now - self._window_start, 1.0)
+                commands, nbytes = self._observed
+                commands = max(commands, self._window[0] / elapsed, 1.0)
+                nbytes = max(nbytes, self._window[1] / elapsed)
+                self.max_commands = commands
+                self.max_bytes = nbytes or None
+                self.commands = TokenBucket(commands)
+                self.bytes = TokenBucket(nbytes) if nbytes else None
+            self.factor = max(self.MIN_FACTOR, self.factor * self.DECREASE)
+            self._last_adjust = now
+            self._apply()
+            for bucket in (self.commands, self.bytes):
+                if bucket:
+                    bucket.drain()
+        rates = []
+        if self.max_commands:
+            rates.append(f"{self.max_commands * self.factor:.1f} commands/s")
+        if self.max_bytes:
+            rates.append(f"{self.max_bytes * self.factor:.0f} bytes/s")
+        logger.warning(f"{self.host} からスロットリング応答を受信しました。転送レートを下げます ({', '.join(rates)}): {reason}")
+
+
+_limiters: Dict[str, HostLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def configure_rate_limits(specs: Optional[Dict[str, Dict[str, Any]]]):
+    """
+    設定の rate_limits を反映する。
+    設定が変わっていないホストは、減速中の状態を実行サイクルをまたいで引き継ぐ。
+    """
+    limits = {
+        host.lower(): ((spec or {}).get('commands_per_second'), (spec or {}).get('bytes_per_second'))
+        for host, spec in (specs or {}).items()
+    }
+    with _limiters_lock:
+        for host, (commands, nbytes) in limits.items():
+            if host not in _limiters:
+                _limiters[host] = HostLimiter(host, commands, nbytes)
+        for host, limiter in _limiters.items():
+            # 設定から外れたホストは制限なし（スロットリング時のみ減速）に戻す
+            wanted = limits.get(host, (None, None))
+            if limiter.configured_limits != wanted:
+                limiter.configure(*wanted)
+
+
+def limiter_for(host: str) -> HostLimiter:
+    """ホストの制限を返す。同じホストへの接続はすべて同じ制限を共有する"""
+    host = (host or '').lower()
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = HostLimiter(host)
+        return limiter
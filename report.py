@@ -0,0 +1,209 @@
+"""
+実行結果の集計
+
+一括処理 (run_batch) 1回分の結果を取得元ごとに記録します。
+ワーカープロセスからはプロセス間で受け渡せるよう辞書に変換して送り、
+親プロセスで1つの結果にまとめます。
+
+取得元ごとに転送バイト数、処理段階 (接続・検索・取得・保存・後処理) ごとの所要時間、
+処理に時間のかかったメッセージの上位を SourceMetrics で集計し、
+--once の JSON レポートに出力します。
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import hashlib
+import itertools
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+def source_identity(source_config: Dict[str, Any]) -> str:
+    """取得元アカウントの識別子"""
+    if source_config.get('path'):
+        # ローカルの取得元 (maildir / mbox) はパスで区別する
+        return '{}:{}'.format(source_config.get('protocol', ''), source_config['path'])
+    return '{}:{}@{}:{}'.format(
+        source_config.get('protocol', ''),
+        source_config.get('user', ''),
+        source_config.get('host', ''),
+        source_config.get('port', ''),
+    )
+
+
+def source_user(source_config: Dict[str, Any]) -> str:
+    """
+    ログや画面に表示する取得元の名前（SourceConfig.user と同じ値）。
+    ローカルの取得元 (maildir / mbox) で user が省略されていればファイル名（ディレクトリ名）
+    """
+    if source_config.get('user') or not source_config.get('path'):
+        return source_config.get('user', '')
+    return os.path.basename(os.path.normpath(os.path.expanduser(source_config['path'])))
+
+
+def source_id(source_config: Dict[str, Any]) -> str:
+    """URL などで取得元を指定するための短いID"""
+    return hashlib.sha1(source_identity(source_config).encode('utf-8')).hexdigest()[:12]
+
+
+class SourceMetrics:
+    """1つの取得元の処理量と処理段階ごとの所要時間"""
+    # 記録する「遅いメッセージ」の件数
+    SLOWEST = 10
+
+    def __init__(self):
+        self.bytes = 0
+        self.messages = 0
+        self.failed = 0
+        # サイズ別レーンで大きいメッセージのレーンに回した件数
+        self.deferred = 0
+        self.phases: Dict[str, float] = {}
+        # (秒数, 連番, 情報) の最小ヒープ。先頭が記録中で最も速いメッセージ
+        self._slowest: List[Tuple[float, int, Dict[str, Any]]] = []
+        self._seq = itertools.count()
+
+    def add_phase(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """with ブロックの所要時間を name の段階に加算する"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.monotonic() - started)
+
+    def message(self, seconds: float, **info: Any):
+        """1通の処理時間を記録する（上位 SLOWEST 件だけ保持する）"""
+        self.messages += 1
+        item = (seconds, next(self._seq), info)
+        if len(self._slowest) < self.SLOWEST:
+            heapq.heappush(self._slowest, item)
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+
+    def slowest(self) -> List[Dict[str, Any]]:
+        return [dict(info, seconds=round(seconds, 3))
+                for seconds, _, info in sorted(self._slowest, key=lambda item: item[0], reverse=True)]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'bytes': self.bytes,
+            'messages': self.messages,
+            'failed': self.failed,
+            'deferred': self.deferred,
+            'phases': {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            'slowest': self.slowest(),
+        }
+
+
+class RunReport:
+    """1回の一括処理の取得元ごとの結果"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.sources: List[Dict[str, Any]] = []
+        # 取得元に関係しないエラー（移動先に接続できないなど）
+        self.error: Optional[str] = None
+        # 停止シグナルで中断された
+        self.interrupted = False
+
+    def add_source(self, source_config: Dict[str, Any], moved: int = 0, seconds: float = 0.0,
+                   error: Optional[str] = None, **extra: Any):
+        """1つの取得元の結果を記録する"""
+        entry = {
+            'id': source_id(source_config),
+            'protocol': source_config.get('protocol', ''),
+            'user': source_user(source_config),
+            # ローカルの取得元 (maildir / mbox) はホストの代わりにパスを表示する
+            'host': source_config.get('host') or source_config.get('path', ''),
+            'moved': moved,
+            'seconds': round(seconds, 3),
+            'error': error,
+        }
+        entry.update(extra)
+        self.sources.append(entry)
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def total_moved(self) -> int:
+        return sum(entry['moved'] for entry in self.sources)
+
+    @property
+    def total_errors(self) -> int:
+        return sum(1 for entry in self.sources if entry['error'])
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(entry.get('bytes', 0) for entry in self.sources)
+
+    @property
+    def status(self) -> str:
+        """'ok' / 'failed' / 'interrupted'"""
+        if self.error or self.total_errors:
+            return 'failed'
+        if self.interrupted:
+            return 'interrupted'
+        return 'ok'
+
+    def slowest(self) -> List[Dict[str, Any]]:
+        """全取得元を通して処理に時間のかかったメッセージ"""
+        messages = [dict(message, source=entry['user'])
+                    for entry in self.sources for message in entry.get('slowest', [])]
+        return heapq.nlargest(SourceMetrics.SLOWEST, messages, key=lambda message: message['seconds'])
+
+    def merge(self, other: 'RunReport'):
+        """他の結果（ワーカープロセスの結果など）を取り込む"""
+        self.sources.extend(other.sources)
+        self.error = self.error or other.error
+        self.interrupted = self.interrupted or other.interrupted
+
+    def summary(self) -> str:
+        return f"処理完了: 合計 {self.total_moved} 通移動しました (エラー: {self.total_errors} 件)"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'status': self.status,
+            'started': self.started,
+            'finished': self.finished,
+            'seconds': round((self.finished or time.time()) - self.started, 3),
+            'error': self.error,
+            'interrupted': self.interrupted,
+            'total_moved': self.total_moved,
+            'total_errors': self.total_errors,
+            'total_bytes': self.total_bytes,
+            'sources': self.sources,
+            'slowest': self.slowest(),
+        }
+
+    def write_json(self, path: str):
+        """
+        結果を JSON で書き出す。path が '-' なら標準出力に書く
+        ファイルは一時ファイルに書いてから置き換えるため、読み手が途中の内容を見ることはない
+        """
+        data = json.dumps(self.to_dict(), ensure_ascii=False, indent=2) + '\n'
+        if path == '-':
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'RunReport':
+        report = cls()
+        report.started = data.get('started', report.started)
+        report.finished = data.get('finished')
+        report.sources = list(data.get('sources', []))
+        report.error = data.get('error')
+        report.interrupted = bool(data.get('interrupted'))
+        return report
@@ -0,0 +1,201 @@
+"""
+振り分けルールエンジン
+
+設定の `routing` に書かれたルールを設定読み込み時に一度だけコンパイルし、
+メッセージごとの保存先フォルダを決定します。
+
+ルールは上から順に評価され、最初に全条件を満たしたルールのフォルダが使われます。
+どのルールにも一致しない場合は移動先の `folder` に保存されます。
+
+    routing:
+      - folder: Lists/Python
+        list_id: python-list.python.org
+      - folder: Work
+        source: work@example.com
+      - folder: Newsletters
+        from: "@news.example.com"      # @で始まる値はドメイン（サブドメイン含む）に一致
+      - folder: Invoices
+        subject_regex: "(?i)invoice"
+      - folder: Large
+        min_size: 10485760
+"""
+
+import re
+import logging
+from email.message import Message
+from email.utils import getaddresses
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 完全一致で索引化できる条件（ルールのキー -> メッセージのヘッダ）
+LITERAL_FIELDS = {
+    'source': None,
+    'from': 'From',
+    'to': 'To',
+    'list_id': 'List-Id',
+}
+
+_LIST_ID_RE = re.compile(r'<([^>]+)>')
+
+
+class _Rule:
+    """コンパイル済みの1ルール"""
+    __slots__ = ('index', 'folder', 'literals', 'subject_regex', 'min_size', 'max_size')
+
+    def __init__(self, index: int, spec: Dict[str, Any]):
+        self.index = index
+        self.folder = spec.get('folder')
+        if not self.folder:
+            raise ValueError(f"振り分けルール #{index + 1} に folder が指定されていません")
+
+        # field -> (完全一致の値の集合, ドメイン条件の集合)
+        self.literals: Dict[str, tuple] = {}
+        for field in LITERAL_FIELDS:
+            if field not in spec:
+                continue
+            values = spec[field]
+            if isinstance(values, str):
+                values = [values]
+            exact = set()
+            domains = set()
+            for value in values:
+                value = str(value).strip().lower()
+                if field in ('from', 'to') and value.startswith('@'):
+                    domains.add(value[1:])
+                else:
+                    exact.add(value)
+            self.literals[field] = (exact, domains)
+
+        pattern = spec.get('subject_regex')
+        try:
+            self.subject_regex = re.compile(pattern) if pattern else None
+        except re.error as e:
+            raise ValueError(f"振り分けルール #{index + 1} の subject_regex が不正です: {e}")
+        self.min_size = _size(spec, 'min_size', index)
+        self.max_size = _size(spec, 'max_size', index)
+
+        if not self.literals and self.subject_regex is None and self.min_size is None and self.max_size is None:
+            raise ValueError(f"振り分けルール #{index + 1} に条件が指定されていません")
+
+    def matches(self, values: Dict[str, List[str]], subject: str, size: int) -> bool:
+        for field, (exact, domains) in self.literals.items():
+            if not any(v in exact or (domains and _domain_matches(v, domains)) for v in values[field]):
+                return False
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        if self.subject_regex is not None and not self.subject_regex.search(subject or ''):
+            return False
+        return True
+
+
+def _size(spec: Dict[str, Any], key: str, index: int) -> Optional[float]:
+    """min_size / max_size を検証する（0以上のバイト数）"""
+    value = spec.get(key)
+    if value is None:
+        return None
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ValueError(f"振り分けルール #{index + 1} の {key} は0以上のバイト数で指定してください: {value!r}")
+    return value
+
+
+def _domain_matches(address: str, domains: set) -> bool:
+    domain = address.rpartition('@')[2]
+    while domain:
+        if domain in domains:
+            return True
+        domain = domain.partition('.')[2]
+    return False
+
+
+class RoutingRules:
+    """
+    振り分けルールの集合。
+
+    完全一致条件は値ごとの辞書に、ドメイン条件はラベルを逆順にたどるトライに索引化し、
+    メッセージから候補ルールだけを取り出してから残りの条件を評価する。
+    """
+
+    def __init__(self, specs: List[Dict[str, Any]]):
+        self.rules = [_Rule(i, spec) for i, spec in enumerate(specs or [])]
+        self._exact: Dict[str, Dict[str, List[int]]] = {field: {} for field in LITERAL_FIELDS}
+        self._domains: Dict[str, dict] = {'from': {}, 'to': {}}
+        self._unindexed: List[int] = []
+        # 評価に必要なフィールドだけメッセージから取り出す
+        self.fields = set()
+
+        for rule in self.rules:
+            self.fields.update(rule.literals)
+            if not rule.literals:
+                self._unindexed.append(rule.index)
+                continue
+            # 最初の完全一致条件で索引化する（残りの条件は matches で確認）
+            field, (exact, domains) = next(iter(rule.literals.items()))
+            for value in exact:
+                self._exact[field].setdefault(value, []).append(rule.index)
+            for domain in domains:
+                node = self._domains[field]
+                for label in reversed(domain.split('.')):
+                    node = node.setdefault(label, {})
+                node.setdefault(None, []).append(rule.index)
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'RoutingRules':
+        rules = cls(config.get('routing') or [])
+        if rules:
+            logger.info(f"振り分けルールを {len(rules.rules)} 件読み込みました")
+        return rules
+
+    def _extract(self, source: str, headers: Message) -> Dict[str, List[str]]:
+        values: Dict[str, List[str]] = {}
+        for field in self.fields:
+            if field == 'source':
+                values[field] = [source.lower()]
+            elif field == 'list_id':
+                raw = headers.get('List-Id') or ''
+                match = _LIST_ID_RE.search(raw)
+                values[field] = [(match.group(1) if match else raw).strip().lower()] if raw else []
+            else:
+                raw = headers.get_all(LITERAL_FIELDS[field]) or []
+                values[field] = [addr.lower() for _, addr in getaddresses([str(v) for v in raw]) if addr]
+        return values
+
+    def _candidates(self, values: Dict[str, List[str]]) -> List[int]:
+        candidates = set(self._unindexed)
+        for field, index in self._exact.items():
+            if not index:
+                continue
+            for value in values.get(field, ()):
+                candidates.update(index.get(value, ()))
+        for field, trie in self._domains.items():
+            if not trie:
+                continue
+            for address in values.get(field, ()):
+                node = trie
+                for label in reversed(address.rpartition('@')[2].split('.')):
+                    node = node.get(label)
+                    if node is None:
+                        break
+                    candidates.update(node.get(None, ()))
+        return sorted(candidates)
+
+    def match(self, source: str, headers: Message, subject: str, size: int) -> Optional[str]:
+        """
+        メッセージの保存先フォルダを返す。どのルールにも一致しなければ None。
+        headers はヘッダのみ解析済みのメッセージ、subject はデコード済みの件名。
+        """
+        if not self.rules:
+            return None
+        values = self._extract(source, headers)
+        for index in self._candidates(values):
+            rule = self.rules[index]
+            if rule.matches(values, subject, size):
+                return rule.folder
+        return None
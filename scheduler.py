@@ -0,0 +1,176 @@
+"""
+定期実行スケジューラ
+
+次に実行すべきジョブの時刻をヒープで管理し、その時刻まで Condition.wait で眠ります。
+待機中に「今すぐ実行」「実行間隔の変更」「停止」が要求されると、待機を即座に打ち切って
+スケジュールを再計算します。
+
+シグナルハンドラは待機中のメインスレッドに割り込むため、Condition を操作すると
+通知が待機の開始前に失われることがあります。シグナルハンドラからの要求は
+request_stop() / request_run() でフラグに記録するだけにし、待機側が
+SIGNAL_CHECK_INTERVAL 秒ごとに起きて確認します。
+
+ジョブの次回実行時刻は、前回の実行が終わった時刻に実行間隔を足した時刻です。
+"""
+
+import time
+import heapq
+import logging
+import itertools
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# シグナルハンドラからの要求を確認する間隔（秒）
+SIGNAL_CHECK_INTERVAL = 1.0
+
+
+class _Job:
+    __slots__ = ('name', 'func', 'interval', 'entry', 'running', 'run_again', 'last_finished')
+
+    def __init__(self, name: str, func: Callable[[], None], interval: float):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        # ヒープ上の有効なエントリ (due, seq)。None なら予定なし
+        self.entry: Optional[Tuple[float, int]] = None
+        self.running = False
+        # 実行中に run_now された場合、終了後すぐに再実行する
+        self.run_again = False
+        self.last_finished: Optional[float] = None
+
+
+class Scheduler:
+    """
+    タイマーヒープによるスケジューラ。run() を呼び出したスレッドでジョブを順に実行する。
+    シグナルハンドラからは stop() / run_now() ではなく request_stop() / request_run() を呼び出す。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.RLock())
+        self._heap: List[Tuple[float, int, str]] = []
+        self._jobs: Dict[str, _Job] = {}
+        self._seq = itertools.count()
+        self._stopped = False
+        # シグナルハンドラからの要求（ロックを取らずに設定し、待機側で反映する）
+        self._stop_requested = False
+        self._run_requested: Set[str] = set()
+
+    def _push(self, job: _Job, due: float):
+        seq = next(self._seq)
+        job.entry = (due, seq)
+        heapq.heappush(self._heap, (due, seq, job.name))
+        self._cond.notify_all()
+
+    def add_job(self, name: str, func: Callable[[], None], interval: float, delay: float = 0.0):
+        """ジョブを登録する。最初の実行は delay 秒後"""
+        with self._cond:
+            job = _Job(name, func, interval)
+            self._jobs[name] = job
+            self._push(job, time.monotonic() + delay)
+
+    def remove_job(self, name: str):
+        with self._cond:
+            job = self._jobs.pop(name, None)
+            if job:
+                job.entry = None
+
+    def run_now(self, name: str):
+        """ジョブを今すぐ実行する。実行中であれば終了後にもう一度実行する"""
+        with self._cond:
+            job = self._jobs.get(name)
+            if not job:
+                return
+            if job.running:
+                job.run_again = True
+            else:
+                self._push(job, time.monotonic())
+
+    def reschedule(self, name: str, interval: float):
+        """実行間隔を変更し、次回の実行時刻を前回の終了時刻から計算し直す"""
+        with self._cond:
+            job = self._jobs.get(name)
+            if not job or job.interval == interval:
+                return
+            job.interval = interval
+            if not job.running:
+                base = job.last_finished if job.last_finished is not None else time.monotonic()
+                self._push(job, base + interval)
+
+    def seconds_until(self, name: str) -> Optional[float]:
+        """次回の実行までの秒数。実行中または予定がなければ None"""
+        with self._cond:
+            job = self._jobs.get(name)
+            if not job or not job.entry:
+                return None
+            return max(0.0, job.entry[0] - time.monotonic())
+
+    def stop(self):
+        """待機中の run() を直ちに終了させる（実行中のジョブの完了は待たない）"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def request_stop(self):
+        """シグナルハンドラ用の stop()。フラグを立てるだけで、待機側が次に起きた時点で停止する"""
+        self._stop_requested = True
+
+    def request_run(self, name: str):
+        """シグナルハンドラ用の run_now()。待機側が次に起きた時点で反映する"""
+        self._run_requested.add(name)
+
+    def _apply_requests(self):
+        """シグナルハンドラからの要求を反映する（ロックを取った状態で呼び出す）"""
+        if self._stop_requested:
+            self._stopped = True
+        while self._run_requested:
+            self.run_now(self._run_requested.pop())
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped or self._stop_requested
+
+    def _next_job(self) -> Optional[_Job]:
+        """実行時刻になったジョブを返す。停止された場合は None"""
+        while True:
+            self._apply_requests()
+            if self._stopped:
+                return None
+            # 取り消し・変更されたエントリを捨てる
+            while self._heap:
+                due, seq, name = self._heap[0]
+                job = self._jobs.get(name)
+                if job and job.entry == (due, seq):
+                    break
+                heapq.heappop(self._heap)
+            now = time.monotonic()
+            if self._heap and self._heap[0][0] <= now:
+                job = self._jobs[heapq.heappop(self._heap)[2]]
+                job.entry = None
+                return job
+            timeout = self._heap[0][0] - now if self._heap else SIGNAL_CHECK_INTERVAL
+            # シグナルハンドラは通知しないため、要求を確認できるよう待機時間に上限を設ける
+            self._cond.wait(min(timeout, SIGNAL_CHECK_INTERVAL))
+
+    def run(self):
+        """stop() が呼ばれるまでジョブを実行し続ける"""
+        while True:
+            with self._cond:
+                job = self._next_job()
+                if job is None:
+                    return
+                job.running = True
+            try:
+                job.func()
+            except Exception as e:
+                logger.error(f"ジョブ {job.name} の実行中にエラーが発生しました: {e}")
+            with self._cond:
+                job.running = False
+                job.last_finished = time.monotonic()
+                if self._jobs.get(job.name) is job and not self._stopped:
+                    if job.run_again:
+                        job.run_again = False
+                        self._push(job, job.last_finished)
+                    else:
+                        self._push(job, job.last_finished + job.interval)
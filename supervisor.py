@@ -0,0 +1,264 @@
+"""
+マルチプロセス・ワーカーモード
+
+デーモンモードで取得元を複数のワーカープロセスに分けて処理します。
+ヘッダのデコードや MIME 解析、TLS の処理は GIL の下で動くため、スレッドでは
+1コア分しか使えません。ワーカーをプロセスに分けることで複数のコアを使えるようにします。
+
+- 取得元はコンシステントハッシュでワーカーに割り当てる。ワーカー数が変わらなければ
+  同じ取得元は常に同じワーカーで処理されるため、keep_alive のセッションを再利用できる
+- ワーカーのログは上限つきのキュー経由で親プロセスのハンドラに出力する
+- 異常終了したワーカーは再起動し、処理中だった取得元はその回のエラーとして集計する
+- 各ワーカーの結果 (RunReport) を親プロセスで1つにまとめる
+
+レート制限 (rate_limits) はプロセスごとに持つため、設定値をワーカー数で割って渡す。
+"""
+
+import bisect
+import signal
+import hashlib
+import logging
+import threading
+import multiprocessing
+import multiprocessing.connection
+from logging.handlers import QueueListener
+from typing import Any, Callable, Dict, List, Optional
+from report import RunReport, source_identity
+from logging_setup import BoundedQueueHandler, QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    """コンシステントハッシュ。ワーカーごとに仮想ノードを置いて偏りを抑える"""
+    REPLICAS = 64
+
+    def __init__(self, nodes: List[int]):
+        self._ring = sorted(
+            (self._hash(f"worker-{node}#{replica}"), node)
+            for node in nodes for replica in range(self.REPLICAS)
+        )
+        self._keys = [key for key, _ in self._ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def node_for(self, key: str) -> int:
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[index][1]
+
+
+def _worker_main(index: int, conn, stop_event, log_queue):
+    """ワーカープロセスの本体。親から設定を受け取るたびに run_batch を実行する"""
+    # Ctrl+C はプロセスグループ全体に届くため、停止は親からの stop_event に任せる
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    root = logging.getLogger()
+    root.handlers[:] = [BoundedQueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+
+    # spawn で起動された場合もここで読み込む
+    from core import run_batch, close_connection_pool
+
+    # 進捗イベントは取得スレッドからも送られるため、送信を直列化する
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    try:
+        while True:
+            try:
+                config = conn.recv()
+            except EOFError:
+                # 親プロセスが終了した
+                break
+            if config is None:
+                break
+            report = RunReport()
+            try:
+                run_batch(config, stop_event, lambda data: send(('event', data)), report)
+            except Exception as e:
+                logger.error(f"ワーカー {index}: 実行エラー: {e}")
+                if not report.sources:
+                    for source_config in config.get('sources', []):
+                        report.add_source(source_config, error=str(e))
+            report.finish()
+            send(('result', report.to_dict()))
+    finally:
+        close_connection_pool()
+
+
+class _Worker:
+    __slots__ = ('index', 'process', 'conn')
+
+    def __init__(self, index: int, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+
+
+class Supervisor:
+    """ワーカープロセスを起動・監視し、実行サイクルごとに取得元を振り分ける"""
+
+    def __init__(self, workers: int):
+        self.size = workers
+        # fork はスレッドを持つ親プロセスでは安全でないため、全プラットフォームで spawn を使う
+        self._ctx = multiprocessing.get_context('spawn')
+        # 実行中のワーカーに処理の中断を伝える
+        self.stop_event = self._ctx.Event()
+        self._log_queue = self._ctx.Queue(QUEUE_SIZE)
+        self._log_listener: Optional[QueueListener] = None
+        self._workers: List[Optional[_Worker]] = [None] * workers
+        self._ring = HashRing(list(range(workers)))
+        self.restarts = 0
+
+    def start(self):
+        root = logging.getLogger()
+        self._log_listener = QueueListener(self._log_queue, *root.handlers, respect_handler_level=True)
+        self._log_listener.start()
+        for index in range(self.size):
+            self._spawn(index)
+        logger.info(f"{self.size} 個のワーカープロセスを起動しました")
+
+    def _spawn(self, index: int) -> _Worker:
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(index, child_conn, self.stop_event, self._log_queue),
+            name=f"MailConsolidator-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        worker = self._workers[index] = _Worker(index, process, parent_conn)
+        return worker
+
+    def _restart(self, index: int) -> _Worker:
+        old = self._workers[index]
+        if old:
+            old.conn.close()
+            old.process.join(timeout=1)
+        self.restarts += 1
+        logger.warning(f"ワーカー {index} を再起動します")
+        return self._spawn(index)
+
+    def assign(self, sources: List[Dict[str, Any]]) -> Dict[int, List[Dict[str, Any]]]:
+        """取得元をワーカーに割り当てる"""
+        assignments: Dict[int, List[Dict[str, Any]]] = {}
+        for source_config in sources:
+            index = self._ring.node_for(source_identity(source_config))
+            assignments.setdefault(index, []).append(source_config)
+        return assignments
+
+    @staticmethod
+    def _worker_config(config: Dict[str, Any], sources: List[Dict[str, Any]], active: int) -> Dict[str, Any]:
+        worker_config = dict(config, sources=sources)
+        rate_limits = config.get('rate_limits')
+        if rate_limits and active > 1:
+            # 同じホストへ複数のワーカーが同時に接続するため、制限を均等に分ける
+            worker_config['rate_limits'] = {
+                host: {key: value / active for key, value in (spec or {}).items() if value}
+                for host, spec in rate_limits.items()
+            }
+        return worker_config
+
+    def run_cycle(self, config: Dict[str, Any], callback: Optional[Callable] = None) -> RunReport:
+        """
+        1回分の一括処理をワーカーに振り分け、すべての結果を待って集計する
+        callback にはワーカーから届いた進捗イベントを渡す
+        """
+        report = RunReport()
+        assignments = self.assign(config.get('sources', []))
+        pending: Dict[int, List[Dict[str, Any]]] = {}
+
+        for index, sources in assignments.items():
+            worker_config = self._worker_config(config, sources, len(assignments))
+            worker = self._workers[index]
+            if worker is None or not worker.process.is_alive():
+                worker = self._restart(index)
+            try:
+                worker.conn.send(worker_config)
+            except (OSError, ValueError):
+                worker = self._restart(index)
+                worker.conn.send(worker_config)
+            pending[index] = sources
+
+        while pending:
+            waitables = {}
+            for index in pending:
+                worker = self._workers[index]
+                waitables[worker.conn] = index
+                waitables[worker.process.sentinel] = index
+            for obj in multiprocessing.connection.wait(list(waitables)):
+                index = waitables[obj]
+                if index not in pending:
+                    continue
+                worker = self._workers[index]
+                result = None
+                broken = False
+                # 結果を送ってから終了した場合に取りこぼさないよう、終了時もパイプを先に読む
+                try:
+                    while result is None and worker.conn.poll():
+                        kind, data = worker.conn.recv()
+                        if kind == 'result':
+                            result = data
+                        elif callback:
+                            callback(data)
+                except (EOFError, OSError):
+                    broken = True
+                if result is not None:
+                    worker_report = RunReport.from_dict(result)
+                    for entry in worker_report.sources:
+                        entry['worker'] = index
+                    report.merge(worker_report)
+                    elapsed = (worker_report.finished or worker_report.started) - worker_report.started
+                    logger.info(
+                        f"ワーカー {index} (PID: {worker.process.pid}): "
+                        f"{len(worker_report.sources)} 件の取得元、{worker_report.total_moved} 通、{elapsed:.1f}秒"
+                    )
+                    del pending[index]
+                    continue
+                if not broken and worker.process.is_alive():
+                    # 進捗イベントだけを受け取った
+                    continue
+                worker.process.join(timeout=5)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+                    worker.process.join()
+                logger.error(f"ワーカー {index} が異常終了しました (終了コード: {worker.process.exitcode})")
+                for source_config in pending.pop(index):
+                    report.add_source(source_config, error="ワーカープロセスが異常終了しました", worker=index)
+                self._restart(index)
+
+        report.finish()
+        return report
+
+    def stop(self):
+        """実行中の処理を中断させる（シグナルハンドラから呼び出す）。停止後は再開しない"""
+        self.stop_event.set()
+
+    def close(self, timeout: float = 10.0):
+        """ワーカーを終了させる"""
+        self.stop_event.set()
+        for worker in self._workers:
+            if worker is None:
+                continue
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self._workers:
+            if worker is None:
+                continue
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                logger.warning(f"ワーカー {worker.index} が応答しないため、強制終了します")
+                worker.process.terminate()
+                worker.process.join()
+            worker.conn.close()
+        if self._log_listener:
+            self._log_listener.stop()
+            self._log_listener = None
+        logger.info("ワーカープロセスを終了しました")